@@ -6,7 +6,31 @@ import boto3
 import pandas as pd
 from es_aws_functions import aws_functions, exception_classes, general_functions
 from marshmallow import EXCLUDE, Schema, fields
-from marshmallow.validate import Equal
+from marshmallow.validate import Equal, OneOf
+
+from batch import BATCH_COLUMN, read_batch, split_batch
+from capture import captured
+from dtype_policy import apply_dtype_policy
+from engines import PandasEngine
+from instrumentation import Instrumentation
+from json_layout import JSON_LAYOUTS, decode_frame
+from local_cache import LocalCache
+from memory_governor import MemoryGovernor
+from notifications import NotificationDispatcher
+from parallel import apply_partitioned, available_workers
+from profiling import profiled
+from storage import STORAGE_BACKENDS, STORAGE_DIRECTORY, open_storage
+from tracing import Tracer
+from transfer import Transfer
+
+
+class BatchRunSchema(Schema):
+    class Meta:
+        unknown = EXCLUDE
+
+    in_file_name = fields.Str(required=True)
+    out_file_name_bricks = fields.Str(required=True)
+    out_file_name_region = fields.Str(required=True)
 
 
 class EnvironmentSchema(Schema):
@@ -18,7 +42,14 @@ class EnvironmentSchema(Schema):
         raise ValueError(f"Error validating environment params: {e}")
 
     bucket_name = fields.Str(required=True)
+    local_cache_max_bytes = fields.Int(missing=0)
     method_name = fields.Str(required=True)
+    storage_backend = fields.Str(missing="s3", validate=OneOf(STORAGE_BACKENDS))
+    storage_directory = fields.Str(missing=STORAGE_DIRECTORY)
+    transfer_concurrency = fields.Int(missing=10)
+    transfer_hedge_percentile = fields.Float(missing=0.0)
+    transfer_max_attempts = fields.Int(missing=0)
+    transfer_part_size = fields.Int(missing=0)
 
 
 class FactorsSchema(Schema):
@@ -37,20 +68,36 @@ class RuntimeSchema(Schema):
         logging.error(f"Error validating runtime params: {e}")
         raise ValueError(f"Error validating runtime params: {e}")
 
+    async_notifications = fields.Bool(missing=False)
+    batch_runs = fields.List(fields.Nested(BatchRunSchema), missing=[])
     bpm_queue_url = fields.Str(required=True)
+    column_types = fields.Dict(keys=fields.Str(), values=fields.Str(), missing={})
     environment = fields.Str(Required=True)
     factors_parameters = fields.Dict(
         keys=fields.String(validate=Equal(comparable="RuntimeVariables")),
         values=fields.Nested(FactorsSchema, required=True))
     in_file_name = fields.Str(required=True)
+    instrumentation_enabled = fields.Bool(missing=False)
+    json_layout = fields.Str(missing="records", validate=OneOf(JSON_LAYOUTS))
+    memory_fraction = fields.Float(missing=0.0)
+    memory_instrumentation_enabled = fields.Bool(missing=False)
+    optimise_dtypes = fields.Bool(missing=False)
     out_file_name_bricks = fields.Str(required=True)
     out_file_name_region = fields.Str(required=True)
+    parallel_enabled = fields.Bool(missing=False)
+    partition_column = fields.Str(missing="")
     sns_topic_arn = fields.Str(required=True)
+    sparse_bricks = fields.Bool(missing=False)
     survey = fields.Str(required=True)
     total_columns = fields.List(fields.String, required=True)
+    trace_context = fields.Dict(missing={})
+    tracemalloc_top = fields.Int(missing=0)
+    tracing_enabled = fields.Bool(missing=False)
     unique_identifier = fields.List(fields.String, required=True)
 
 
+@captured
+@profiled
 def lambda_handler(event, context):
     """
     The wrangler converts the data from JSON format into a dataframe and then edits data.
@@ -59,6 +106,25 @@ def lambda_handler(event, context):
     consolidated brick_type.
 
     :param event: Contains all the variables which are required for the specific run.
+        batch_runs - Optional. Further runs, each with an in_file_name,
+                        out_file_name_bricks and out_file_name_region, to split in
+                        the same pass.
+        parallel_enabled - Optional. Collate large inputs across all available
+                        CPUs.
+        async_notifications - Optional. Send the IN PROGRESS status to BPM from
+                        a background thread while the data is processed.
+        memory_fraction - Optional. Fraction of the memory limit the collation's
+                        intermediates may use, collating in chunks when needed.
+        partition_column - Optional. Write the outputs as one file per value of
+                        this column, with a manifest.
+        sparse_bricks - Optional. Collate the brick type columns from a long form
+                        holding only the reported values.
+        json_layout - Optional. Layout of the JSON files written, records (default)
+                        or split.
+        trace_context - Optional. Trace and parent span ids from the caller.
+        tracing_enabled - Optional. Emit trace spans for each stage.
+        capture_enabled - Optional. Record the invocation for replay.py.
+        profiling_enabled - Optional. Profile the invocation, see profiling.py.
     :param context: N/A
 
     :return:  Success & None/Error - Type: JSON
@@ -82,18 +148,40 @@ def lambda_handler(event, context):
 
         # Environment Variables
         bucket_name = environment_variables["bucket_name"]
+        local_cache_max_bytes = environment_variables["local_cache_max_bytes"]
         method_name = environment_variables["method_name"]
+        storage_backend = environment_variables["storage_backend"]
+        storage_directory = environment_variables["storage_directory"]
+        transfer_concurrency = environment_variables["transfer_concurrency"]
+        transfer_hedge_percentile = environment_variables["transfer_hedge_percentile"]
+        transfer_max_attempts = environment_variables["transfer_max_attempts"]
+        transfer_part_size = environment_variables["transfer_part_size"]
 
         # Runtime Variables
+        async_notifications = runtime_variables["async_notifications"]
+        batch_runs = runtime_variables["batch_runs"]
         bpm_queue_url = runtime_variables["bpm_queue_url"]
         column_list = runtime_variables["total_columns"]
+        column_types = runtime_variables["column_types"]
         environment = runtime_variables["environment"]
         factors_parameters = runtime_variables["factors_parameters"]["RuntimeVariables"]
         in_file_name = runtime_variables["in_file_name"]
+        instrumentation_enabled = runtime_variables["instrumentation_enabled"]
+        json_layout = runtime_variables["json_layout"]
+        memory_fraction = runtime_variables["memory_fraction"]
+        memory_instrumentation_enabled = \
+            runtime_variables["memory_instrumentation_enabled"]
+        optimise_dtypes = runtime_variables["optimise_dtypes"]
         out_file_name_bricks = runtime_variables["out_file_name_bricks"]
         out_file_name_region = runtime_variables["out_file_name_region"]
+        parallel_enabled = runtime_variables["parallel_enabled"]
+        partition_column = runtime_variables["partition_column"]
         sns_topic_arn = runtime_variables["sns_topic_arn"]
+        sparse_bricks = runtime_variables["sparse_bricks"]
         survey = runtime_variables["survey"]
+        trace_context = runtime_variables["trace_context"]
+        tracemalloc_top = runtime_variables["tracemalloc_top"]
+        tracing_enabled = runtime_variables["tracing_enabled"]
         unique_identifier = runtime_variables["unique_identifier"]
 
         # Factors Parameters
@@ -112,15 +200,52 @@ def lambda_handler(event, context):
                                                            run_id, context=context)
 
         raise exception_classes.LambdaFailure(error_message)
+
+    tracer = Tracer(run_id, current_module, trace_context, tracing_enabled)
+    instrumentation = Instrumentation(run_id, current_module, instrumentation_enabled,
+                                      memory_instrumentation_enabled, tracemalloc_top,
+                                      tracer)
+    transfer = Transfer(transfer_part_size, transfer_concurrency, json_layout,
+                        transfer_hedge_percentile, transfer_max_attempts)
+    local_cache = LocalCache(local_cache_max_bytes,
+                             read_dataframe=transfer.read_dataframe)
+    storage = open_storage(storage_backend, storage_directory, transfer, local_cache,
+                           partition_column, json_layout)
+    notifications = NotificationDispatcher(logger, async_notifications)
+    governor = MemoryGovernor(context, memory_fraction)
+
     try:
         logger.info("Started - retrieved configuration variables.")
         # Send start of module status to BPM.
         # (NB: Current step and total steps omitted to display as "-" in bpm.)
         status = "IN PROGRESS"
-        aws_functions.send_bpm_status(bpm_queue_url, current_module, status, run_id)
+        with instrumentation.stage("notify"):
+            notifications.submit(aws_functions.send_bpm_status, bpm_queue_url,
+                                 current_module, status, run_id)
+
+        # Batched runs are read together and split in a single pass.
+        in_file_names = [in_file_name]
+        out_file_names_bricks = [out_file_name_bricks]
+        out_file_names_region = [out_file_name_region]
+        for batch_run in batch_runs:
+            in_file_names.append(batch_run["in_file_name"])
+            out_file_names_bricks.append(batch_run["out_file_name_bricks"])
+            out_file_names_region.append(batch_run["out_file_name_region"])
+        batch_keys = [BATCH_COLUMN] if batch_runs else []
 
         # Pulls In Data.
-        data = aws_functions.read_dataframe_from_s3(bucket_name, in_file_name)
+        governor.check_read(storage, bucket_name, in_file_names)
+        with instrumentation.stage("read"):
+            if batch_runs:
+                data = read_batch(bucket_name, in_file_names, storage.read_dataframe)
+            else:
+                data = storage.read_dataframe(bucket_name, in_file_name)
+        instrumentation.record("runs", len(in_file_names))
+        if optimise_dtypes:
+            with instrumentation.stage("decode"):
+                data = apply_dtype_policy(data, column_types, unique_identifier)
+        instrumentation.record("rows_in", len(data))
+        instrumentation.record_frame("input", data)
 
         logger.info("Retrieved data from s3")
         new_type = 1  # This number represents Clay & Sandlime Combined
@@ -134,27 +259,22 @@ def lambda_handler(event, context):
         questions_list = [brick + "_" + column
                           for column in column_list
                           for brick in brick_type.keys()]
-        data["zero_data"] = data.apply(
-            lambda x: do_check(x, questions_list), axis=1)
-        data = data[~data["zero_data"]]
-        data.drop(["zero_data"], axis=1, inplace=True)
-
-        # Identify The Brick Type Of The Row.
-        data[unique_identifier[0]] = data.apply(
-            lambda x: calculate_row_type(x, brick_type, column_list), axis=1)
-
-        # Collate Each Rows 12 Good Brick Type Columns And 24 Empty Columns Down
-        # Into 12 With The Same Name.
-        data = data.apply(lambda x: sum_columns(x, brick_type, column_list,
-                                                unique_identifier), axis=1)
-
-        # Old Columns With Brick Type In The Name Are Dropped.
-        for question in questions_list:
-            data.drop([question], axis=1, inplace=True)
+        workers = available_workers() if parallel_enabled else 1
+        instrumentation.record("workers", workers)
+        chunks = governor.chunk_count(data)
+        instrumentation.record("chunks", chunks)
+        collate = collate_brick_types_sparse if sparse_bricks else collate_brick_types
+        with instrumentation.stage("compute"):
+            data = apply_partitioned(
+                lambda partition: collate(partition, brick_type, column_list,
+                                          questions_list, unique_identifier),
+                data, workers=workers, chunks=chunks)
+        instrumentation.record_frame("collated", data)
 
         # Add GB Region For Aggregation By Region.
         logger.info("Creating File For Aggregation By Region.")
-        data_region = data.to_json(orient="records")
+        with instrumentation.stage("encode"):
+            data_region = data.to_json(orient="records")
 
         payload = {
             "RuntimeVariables": {
@@ -164,67 +284,110 @@ def lambda_handler(event, context):
                 "region_column": region_column,
                 "regionless_code": regionless_code,
                 "run_id": run_id,
-                "survey": survey
+                "survey": survey,
+                "trace_context": tracer.child_context()
             }
         }
 
         # Pass the data for processing (adding of the regionless region.
-        gb_region_data = lambda_client.invoke(
-            FunctionName=method_name,
-            Payload=json.dumps(payload)
-        )
-        logger.info("Succesfully invoked method.")
-
-        json_response = json.loads(gb_region_data.get("Payload").read().decode("UTF-8"))
+        with instrumentation.stage("invoke"):
+            gb_region_data = lambda_client.invoke(
+                FunctionName=method_name,
+                Payload=json.dumps(payload)
+            )
+            logger.info("Succesfully invoked method.")
+
+            json_response = json.loads(
+                gb_region_data.get("Payload").read().decode("UTF-8"))
         logger.info("JSON extracted from method response.")
 
         if not json_response["success"]:
             raise exception_classes.MethodFailure(json_response["error"])
 
-        region_dataframe = pd.DataFrame(json.loads(json_response["data"]))
+        instrumentation.record_bytes("bytes_in", json_response["data"])
+        with instrumentation.stage("decode"):
+            region_dataframe = decode_frame(json_response["data"])
+            if optimise_dtypes:
+                region_dataframe = apply_dtype_policy(region_dataframe, column_types,
+                                                      unique_identifier)
+        instrumentation.record_frame("region", region_dataframe)
 
         totals_dict = {total_column: "sum" for total_column in column_list}
-
-        data_region = region_dataframe.groupby(
-            unique_identifier[1:]).agg(
-            totals_dict).reset_index()
-
-        region_output = data_region.to_json(orient="records")
-
-        aws_functions.save_to_s3(bucket_name, out_file_name_region, region_output)
+        engine = PandasEngine()
+
+        with instrumentation.stage("compute"):
+            data_region = engine.group_aggregate(
+                region_dataframe, batch_keys + unique_identifier[1:], totals_dict) \
+                .sort_index().reset_index()
+        instrumentation.record("groups", len(data_region))
+
+        with instrumentation.stage("encode"):
+            region_outputs = [data_region]
+            if batch_runs:
+                region_outputs = split_batch(data_region, len(in_file_names))
+            region_outputs = [storage.encode(output)
+                              for output in region_outputs]
+        for region_output in region_outputs:
+            instrumentation.record_bytes("bytes_out", region_output)
+
+        with instrumentation.stage("write"):
+            for file_name, region_output in zip(out_file_names_region, region_outputs):
+                storage.save(bucket_name, file_name, region_output)
 
         logger.info("Successfully sent data to s3")
 
         # Collate Brick Types Clay And Sand Lime Into A Single Type And Add To Data
         # For Aggregation By Brick Type.
         logger.info("Creating File For Aggregation By Brick Type.")
-        data_brick = data.copy()
+        with instrumentation.stage("compute"):
+            data_brick = data.copy()
+
+            data = data[data[unique_identifier[0]] != brick_type["concrete"]]
+            data[unique_identifier[0]] = new_type
 
-        data = data[data[unique_identifier[0]] != brick_type["concrete"]]
-        data[unique_identifier[0]] = new_type
+            data_brick = pd.concat([data_brick, data])
 
-        data_brick = pd.concat([data_brick, data])
+            brick_dataframe = engine.group_aggregate(
+                data_brick, batch_keys + unique_identifier[0:2], totals_dict) \
+                .sort_index().reset_index()
+        instrumentation.record("groups", len(brick_dataframe))
+        instrumentation.record_frame("bricks_concat", data_brick)
 
-        brick_dataframe = data_brick.groupby(unique_identifier[0:2]
-                                             ).agg(totals_dict).reset_index()
+        with instrumentation.stage("encode"):
+            brick_outputs = [brick_dataframe]
+            if batch_runs:
+                brick_outputs = split_batch(brick_dataframe, len(in_file_names))
+            brick_outputs = [storage.encode(output)
+                             for output in brick_outputs]
+        for brick_output in brick_outputs:
+            instrumentation.record_bytes("bytes_out", brick_output)
 
-        brick_output = brick_dataframe.to_json(orient="records")
-        aws_functions.save_to_s3(bucket_name, out_file_name_bricks, brick_output)
+        with instrumentation.stage("write"):
+            for file_name, brick_output in zip(out_file_names_bricks, brick_outputs):
+                storage.save(bucket_name, file_name, brick_output)
 
         logger.info("Successfully sent data to s3")
 
-        logger.info(aws_functions.send_sns_message(sns_topic_arn,
-                                                   "Pre Aggregation."))
+        with instrumentation.stage("notify"):
+            # The IN PROGRESS status must reach BPM before the SNS message.
+            notifications.flush()
+            aws_functions.send_sns_message(sns_topic_arn, "Pre Aggregation.")
 
         logger.info("Succesfully sent message to sns")
 
     except Exception as e:
+        # Queued messages must reach BPM before the failure status does.
+        notifications.flush(raise_errors=False)
         error_message = general_functions.handle_exception(e,
                                                            current_module,
                                                            run_id,
                                                            context=context,
                                                            bpm_queue_url=bpm_queue_url)
     finally:
+        if transfer.hedging:
+            instrumentation.record("hedged_reads", transfer.hedged_reads)
+            instrumentation.record("hedges_won", transfer.hedges_won)
+        instrumentation.emit(logger)
         if (len(error_message)) > 0:
             logger.error(error_message)
             raise exception_classes.LambdaFailure(error_message)
@@ -239,6 +402,108 @@ def lambda_handler(event, context):
     return {"success": True}
 
 
+def collate_brick_types(data, brick_type, column_list, questions_list,
+                        unique_identifier):
+    """
+    Prunes rows that contain no data, identifies the brick type of each row and
+    collates its brick type columns into generically named columns.
+
+    :param data: Contains all data. - DataFrame.
+    :param brick_type: Dictionary of the possible brick types. - Dict.
+    :param column_list: List of the columns that need to be added to. - List.
+    :param questions_list: List of the brick type question columns. - List.
+    :param unique_identifier: List of columns to make each row unique. - List.
+
+    :return:  Collated data. - DataFrame.
+    """
+    data["zero_data"] = data.apply(
+        lambda x: do_check(x, questions_list), axis=1)
+    data = data[~data["zero_data"]]
+    data.drop(["zero_data"], axis=1, inplace=True)
+
+    # Identify The Brick Type Of The Row.
+    data[unique_identifier[0]] = data.apply(
+        lambda x: calculate_row_type(x, brick_type, column_list), axis=1)
+
+    # Collate Each Rows 12 Good Brick Type Columns And 24 Empty Columns Down
+    # Into 12 With The Same Name.
+    data = data.apply(lambda x: sum_columns(x, brick_type, column_list,
+                                            unique_identifier), axis=1)
+
+    # Old Columns With Brick Type In The Name Are Dropped.
+    for question in questions_list:
+        data.drop([question], axis=1, inplace=True)
+
+    return data
+
+
+def collate_brick_types_sparse(data, brick_type, column_list, questions_list,
+                               unique_identifier):
+    """
+    Produces the same output as collate_brick_types, working from the long form of
+    the brick type question columns instead of row by row. Each contributor reports
+    for a single brick type, so the long form holds about a third of the values,
+    and the brick type columns are dropped as soon as it is built.
+
+    :param data: Contains all data. - DataFrame.
+    :param brick_type: Dictionary of the possible brick types. - Dict.
+    :param column_list: List of the columns that need to be added to. - List.
+    :param questions_list: List of the brick type question columns. - List.
+    :param unique_identifier: List of columns to make each row unique. - List.
+
+    :return:  Collated data. - DataFrame.
+    """
+    values = melt_brick_types(data, brick_type, column_list)
+    data = data.drop(questions_list, axis=1)
+
+    # Prune rows that contain no data, then identify the brick type of each row as
+    # the first type with a positive total, as calculate_row_type does.
+    totals = values.groupby(["row", "brick_order"])["value"].sum().reset_index()
+    row_totals = totals.groupby("row")["value"].sum()
+    kept_rows = row_totals.index[row_totals != 0]
+    row_types = totals[totals["value"] > 0].groupby("row")["brick_order"].min()
+
+    # Spread the values of each row's own brick type into the generic columns.
+    values = values.merge(row_types.reset_index(), on=["row", "brick_order"])
+    collated = values.pivot(index="row", columns="question", values="value") \
+        .reindex(index=row_types.index, columns=range(len(column_list))) \
+        .fillna(0).astype(values["value"].dtype)
+    collated.columns = column_list
+    collated = collated.reindex(kept_rows)
+
+    data = data.iloc[kept_rows].copy()
+    data[unique_identifier[0]] = row_types.reindex(kept_rows).map(
+        dict(enumerate(brick_type.values()))).to_numpy()
+    for column in column_list:
+        data[column] = collated[column].to_numpy()
+
+    return data
+
+
+def melt_brick_types(data, brick_type, column_list):
+    """
+    Reshapes the brick type question columns into a long form with one row per
+    non-zero value, so that its size scales with the values actually reported.
+
+    :param data: Contains all data. - DataFrame.
+    :param brick_type: Dictionary of the possible brick types. - Dict.
+    :param column_list: List of the generic question columns. - List.
+
+    :return:  The row position, brick type position in brick_type, question
+              position in column_list and value of each non-zero value. - DataFrame.
+    """
+    frames = []
+    for brick_order, brick in enumerate(brick_type.keys()):
+        brick_values = data[[brick + "_" + column for column in column_list]] \
+            .to_numpy()
+        rows, questions = brick_values.nonzero()
+        frames.append(pd.DataFrame({"row": rows, "brick_order": brick_order,
+                                    "question": questions,
+                                    "value": brick_values[rows, questions]}))
+
+    return pd.concat(frames, ignore_index=True)
+
+
 def calculate_row_type(row, brick_type, column_list):
     """
     Takes a row and adds up all columns of the current type.
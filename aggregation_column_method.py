@@ -1,9 +1,18 @@
-import json
 import logging
 
-import pandas as pd
 from es_aws_functions import general_functions
 from marshmallow import EXCLUDE, Schema, fields
+from marshmallow.validate import OneOf
+
+from capture import captured
+from dtype_policy import apply_dtype_policy
+from engines import ENGINES, PandasEngine, get_engine
+from instrumentation import Instrumentation
+from json_layout import JSON_LAYOUTS, decode_frame, encode_frame
+from memory_governor import MemoryGovernor
+from parallel import apply_partitioned, available_workers
+from profiling import profiled
+from tracing import Tracer
 
 
 class RuntimeSchema(Schema):
@@ -17,13 +26,27 @@ class RuntimeSchema(Schema):
     additional_aggregated_column = fields.Str(required=True)
     aggregated_column = fields.Str(required=True)
     aggregation_type = fields.Str(required=True)
+    batch_column = fields.Str(missing="")
     cell_total_column = fields.Str(required=True)
+    column_types = fields.Dict(keys=fields.Str(), values=fields.Str(), missing={})
     data = fields.Str(required=True)
+    engine = fields.Str(missing="pandas", validate=OneOf(ENGINES))
     environment = fields.Str(required=True)
+    instrumentation_enabled = fields.Bool(missing=False)
+    json_layout = fields.Str(missing="records", validate=OneOf(JSON_LAYOUTS))
+    memory_fraction = fields.Float(missing=0.0)
+    memory_instrumentation_enabled = fields.Bool(missing=False)
+    optimise_dtypes = fields.Bool(missing=False)
+    parallel_enabled = fields.Bool(missing=False)
     survey = fields.Str(required=True)
     total_columns = fields.List(fields.String, required=True)
+    trace_context = fields.Dict(missing={})
+    tracemalloc_top = fields.Int(missing=0)
+    tracing_enabled = fields.Bool(missing=False)
 
 
+@captured
+@profiled
 def lambda_handler(event, context):
     """
     Generates a JSON dataset, grouped by the given aggregated_column(e.g.county) with
@@ -37,6 +60,24 @@ def lambda_handler(event, context):
         aggregation_type - How we wish to do the aggregation. e.g. sum, count, nunique.
         total_columns - The names of the columns to produce aggregations for.
         cell_total_column - Name of column to rename total_column.
+        instrumentation_enabled - Optional. Emit per-stage timing metrics.
+        memory_instrumentation_enabled - Optional. Emit peak RSS and dataframe
+                        memory footprints.
+        tracemalloc_top - Optional. Number of top allocating lines to report.
+        trace_context - Optional. Trace and parent span ids from the caller.
+        tracing_enabled - Optional. Emit trace spans for each stage.
+        batch_column - Optional. Column holding the run of each row when several
+                        runs are aggregated together.
+        parallel_enabled - Optional. Aggregate large inputs across all available
+                        CPUs.
+        engine - Optional. Compute engine for the aggregation kernels, pandas
+                        (default) or duckdb.
+        memory_fraction - Optional. Fraction of the memory limit the calculation's
+                        intermediates may use, calculating in chunks when needed.
+        json_layout - Optional. Layout of the output JSON, records (default) or
+                        split. The input is read in either layout.
+        capture_enabled - Optional. Record the invocation for replay.py.
+        profiling_enabled - Optional. Profile the invocation, see profiling.py.
     }
 
     :param context: N/A
@@ -57,11 +98,24 @@ def lambda_handler(event, context):
         additional_aggregated_column = runtime_variables["additional_aggregated_column"]
         aggregated_column = runtime_variables["aggregated_column"]
         aggregation_type = runtime_variables["aggregation_type"]
+        batch_column = runtime_variables["batch_column"]
         cell_total_column = runtime_variables["cell_total_column"]
-        data = json.loads(runtime_variables["data"])
+        column_types = runtime_variables["column_types"]
+        data = runtime_variables["data"]
+        engine_name = runtime_variables["engine"]
         environment = runtime_variables["environment"]
+        instrumentation_enabled = runtime_variables["instrumentation_enabled"]
+        json_layout = runtime_variables["json_layout"]
+        memory_fraction = runtime_variables["memory_fraction"]
+        memory_instrumentation_enabled = \
+            runtime_variables["memory_instrumentation_enabled"]
+        optimise_dtypes = runtime_variables["optimise_dtypes"]
+        parallel_enabled = runtime_variables["parallel_enabled"]
         survey = runtime_variables["survey"]
         total_columns = runtime_variables["total_columns"]
+        trace_context = runtime_variables["trace_context"]
+        tracemalloc_top = runtime_variables["tracemalloc_top"]
+        tracing_enabled = runtime_variables["tracing_enabled"]
 
     except Exception as e:
         error_message = general_functions.handle_exception(e, current_module, run_id,
@@ -75,9 +129,23 @@ def lambda_handler(event, context):
                                                            run_id, context=context)
         return {"success": False, "error": error_message}
 
+    tracer = Tracer(run_id, current_module, trace_context, tracing_enabled)
+    instrumentation = Instrumentation(run_id, current_module, instrumentation_enabled,
+                                      memory_instrumentation_enabled, tracemalloc_top,
+                                      tracer)
+    governor = MemoryGovernor(context, memory_fraction)
+
     try:
         logger.info("Started - retrieved configuration variables from wrangler.")
-        input_dataframe = pd.DataFrame(data)
+        instrumentation.record_bytes("bytes_in", data)
+        with instrumentation.stage("decode"):
+            input_dataframe = decode_frame(data)
+            if optimise_dtypes:
+                input_dataframe = apply_dtype_policy(
+                    input_dataframe, column_types,
+                    [aggregated_column, additional_aggregated_column])
+        instrumentation.record("rows_in", len(input_dataframe))
+        instrumentation.record_frame("input", input_dataframe)
         totals_dict = {total_column: aggregation_type for total_column in total_columns}
 
         logger.info("JSON data converted to DataFrame.")
@@ -85,11 +153,22 @@ def lambda_handler(event, context):
         to_aggregate = [aggregated_column]
         if additional_aggregated_column != "":
             to_aggregate.append(additional_aggregated_column)
-
-        county_agg = input_dataframe.groupby(to_aggregate)
-
-        agg_by_county_output = county_agg.agg(totals_dict) \
-            .reset_index()
+        if batch_column != "":
+            to_aggregate.insert(0, batch_column)
+
+        # DuckDB already runs across all CPUs, and cannot be used in a forked worker.
+        engine = get_engine(engine_name)
+        workers = available_workers() if parallel_enabled and engine_name == "pandas" \
+            else 1
+        instrumentation.record("workers", workers)
+        chunks = governor.chunk_count(input_dataframe)
+        instrumentation.record("chunks", chunks)
+
+        with instrumentation.stage("compute"):
+            agg_by_county_output = calc_column_totals(
+                input_dataframe, to_aggregate, totals_dict, workers, engine, chunks)
+        instrumentation.record("groups", len(agg_by_county_output))
+        instrumentation.record_frame("output", agg_by_county_output)
 
         for total_column in total_columns:
             if "total" not in cell_total_column:
@@ -103,7 +182,9 @@ def lambda_handler(event, context):
 
         logger.info("Column totals successfully calculated.")
 
-        output_json = agg_by_county_output.to_json(orient="records")
+        with instrumentation.stage("encode"):
+            output_json = encode_frame(agg_by_county_output, json_layout)
+        instrumentation.record_bytes("bytes_out", output_json)
         final_output = {"data": output_json}
         logger.info("DataFrame converted to JSON for output.")
 
@@ -111,6 +192,7 @@ def lambda_handler(event, context):
         error_message = general_functions.handle_exception(e, current_module,
                                                            run_id, context)
     finally:
+        instrumentation.emit(logger)
         if (len(error_message)) > 0:
             logger.error(error_message)
             return {"success": False, "error": error_message}
@@ -118,3 +200,28 @@ def lambda_handler(event, context):
     logger.info("Successfully completed module.")
     final_output["success"] = True
     return final_output
+
+
+def calc_column_totals(data, to_aggregate, totals_dict, workers=1, engine=None,
+                       chunks=1):
+    """
+    :param data: Input Dataframe
+    :param to_aggregate: The columns to aggregate by. e.g. [Region, Strata].
+    :param totals_dict: The aggregation of each total column. e.g. {Q608_total: sum}.
+    :param workers: Number of worker processes to aggregate large inputs with.
+    :param engine: Compute engine to aggregate with, defaults to pandas.
+    :param chunks: Number of chunks to aggregate the data in, one after another.
+
+    :return: data: to_aggregate and the aggregated total columns of each group,
+                   in group order.
+    """
+    engine = engine or PandasEngine()
+
+    # Each partition holds whole groups, so can be aggregated independently.
+    county_agg = apply_partitioned(
+        lambda partition: engine.group_aggregate(partition, to_aggregate,
+                                                 totals_dict),
+        data, to_aggregate, workers, chunks)
+
+    # Categorical keys and partitions do not come back in sorted order.
+    return county_agg.sort_index().reset_index()
@@ -5,6 +5,29 @@ import os
 import boto3
 from es_aws_functions import aws_functions, exception_classes, general_functions
 from marshmallow import EXCLUDE, Schema, fields
+from marshmallow.validate import OneOf
+
+from batch import BATCH_COLUMN, read_batch, split_batch
+from capture import captured
+from dtype_policy import apply_dtype_policy
+from engines import ENGINES
+from incremental import find_changed_groups, in_groups, patch_groups
+from instrumentation import Instrumentation
+from json_layout import JSON_LAYOUTS, decode_frame, encode_frame
+from local_cache import LocalCache
+from profiling import profiled
+from result_cache import ResultCache
+from storage import STORAGE_BACKENDS, STORAGE_DIRECTORY, open_storage
+from tracing import Tracer
+from transfer import Transfer
+
+
+class BatchRunSchema(Schema):
+    class Meta:
+        unknown = EXCLUDE
+
+    in_file_name = fields.Str(required=True)
+    out_file_name = fields.Str(required=True)
 
 
 class EnvironmentSchema(Schema):
@@ -16,7 +39,17 @@ class EnvironmentSchema(Schema):
         raise ValueError(f"Error validating environment params: {e}")
 
     bucket_name = fields.Str(required=True)
+    cache_max_bytes = fields.Int(missing=0)
+    cache_prefix = fields.Str(missing="")
+    cache_ttl = fields.Int(missing=86400)
+    local_cache_max_bytes = fields.Int(missing=0)
     method_name = fields.Str(required=True)
+    storage_backend = fields.Str(missing="s3", validate=OneOf(STORAGE_BACKENDS))
+    storage_directory = fields.Str(missing=STORAGE_DIRECTORY)
+    transfer_concurrency = fields.Int(missing=10)
+    transfer_hedge_percentile = fields.Float(missing=0.0)
+    transfer_max_attempts = fields.Int(missing=0)
+    transfer_part_size = fields.Int(missing=0)
 
 
 class RuntimeSchema(Schema):
@@ -30,15 +63,35 @@ class RuntimeSchema(Schema):
     additional_aggregated_column = fields.Str(required=True)
     aggregated_column = fields.Str(required=True)
     aggregation_type = fields.Str(required=True)
+    batch_runs = fields.List(fields.Nested(BatchRunSchema), missing=[])
+    bypass_cache = fields.Bool(missing=False)
     cell_total_column = fields.Str(required=True)
+    column_types = fields.Dict(keys=fields.Str(), values=fields.Str(), missing={})
+    engine = fields.Str(missing="pandas", validate=OneOf(ENGINES))
     environment = fields.Str(Required=True)
     in_file_name = fields.Str(required=True)
+    instrumentation_enabled = fields.Bool(missing=False)
+    json_layout = fields.Str(missing="records", validate=OneOf(JSON_LAYOUTS))
+    memory_fraction = fields.Float(missing=0.0)
+    memory_instrumentation_enabled = fields.Bool(missing=False)
+    optimise_dtypes = fields.Bool(missing=False)
+    parallel_enabled = fields.Bool(missing=False)
     out_file_name = fields.Str(required=True)
+    partition_column = fields.Str(missing="")
+    previous_in_file_name = fields.Str(missing="")
+    previous_out_file_name = fields.Str(missing="")
+    profiling_enabled = fields.Bool(missing=False)
     sns_topic_arn = fields.Str(required=True)
     survey = fields.Str(required=True)
     total_columns = fields.List(fields.String, required=True)
+    trace_context = fields.Dict(missing={})
+    tracemalloc_top = fields.Int(missing=0)
+    tracing_enabled = fields.Bool(missing=False)
+    unique_identifier = fields.List(fields.String, missing=[])
 
 
+@captured
+@profiled
 def lambda_handler(event, context):
     """
     This method is used to prepare data for the calculation of column totals.
@@ -50,6 +103,34 @@ def lambda_handler(event, context):
         total_columns - The names of the columns to produce aggregations for.
         cell_total_column - Name of column to rename each total_column.
                         Is concatenated to the front of the total_column name.
+        instrumentation_enabled - Optional. Emit per-stage timing metrics.
+        memory_instrumentation_enabled - Optional. Emit peak RSS and dataframe
+                        memory footprints.
+        tracemalloc_top - Optional. Number of top allocating lines to report.
+        trace_context - Optional. Trace and parent span ids from the caller.
+        tracing_enabled - Optional. Emit trace spans for each stage.
+        previous_in_file_name - Optional. Input of the previous run, enables
+                        incremental aggregation of changed groups only.
+        previous_out_file_name - Optional. Output of the previous run to patch.
+        unique_identifier - Columns identifying a contributor, needed when
+                        running incrementally.
+        bypass_cache - Optional. Invoke the method even when a cached result
+                        exists, then refresh the cache.
+        batch_runs - Optional. Further runs, each with an in_file_name and
+                        out_file_name, to aggregate in the same pass.
+        parallel_enabled - Optional. Have the method aggregate large inputs across
+                        all available CPUs.
+        engine - Optional. Compute engine the method runs its aggregation kernels
+                        on, pandas (default) or duckdb.
+        memory_fraction - Optional. Fraction of its memory limit the method's
+                        intermediates may use, calculating in chunks when needed.
+        partition_column - Optional. Read and write files as one file per value of
+                        this column, with a manifest.
+        json_layout - Optional. Layout of the JSON files written and sent to the
+                        method, records (default) or split.
+        capture_enabled - Optional. Record the invocation for replay.py.
+        profiling_enabled - Optional. Profile the invocation and the method's,
+                        see profiling.py.
     }}
 
     :param context: N/A
@@ -75,19 +156,48 @@ def lambda_handler(event, context):
 
         # Environment Variables
         bucket_name = environment_variables["bucket_name"]
+        cache_max_bytes = environment_variables["cache_max_bytes"]
+        cache_prefix = environment_variables["cache_prefix"]
+        cache_ttl = environment_variables["cache_ttl"]
+        local_cache_max_bytes = environment_variables["local_cache_max_bytes"]
         method_name = environment_variables["method_name"]
+        storage_backend = environment_variables["storage_backend"]
+        storage_directory = environment_variables["storage_directory"]
+        transfer_concurrency = environment_variables["transfer_concurrency"]
+        transfer_hedge_percentile = environment_variables["transfer_hedge_percentile"]
+        transfer_max_attempts = environment_variables["transfer_max_attempts"]
+        transfer_part_size = environment_variables["transfer_part_size"]
 
         # Runtime Variables
         additional_aggregated_column = runtime_variables["additional_aggregated_column"]
         aggregated_column = runtime_variables["aggregated_column"]
         aggregation_type = runtime_variables["aggregation_type"]
+        batch_runs = runtime_variables["batch_runs"]
+        bypass_cache = runtime_variables["bypass_cache"]
         cell_total_column = runtime_variables["cell_total_column"]
+        column_types = runtime_variables["column_types"]
+        engine = runtime_variables["engine"]
         environment = runtime_variables["environment"]
         in_file_name = runtime_variables["in_file_name"]
+        instrumentation_enabled = runtime_variables["instrumentation_enabled"]
+        json_layout = runtime_variables["json_layout"]
+        memory_fraction = runtime_variables["memory_fraction"]
+        memory_instrumentation_enabled = \
+            runtime_variables["memory_instrumentation_enabled"]
+        optimise_dtypes = runtime_variables["optimise_dtypes"]
+        parallel_enabled = runtime_variables["parallel_enabled"]
         out_file_name = runtime_variables["out_file_name"]
+        partition_column = runtime_variables["partition_column"]
+        previous_in_file_name = runtime_variables["previous_in_file_name"]
+        previous_out_file_name = runtime_variables["previous_out_file_name"]
+        profiling_enabled = runtime_variables["profiling_enabled"]
         sns_topic_arn = runtime_variables["sns_topic_arn"]
         survey = runtime_variables["survey"]
         total_columns = runtime_variables["total_columns"]
+        trace_context = runtime_variables["trace_context"]
+        tracemalloc_top = runtime_variables["tracemalloc_top"]
+        tracing_enabled = runtime_variables["tracing_enabled"]
+        unique_identifier = runtime_variables["unique_identifier"]
 
     except Exception as e:
         error_message = general_functions.handle_exception(e, current_module, run_id,
@@ -101,44 +211,174 @@ def lambda_handler(event, context):
                                                            run_id, context=context)
         raise exception_classes.LambdaFailure(error_message)
 
+    tracer = Tracer(run_id, current_module, trace_context, tracing_enabled)
+    instrumentation = Instrumentation(run_id, current_module, instrumentation_enabled,
+                                      memory_instrumentation_enabled, tracemalloc_top,
+                                      tracer)
+    transfer = Transfer(transfer_part_size, transfer_concurrency, json_layout,
+                        transfer_hedge_percentile, transfer_max_attempts)
+    local_cache = LocalCache(local_cache_max_bytes,
+                             read_dataframe=transfer.read_dataframe)
+    storage = open_storage(storage_backend, storage_directory, transfer, local_cache,
+                           partition_column, json_layout)
+    result_cache = ResultCache(bucket_name, cache_prefix, cache_ttl, cache_max_bytes,
+                               bypass_cache)
+
     try:
         logger.info("Started - retrieved configuration variables.")
-        # Read from S3 bucket
-        data = aws_functions.read_dataframe_from_s3(bucket_name, in_file_name)
-        logger.info("Started - retrieved data from s3")
-
-        formatted_data = data.to_json(orient="records")
-        logger.info("Formatted disaggregated_data")
-
-        json_payload = {
-            "RuntimeVariables": {
-                "additional_aggregated_column": additional_aggregated_column,
-                "aggregated_column": aggregated_column,
-                "aggregation_type": aggregation_type,
-                "cell_total_column": cell_total_column,
-                "data": formatted_data,
-                "environment": environment,
-                "run_id": run_id,
-                "survey": survey,
-                "total_columns": total_columns
-            }
-        }
-
-        by_column = lambda_client.invoke(FunctionName=method_name,
-                                         Payload=json.dumps(json_payload))
-
-        json_response = json.loads(by_column.get("Payload").read().decode("utf-8"))
-
-        logger.info("Successfully invoked the method lambda")
-
-        if not json_response["success"]:
-            raise exception_classes.MethodFailure(json_response["error"])
-
-        aws_functions.save_to_s3(bucket_name, out_file_name, json_response["data"])
+        # Batched runs are read together and aggregated in a single pass.
+        in_file_names = [in_file_name]
+        out_file_names = [out_file_name]
+        for batch_run in batch_runs:
+            in_file_names.append(batch_run["in_file_name"])
+            out_file_names.append(batch_run["out_file_name"])
+
+        instrumentation.record("runs", len(in_file_names))
+
+        # Incremental runs only re-aggregate groups whose contributors changed.
+        incremental_run = previous_in_file_name != "" and previous_out_file_name != ""
+        if incremental_run:
+            if not unique_identifier:
+                raise ValueError("Incremental aggregation requires unique_identifier.")
+            if batch_runs:
+                raise ValueError("Batch runs cannot be aggregated incrementally.")
+
+        if result_cache.enabled and storage_backend != "s3":
+            raise ValueError("The result cache keys on S3 ETags, so needs s3 storage.")
+        if result_cache.enabled and storage.partitioned:
+            raise ValueError("The result cache stores whole outputs, so cannot be "
+                             "used with partition_column.")
+
+        # Unchanged inputs give an unchanged output, so reuse a cached one. It is
+        # looked up by the inputs' ETags before they are read.
+        output_data = None
+        if result_cache.enabled and not batch_runs:
+            input_files = [in_file_name]
+            if incremental_run:
+                input_files += [previous_in_file_name, previous_out_file_name]
+            with instrumentation.stage("cache"):
+                cache_key = result_cache.key("column", runtime_variables,
+                                             result_cache.etags(input_files))
+                output_data = result_cache.get(cache_key)
+
+        if output_data is not None:
+            instrumentation.record("cache_hits", 1)
+            logger.info("Retrieved output from the result cache")
+        else:
+            # Read from S3 bucket
+            with instrumentation.stage("read"):
+                if batch_runs:
+                    data = read_batch(bucket_name, in_file_names, storage.read_dataframe)
+                else:
+                    data = storage.read_dataframe(bucket_name, in_file_name)
+            if optimise_dtypes:
+                with instrumentation.stage("decode"):
+                    data = apply_dtype_policy(
+                        data, column_types,
+                        [aggregated_column, additional_aggregated_column])
+            instrumentation.record("rows_in", len(data))
+            instrumentation.record_frame("input", data)
+            logger.info("Started - retrieved data from s3")
+
+            to_aggregate = [aggregated_column]
+            if additional_aggregated_column != "":
+                to_aggregate.append(additional_aggregated_column)
+
+            if incremental_run:
+                with instrumentation.stage("read"):
+                    previous_data = storage.read_dataframe(
+                        bucket_name, previous_in_file_name)
+                    previous_output = storage.read_dataframe(
+                        bucket_name, previous_out_file_name)
+                if optimise_dtypes:
+                    previous_data = apply_dtype_policy(
+                        previous_data, column_types,
+                        [aggregated_column, additional_aggregated_column])
+
+                with instrumentation.stage("compute"):
+                    changed_groups = find_changed_groups(
+                        data, previous_data, unique_identifier, to_aggregate)
+                    data = data[in_groups(data, changed_groups, to_aggregate)]
+                logger.info(f"Incremental run - {len(changed_groups)} groups changed.")
+
+            output_data = "[]"
+            if not incremental_run or len(data) > 0:
+                with instrumentation.stage("encode"):
+                    formatted_data = encode_frame(data, json_layout)
+                instrumentation.record_bytes("bytes_out", formatted_data)
+                logger.info("Formatted disaggregated_data")
+
+                json_payload = {
+                    "RuntimeVariables": {
+                        "additional_aggregated_column": additional_aggregated_column,
+                        "aggregated_column": aggregated_column,
+                        "aggregation_type": aggregation_type,
+                        "batch_column": BATCH_COLUMN if batch_runs else "",
+                        "cell_total_column": cell_total_column,
+                        "column_types": column_types,
+                        "data": formatted_data,
+                        "engine": engine,
+                        "environment": environment,
+                        "instrumentation_enabled": instrumentation_enabled,
+                        "json_layout": json_layout,
+                        "memory_fraction": memory_fraction,
+                        "memory_instrumentation_enabled": memory_instrumentation_enabled,
+                        "optimise_dtypes": optimise_dtypes,
+                        "parallel_enabled": parallel_enabled,
+                        "profiling_enabled": profiling_enabled,
+                        "run_id": run_id,
+                        "survey": survey,
+                        "total_columns": total_columns,
+                        "trace_context": tracer.child_context(),
+                        "tracemalloc_top": tracemalloc_top,
+                        "tracing_enabled": tracing_enabled
+                    }
+                }
+
+                with instrumentation.stage("invoke"):
+                    by_column = lambda_client.invoke(FunctionName=method_name,
+                                                     Payload=json.dumps(json_payload))
+
+                    json_response = json.loads(
+                        by_column.get("Payload").read().decode("utf-8"))
+
+                logger.info("Successfully invoked the method lambda")
+
+                if not json_response["success"]:
+                    raise exception_classes.MethodFailure(json_response["error"])
+
+                output_data = json_response["data"]
+
+            instrumentation.record_bytes("bytes_in", output_data)
+
+            if incremental_run:
+                with instrumentation.stage("compute"):
+                    patched_output = patch_groups(
+                        previous_output, decode_frame(output_data),
+                        changed_groups, to_aggregate)
+                with instrumentation.stage("encode"):
+                    output_data = storage.encode(patched_output)
+
+            if result_cache.enabled and not batch_runs:
+                with instrumentation.stage("cache"):
+                    result_cache.put(cache_key, output_data)
+
+        output_files = [(out_file_name, output_data)]
+        if batch_runs:
+            with instrumentation.stage("encode"):
+                outputs = split_batch(decode_frame(output_data),
+                                      len(out_file_names))
+                output_files = [(file_name, storage.encode(output))
+                                for file_name, output in zip(out_file_names, outputs)]
+
+        with instrumentation.stage("write"):
+            for file_name, file_data in output_files:
+                storage.save(bucket_name, file_name, file_data)
         logger.info("Successfully sent the data to S3")
 
-        aws_functions.send_sns_message(sns_topic_arn,
-                                       "Aggregation - " + aggregated_column + ".")
+        with instrumentation.stage("notify"):
+            aws_functions.send_sns_message(sns_topic_arn,
+                                           "Aggregation - " + aggregated_column + ".")
 
         logger.info("Successfully sent the SNS message")
 
@@ -146,6 +386,10 @@ def lambda_handler(event, context):
         error_message = general_functions.handle_exception(e, current_module,
                                                            run_id, context)
     finally:
+        if transfer.hedging:
+            instrumentation.record("hedged_reads", transfer.hedged_reads)
+            instrumentation.record("hedges_won", transfer.hedges_won)
+        instrumentation.emit(logger)
         if (len(error_message)) > 0:
             logger.error(error_message)
             raise exception_classes.LambdaFailure(error_message)
@@ -1,9 +1,19 @@
-import json
 import logging
 
 import pandas as pd
 from es_aws_functions import general_functions
 from marshmallow import EXCLUDE, Schema, fields
+from marshmallow.validate import OneOf
+
+from capture import captured
+from dtype_policy import apply_dtype_policy
+from engines import ENGINES, PandasEngine, get_engine
+from instrumentation import Instrumentation
+from json_layout import JSON_LAYOUTS, decode_frame, encode_frame
+from memory_governor import MemoryGovernor
+from parallel import apply_partitioned, available_workers
+from profiling import profiled
+from tracing import Tracer
 
 
 class RuntimeSchema(Schema):
@@ -16,15 +26,29 @@ class RuntimeSchema(Schema):
 
     additional_aggregated_column = fields.Str(required=True)
     aggregated_column = fields.Str(required=True)
+    batch_column = fields.Str(missing="")
     bpm_queue_url = fields.Str(required=True)
+    column_types = fields.Dict(keys=fields.Str(), values=fields.Str(), missing={})
     data = fields.Str(required=True)
+    engine = fields.Str(missing="pandas", validate=OneOf(ENGINES))
     environment = fields.Str(required=True)
+    instrumentation_enabled = fields.Bool(missing=False)
+    json_layout = fields.Str(missing="records", validate=OneOf(JSON_LAYOUTS))
+    memory_fraction = fields.Float(missing=0.0)
+    memory_instrumentation_enabled = fields.Bool(missing=False)
+    optimise_dtypes = fields.Bool(missing=False)
+    parallel_enabled = fields.Bool(missing=False)
     survey = fields.Str(required=True)
     top1_column = fields.Str(required=True)
     top2_column = fields.Str(required=True)
     total_columns = fields.List(fields.String, required=True)
+    trace_context = fields.Dict(missing={})
+    tracemalloc_top = fields.Int(missing=0)
+    tracing_enabled = fields.Bool(missing=False)
 
 
+@captured
+@profiled
 def lambda_handler(event, context):
     """
     This method loops through each county and records largest & second largest value
@@ -38,6 +62,24 @@ def lambda_handler(event, context):
         total_columns - The names of the columns to produce aggregations for.
         top1_column - The prefix for the largest_contibutor column
         top2_column - The prefix for the second_largest_contibutor column
+        instrumentation_enabled - Optional. Emit per-stage timing metrics.
+        memory_instrumentation_enabled - Optional. Emit peak RSS and dataframe
+                        memory footprints.
+        tracemalloc_top - Optional. Number of top allocating lines to report.
+        trace_context - Optional. Trace and parent span ids from the caller.
+        tracing_enabled - Optional. Emit trace spans for each stage.
+        batch_column - Optional. Column holding the run of each row when several
+                        runs are aggregated together.
+        parallel_enabled - Optional. Calculate large inputs across all available
+                        CPUs.
+        engine - Optional. Compute engine for the aggregation kernels, pandas
+                        (default) or duckdb.
+        memory_fraction - Optional. Fraction of the memory limit the calculation's
+                        intermediates may use, calculating in chunks when needed.
+        json_layout - Optional. Layout of the output JSON, records (default) or
+                        split. The input is read in either layout.
+        capture_enabled - Optional. Record the invocation for replay.py.
+        profiling_enabled - Optional. Profile the invocation, see profiling.py.
     }
     :param context: N/A
     :return: Success - {"success": True/False, "data"/"error": "JSON String"/"Message"}
@@ -58,13 +100,26 @@ def lambda_handler(event, context):
         # Runtime Variables
         additional_aggregated_column = runtime_variables["additional_aggregated_column"]
         aggregated_column = runtime_variables["aggregated_column"]
+        batch_column = runtime_variables["batch_column"]
         bpm_queue_url = runtime_variables["bpm_queue_url"]
-        data = json.loads(runtime_variables["data"])
+        column_types = runtime_variables["column_types"]
+        data = runtime_variables["data"]
+        engine_name = runtime_variables["engine"]
         environment = runtime_variables["environment"]
+        instrumentation_enabled = runtime_variables["instrumentation_enabled"]
+        json_layout = runtime_variables["json_layout"]
+        memory_fraction = runtime_variables["memory_fraction"]
+        memory_instrumentation_enabled = \
+            runtime_variables["memory_instrumentation_enabled"]
+        optimise_dtypes = runtime_variables["optimise_dtypes"]
+        parallel_enabled = runtime_variables["parallel_enabled"]
         survey = runtime_variables["survey"]
         top1_column = runtime_variables["top1_column"]
         top2_column = runtime_variables["top2_column"]
         total_columns = runtime_variables["total_columns"]
+        trace_context = runtime_variables["trace_context"]
+        tracemalloc_top = runtime_variables["tracemalloc_top"]
+        tracing_enabled = runtime_variables["tracing_enabled"]
 
     except Exception as e:
         error_message = general_functions.handle_exception(e, current_module, run_id,
@@ -79,32 +134,61 @@ def lambda_handler(event, context):
                                                            run_id, context=context)
         return {"success": False, "error": error_message}
 
+    tracer = Tracer(run_id, current_module, trace_context, tracing_enabled)
+    instrumentation = Instrumentation(run_id, current_module, instrumentation_enabled,
+                                      memory_instrumentation_enabled, tracemalloc_top,
+                                      tracer)
+    governor = MemoryGovernor(context, memory_fraction)
+
     try:
         logger.info("Started - retrieved configuration variables from wrangler.")
-        input_dataframe = pd.DataFrame(data)
+        instrumentation.record_bytes("bytes_in", data)
+        with instrumentation.stage("decode"):
+            input_dataframe = decode_frame(data)
+            if optimise_dtypes:
+                input_dataframe = apply_dtype_policy(
+                    input_dataframe, column_types,
+                    [aggregated_column, additional_aggregated_column])
+        instrumentation.record("rows_in", len(input_dataframe))
+        instrumentation.record_frame("input", input_dataframe)
         top_two_output = pd.DataFrame()
         logger.info("Invoking calc_top_two function on input dataframe")
         counter = 0
-        for total_column in total_columns:
-            response = calc_top_two(input_dataframe, total_column,
-                                    aggregated_column, additional_aggregated_column,
-                                    top1_column, top2_column)
-
-            response = response.drop_duplicates()
-            if counter == 0:
-                top_two_output = response
-            else:
-                to_aggregate = [aggregated_column]
-                if additional_aggregated_column != "":
-                    to_aggregate.append(additional_aggregated_column)
-
-                top_two_output = top_two_output.merge(response,
-                                                      on=to_aggregate, how="left")
-            counter += 1
+        # DuckDB already runs across all CPUs, and cannot be used in a forked worker.
+        engine = get_engine(engine_name)
+        workers = available_workers() if parallel_enabled and engine_name == "pandas" \
+            else 1
+        instrumentation.record("workers", workers)
+        chunks = governor.chunk_count(input_dataframe)
+        instrumentation.record("chunks", chunks)
+        with instrumentation.stage("compute"):
+            for total_column in total_columns:
+                response = calc_top_two(input_dataframe, total_column,
+                                        aggregated_column, additional_aggregated_column,
+                                        top1_column, top2_column, batch_column,
+                                        workers, engine, chunks)
+
+                response = response.drop_duplicates()
+                if counter == 0:
+                    top_two_output = response
+                else:
+                    to_aggregate = [aggregated_column]
+                    if additional_aggregated_column != "":
+                        to_aggregate.append(additional_aggregated_column)
+                    if batch_column != "":
+                        to_aggregate.insert(0, batch_column)
+
+                    top_two_output = engine.join(top_two_output, response,
+                                                 to_aggregate)
+                counter += 1
 
         response = top_two_output
+        instrumentation.record("groups", len(response))
+        instrumentation.record_frame("output", response)
         logger.info("Converting output dataframe to json")
-        response_json = response.to_json(orient="records")
+        with instrumentation.stage("encode"):
+            response_json = encode_frame(response, json_layout)
+        instrumentation.record_bytes("bytes_out", response_json)
         final_output = {"data": response_json}
     except Exception as e:
         error_message = general_functions.handle_exception(e,
@@ -113,6 +197,7 @@ def lambda_handler(event, context):
                                                            context=context,
                                                            bpm_queue_url=bpm_queue_url)
     finally:
+        instrumentation.emit(logger)
         if (len(error_message)) > 0:
             logger.error(error_message)
             return {"success": False, "error": error_message}
@@ -122,7 +207,8 @@ def lambda_handler(event, context):
 
 
 def calc_top_two(data, total_column, aggregated_column, additional_aggregated_column,
-                 top1_column, top2_column):
+                 top1_column, top2_column, batch_column="", workers=1, engine=None,
+                 chunks=1):
     """
     :param data: Input Dataframe
     :param total_column - The name of the column to produce aggregation for.
@@ -130,6 +216,10 @@ def calc_top_two(data, total_column, aggregated_column, additional_aggregated_co
     :param additional_aggregated_column: A column to aggregate by. e.g. Region.
     :param top1_column: top1_column - Prefix for the largest_contributor column.
     :param top2_column: top2_column - Prefix for the second_largest_contributor column.
+    :param batch_column: Optional column holding the run of each row in a batch.
+    :param workers: Number of worker processes to calculate large inputs with.
+    :param engine: Compute engine to calculate with, defaults to pandas.
+    :param chunks: Number of chunks to calculate the data in, one after another.
 
     :return: data: input dataframe with the addition of top2 calulations for total_column
     """
@@ -137,20 +227,24 @@ def calc_top_two(data, total_column, aggregated_column, additional_aggregated_co
     logger.info("Executing function: calc_top_two")
     top1_column = total_column + "_" + top1_column
     top2_column = total_column + "_" + top2_column
+    engine = engine or PandasEngine()
 
     to_aggregate = [aggregated_column]
     if additional_aggregated_column != "":
         to_aggregate.append(additional_aggregated_column)
+    if batch_column != "":
+        to_aggregate.insert(0, batch_column)
 
     # Group data on groupby columns and collect list of total column.
 
-    grouped_data = data.groupby(to_aggregate, as_index=False)\
-        .agg({total_column: col_to_list})
-
-    grouped_data = grouped_data.apply(
-        lambda x: do_top_two(x, total_column, top1_column, top2_column), axis=1)
+    # Each partition holds whole groups, so can be calculated independently.
+    grouped_data = apply_partitioned(
+        lambda partition: engine.group_top_two(partition, to_aggregate, total_column,
+                                               top1_column, top2_column),
+        data, to_aggregate, workers, chunks)
 
-    grouped_data = grouped_data.drop(total_column, axis=1)
+    # Categorical keys and partitions do not come back in sorted order.
+    grouped_data = grouped_data.sort_values(to_aggregate, ignore_index=True)
 
     logger.info("Returning the output data")
     filter_output = [
@@ -161,6 +255,8 @@ def calc_top_two(data, total_column, aggregated_column, additional_aggregated_co
 
     if additional_aggregated_column != "":
         filter_output.append(additional_aggregated_column)
+    if batch_column != "":
+        filter_output.append(batch_column)
 
     grouped_data = grouped_data[filter_output]
     logger.info("Successfully completed function: calc_top_two")
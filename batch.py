@@ -0,0 +1,48 @@
+import pandas as pd
+from es_aws_functions import aws_functions
+
+# Column tagging each row with the position of its run within a batch.
+BATCH_COLUMN = "batch_run"
+
+
+def read_batch(bucket_name, file_names, read_dataframe=None):
+    """
+    Reads the input of every run in a batch into one dataframe, tagging each row
+    with its run so that all runs can be aggregated in a single pass.
+
+    :param bucket_name: Name of the bucket holding the inputs. - String.
+    :param file_names: Input file of each run, in run order. - List.
+    :param read_dataframe: Reads one file, defaults to
+                           aws_functions.read_dataframe_from_s3. - Function.
+
+    :return: data: Inputs of all runs with a BATCH_COLUMN. - DataFrame.
+    """
+    read_dataframe = read_dataframe or aws_functions.read_dataframe_from_s3
+
+    frames = []
+    for batch_run, file_name in enumerate(file_names):
+        frame = read_dataframe(bucket_name, file_name)
+        frame.insert(0, BATCH_COLUMN, batch_run)
+        frames.append(frame)
+
+    return pd.concat(frames, ignore_index=True)
+
+
+def split_batch(data, run_count):
+    """
+    Splits a batched output back into one output per run, keeping row order and
+    dropping the BATCH_COLUMN.
+
+    :param data: Output of all runs with a BATCH_COLUMN. - DataFrame.
+    :param run_count: Number of runs in the batch. - Int.
+
+    :return: outputs: Output of each run, in run order. - List.
+    """
+    if BATCH_COLUMN not in data.columns:
+        return [data.copy() for _ in range(run_count)]
+
+    runs = dict(tuple(data.groupby(BATCH_COLUMN, sort=False)))
+    empty = data.iloc[0:0]
+
+    return [runs.get(batch_run, empty).drop(BATCH_COLUMN, axis=1)
+            .reset_index(drop=True) for batch_run in range(run_count)]
@@ -0,0 +1,297 @@
+import functools
+import hashlib
+import json
+import logging
+import os
+import time
+import uuid
+
+import pandas as pd
+
+from json_layout import decode_frame, encode_frame
+from profiling import write_object
+from result_cache import object_key
+from storage import STORAGE_DIRECTORY, open_storage
+
+# Where captures are written when capture_location is not set.
+CAPTURE_LOCATION = "/tmp/captures"
+
+# Column identifying a contributor, when capture_key_column is not set.
+CAPTURE_KEY_COLUMN = "enterprise_reference"
+
+# Runtime variables naming the files a handler reads.
+INPUT_PARAMETERS = ["in_file_name", "previous_in_file_name", "previous_out_file_name"]
+
+# Sampled rows are chosen by hashing into this many buckets.
+SAMPLE_BUCKETS = 1000000
+
+
+def capture_settings(event):
+    """
+    Whether and how to capture an invocation. Capture is enabled by the
+    capture_enabled runtime variable, or for every invocation by the
+    capture_enabled environment variable. The capture_location,
+    capture_sample_fraction, capture_key_column, capture_anonymise,
+    capture_anonymise_columns and capture_salt environment variables configure
+    it. Only the key column and those listed are anonymised, so the columns a
+    handler groups by, such as region and brick_type, are kept as they are.
+
+    :param event: Event the handler was invoked with. - Dict.
+    :return: Settings, or None when not capturing. - Dict.
+    """
+    runtime_variables = event.get("RuntimeVariables", {}) \
+        if isinstance(event, dict) else {}
+    enabled = runtime_variables.get("capture_enabled") is True or \
+        os.environ.get("capture_enabled", "").lower() == "true"
+    if not enabled:
+        return None
+
+    key_column = os.environ.get("capture_key_column", CAPTURE_KEY_COLUMN)
+    anonymise_columns = []
+    if os.environ.get("capture_anonymise", "").lower() == "true":
+        anonymise_columns = list(dict.fromkeys(
+            [key_column] + [column for column in
+                            os.environ.get("capture_anonymise_columns", "").split(",")
+                            if column]))
+
+    return {
+        "anonymise_columns": anonymise_columns,
+        "key_column": key_column,
+        "location": os.environ.get("capture_location", CAPTURE_LOCATION),
+        "salt": os.environ.get("capture_salt", ""),
+        "sample_fraction": float(os.environ.get("capture_sample_fraction", 0.0))
+    }
+
+
+def captured_environment():
+    """
+    The environment variables configuring the handlers. These are the lower case
+    ones, as those set by Lambda itself are upper case. Those configuring
+    capture and profiling are left out.
+
+    :return: environment: Environment variables. - Dict.
+    """
+    return {key: value for key, value in os.environ.items()
+            if key == key.lower() and not key.startswith(("capture_", "profil"))}
+
+
+def input_files(runtime_variables):
+    """
+    :param runtime_variables: Runtime variables of the invocation. - Dict.
+    :return: Names of the files the invocation reads. - List.
+    """
+    file_names = [runtime_variables.get(parameter, "")
+                  for parameter in INPUT_PARAMETERS]
+    file_names += [batch_run["in_file_name"]
+                   for batch_run in runtime_variables.get("batch_runs", [])]
+    file_names += list(runtime_variables.get("aggregation_files", {}).values())
+
+    return list(dict.fromkeys(file_name for file_name in file_names if file_name))
+
+
+def read_inputs(runtime_variables):
+    """
+    Reads the inputs of an invocation. A method's input is the data in its
+    payload. Any other handler's inputs are read from the storage backend its
+    environment configures.
+
+    :param runtime_variables: Runtime variables of the invocation. - Dict.
+    :return: inputs: Data and size in bytes of each input, keyed on the file
+                     name, or data for a method. - Dict.
+    """
+    if "data" in runtime_variables:
+        content = runtime_variables["data"]
+        return {"data": (decode_frame(content), len(content.encode("utf-8")))}
+
+    storage = open_storage(os.environ.get("storage_backend", "s3"),
+                           os.environ.get("storage_directory", STORAGE_DIRECTORY),
+                           partition_column=runtime_variables.get("partition_column",
+                                                                  ""))
+    bucket_name = os.environ.get("bucket_name", "")
+    inputs = {}
+    for file_name in input_files(runtime_variables):
+        data = storage.read_dataframe(bucket_name, file_name)
+        try:
+            size = storage.size(bucket_name, file_name)
+        except Exception:
+            size = None
+        inputs[file_name] = (data, size)
+
+    return inputs
+
+
+def fingerprint(data, size=None):
+    """
+    Describes an input without copying it: its shape, the type and number of
+    distinct values of each column, and a digest that changes with any value.
+
+    :param data: Input to describe. - DataFrame.
+    :param size: Size of the input in bytes. - Int.
+    :return: fingerprint: Fingerprint of the input. - Dict.
+    """
+    digest = hashlib.sha256(
+        pd.util.hash_pandas_object(data, index=False).values.tobytes()).hexdigest()
+
+    return {
+        "bytes": size,
+        "columns": {column: {"distinct": int(data[column].nunique(dropna=False)),
+                             "dtype": str(data[column].dtype)}
+                    for column in data.columns},
+        "digest": digest,
+        "rows": len(data)
+    }
+
+
+def sample_frame(data, fraction, key_column=""):
+    """
+    Samples whole contributors, by hashing key_column, so every file of a run
+    keeps the same contributors and a contributor keeps all of its rows. Files
+    without key_column, such as aggregation outputs, are small and kept whole.
+    Without a key_column, rows are sampled at random with a fixed seed.
+
+    :param data: Data to sample. - DataFrame.
+    :param fraction: Fraction of contributors or rows to keep. - Float.
+    :param key_column: Column identifying a contributor. - String.
+    :return: sampled: The sample, in the original order. - DataFrame.
+    """
+    if fraction >= 1:
+        return data
+    if not key_column:
+        return data.sample(frac=fraction, random_state=0).sort_index()
+    if key_column not in data.columns:
+        return data
+
+    buckets = pd.util.hash_pandas_object(data[key_column], index=False).values \
+        % SAMPLE_BUCKETS
+
+    return data[buckets < fraction * SAMPLE_BUCKETS]
+
+
+def anonymise_frame(data, columns, salt=""):
+    """
+    Replaces the values of columns with a keyed hash of them. Equal values stay
+    equal, in every file hashed with the same salt, so the groups and joins of a
+    run are kept, while the original values cannot be read back. Integer columns
+    stay integers and missing values stay missing.
+
+    :param data: Data to anonymise. - DataFrame.
+    :param columns: Columns to anonymise, those missing from data are ignored.
+                    - List.
+    :param salt: Secret mixed into the hash. - String.
+    :return: anonymised: A copy of data with the columns anonymised. - DataFrame.
+    """
+    hash_key = hashlib.sha256(salt.encode("utf-8")).hexdigest()[:16]
+    data = data.copy()
+    for column in columns:
+        if column not in data.columns:
+            continue
+        hashed = pd.util.hash_pandas_object(data[column], index=False,
+                                            hash_key=hash_key).values
+        if pd.api.types.is_integer_dtype(data[column]):
+            data[column] = (hashed >> 1).astype("int64")
+        else:
+            missing = data[column].isna()
+            data[column] = pd.Series([format(value, "016x") for value in hashed],
+                                     index=data.index).where(~missing)
+
+    return data
+
+
+def write_capture(name, module, event, context, inputs, settings, seconds, success):
+    """
+    Writes the record of an invocation to name/capture.json, and the copies of
+    its inputs under name/inputs when a sample_fraction is set.
+
+    :param name: S3 URL or local directory to write the capture to. - String.
+    :param module: Module of the captured handler. - String.
+    :param event: Event the handler was invoked with. - Dict.
+    :param context: Context the handler was invoked with. - Context.
+    :param inputs: Data and size of each input, from read_inputs. - Dict.
+    :param settings: Settings from capture_settings. - Dict.
+    :param seconds: Time the handler took. - Float.
+    :param success: Whether the handler succeeded. - Bool.
+    :return: None
+    """
+    runtime_variables = dict(event["RuntimeVariables"])
+    captured_inputs = {}
+    for input_name, (data, size) in inputs.items():
+        captured_input = {"copy": None, "copy_rows": 0,
+                          "fingerprint": fingerprint(data, size)}
+        if settings["sample_fraction"] > 0:
+            data = sample_frame(data, settings["sample_fraction"],
+                                settings["key_column"])
+            data = anonymise_frame(data, settings["anonymise_columns"],
+                                   settings["salt"])
+            copy = "inputs/" + object_key(input_name)
+            write_object(f"{name}/{copy}", encode_frame(data).encode("utf-8"))
+            captured_input.update({"copy": copy, "copy_rows": len(data)})
+        captured_inputs[input_name] = captured_input
+
+    # A method's input is copied, or not, with the others.
+    runtime_variables.pop("data", None)
+    record = {
+        "environment": captured_environment(),
+        "inputs": captured_inputs,
+        "memory_limit_in_mb": int(getattr(context, "memory_limit_in_mb", 0) or 0),
+        "module": module,
+        "run_id": runtime_variables.get("run_id", 0),
+        "runtime_variables": runtime_variables,
+        "seconds": seconds,
+        "success": success
+    }
+    write_object(f"{name}/capture.json",
+                 json.dumps(record, indent=4, default=str).encode("utf-8"))
+
+
+def captured(handler):
+    """
+    Wraps a lambda_handler so its invocations can be recorded and replayed
+    locally with replay.py. A capture holds the runtime variables, the
+    environment variables configuring the handler, the time it took and a
+    fingerprint of every input. With a capture_sample_fraction, a sample of each
+    input is copied as well, with identifiers anonymised when capture_anonymise
+    is set.
+
+    Captures are written to capture_location, an S3 prefix or a local directory,
+    as <module>/<run_id>-<time>-<suffix>/capture.json. Inputs are read before the
+    handler runs, so the handler's timings do not include capturing. A capture
+    that fails is logged without failing the invocation.
+    When not capturing, the handler is called directly.
+
+    :param handler: lambda_handler to wrap. - Function.
+    :return: Wrapped handler. - Function.
+    """
+    module = handler.__module__
+
+    @functools.wraps(handler)
+    def wrapper(event, context):
+        settings = capture_settings(event)
+        if settings is None:
+            return handler(event, context)
+
+        try:
+            inputs = read_inputs(event["RuntimeVariables"])
+        except Exception as e:
+            logging.getLogger().warning(f"Not capturing, could not read inputs: {e}")
+            return handler(event, context)
+
+        success = False
+        start = time.perf_counter()
+        try:
+            response = handler(event, context)
+            success = isinstance(response, dict) and response.get("success") is True
+            return response
+        finally:
+            seconds = time.perf_counter() - start
+            run_id = event["RuntimeVariables"].get("run_id", 0)
+            name = "/".join([
+                settings["location"].rstrip("/"), module,
+                f"{run_id}-{time.strftime('%Y%m%dT%H%M%S')}-{uuid.uuid4().hex[:8]}"])
+            try:
+                write_capture(name, module, event, context, inputs, settings, seconds,
+                              success)
+                logging.getLogger().info(f"Wrote capture to {name}")
+            except Exception as e:
+                logging.getLogger().warning(f"Could not write capture: {e}")
+
+    return wrapper
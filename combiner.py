@@ -1,9 +1,35 @@
 import logging
 import os
 
-import pandas as pd
 from es_aws_functions import aws_functions, exception_classes, general_functions
 from marshmallow import EXCLUDE, Schema, fields
+from marshmallow.validate import OneOf
+
+from batch import BATCH_COLUMN, read_batch, split_batch
+from capture import captured
+from dtype_policy import apply_dtype_policy
+from engines import ENGINES, get_engine
+from factorised import aggregates_file_name, factorise
+from incremental import find_changed_groups, in_groups, patch_rows
+from instrumentation import Instrumentation
+from json_layout import JSON_LAYOUTS
+from local_cache import LocalCache
+from memory_governor import MemoryGovernor
+from parallel import apply_chunked
+from profiling import profiled
+from result_cache import ResultCache
+from storage import STORAGE_BACKENDS, STORAGE_DIRECTORY, open_storage
+from tracing import Tracer
+from transfer import Transfer
+
+
+class BatchRunSchema(Schema):
+    class Meta:
+        unknown = EXCLUDE
+
+    aggregation_files = fields.Dict(required=True)
+    in_file_name = fields.Str(required=True)
+    out_file_name = fields.Str(required=True)
 
 
 class EnvironmentSchema(Schema):
@@ -15,7 +41,17 @@ class EnvironmentSchema(Schema):
         raise ValueError(f"Error validating environment params: {e}")
 
     bucket_name = fields.Str(required=True)
+    cache_max_bytes = fields.Int(missing=0)
+    cache_prefix = fields.Str(missing="")
+    cache_ttl = fields.Int(missing=86400)
+    local_cache_max_bytes = fields.Int(missing=0)
     run_environment = fields.Str(required=True)
+    storage_backend = fields.Str(missing="s3", validate=OneOf(STORAGE_BACKENDS))
+    storage_directory = fields.Str(missing=STORAGE_DIRECTORY)
+    transfer_concurrency = fields.Int(missing=10)
+    transfer_hedge_percentile = fields.Float(missing=0.0)
+    transfer_max_attempts = fields.Int(missing=0)
+    transfer_part_size = fields.Int(missing=0)
 
 
 class RuntimeSchema(Schema):
@@ -29,15 +65,34 @@ class RuntimeSchema(Schema):
     additional_aggregated_column = fields.Str(required=True)
     aggregated_column = fields.Str(required=True)
     aggregation_files = fields.Dict(required=True)
+    batch_runs = fields.List(fields.Nested(BatchRunSchema), missing=[])
     bpm_queue_url = fields.Str(required=True)
+    bypass_cache = fields.Bool(missing=False)
+    column_types = fields.Dict(keys=fields.Str(), values=fields.Str(), missing={})
+    engine = fields.Str(missing="pandas", validate=OneOf(ENGINES))
     environment = fields.Str(required=True)
+    factorised_output = fields.Bool(missing=False)
     in_file_name = fields.Str(required=True)
+    instrumentation_enabled = fields.Bool(missing=False)
+    json_layout = fields.Str(missing="records", validate=OneOf(JSON_LAYOUTS))
+    memory_fraction = fields.Float(missing=0.0)
+    memory_instrumentation_enabled = fields.Bool(missing=False)
+    optimise_dtypes = fields.Bool(missing=False)
     out_file_name = fields.Str(required=True)
+    partition_column = fields.Str(missing="")
+    previous_in_file_name = fields.Str(missing="")
+    previous_out_file_name = fields.Str(missing="")
     sns_topic_arn = fields.Str(required=True)
     survey = fields.Str(required=True)
     total_steps = fields.Int(required=True)
+    trace_context = fields.Dict(missing={})
+    tracemalloc_top = fields.Int(missing=0)
+    tracing_enabled = fields.Bool(missing=False)
+    unique_identifier = fields.List(fields.String, missing=[])
 
 
+@captured
+@profiled
 def lambda_handler(event, context):
     """
     This method takes the new columns and adds them all onto the main dataset.
@@ -45,6 +100,36 @@ def lambda_handler(event, context):
     :param event: { "RuntimeVariables": {
         aggregated_column - A column to aggregate by. e.g. Enterprise_Reference.
         additional_aggregated_column - A column to aggregate by. e.g. Region.
+        instrumentation_enabled - Optional. Emit per-stage timing metrics.
+        memory_instrumentation_enabled - Optional. Emit peak RSS and dataframe
+                        memory footprints.
+        tracemalloc_top - Optional. Number of top allocating lines to report.
+        trace_context - Optional. Trace and parent span ids from the caller.
+        tracing_enabled - Optional. Emit trace spans for each stage.
+        previous_in_file_name - Optional. Input of the previous run, enables
+                        incremental recombination of changed groups only.
+        previous_out_file_name - Optional. Output of the previous run to patch.
+        unique_identifier - Columns identifying a contributor, needed when
+                        running incrementally.
+        bypass_cache - Optional. Recombine even when a cached output exists, then
+                        refresh the cache.
+        batch_runs - Optional. Further runs, each with an in_file_name,
+                        out_file_name and aggregation_files, to combine in the same
+                        pass. Batches are not cached.
+        engine - Optional. Compute engine for the joins, pandas (default) or
+                        duckdb.
+        memory_fraction - Optional. Fraction of the memory limit the joins'
+                        intermediates may use, joining in chunks when needed.
+        partition_column - Optional. Read and write files as one file per value of
+                        this column, with a manifest, joining partition by
+                        partition when it is one of the aggregation columns.
+        json_layout - Optional. Layout of the JSON files written, records (default)
+                        or split.
+        factorised_output - Optional. Write the data with a group_id column, and
+                        each group's aggregates once in <out_file_name>_aggregates,
+                        see factorised.py.
+        capture_enabled - Optional. Record the invocation for replay.py.
+        profiling_enabled - Optional. Profile the invocation, see profiling.py.
     }}
     :param context:
     :return:
@@ -68,19 +153,47 @@ def lambda_handler(event, context):
 
         # Environment Variables
         bucket_name = environment_variables["bucket_name"]
+        cache_max_bytes = environment_variables["cache_max_bytes"]
+        cache_prefix = environment_variables["cache_prefix"]
+        cache_ttl = environment_variables["cache_ttl"]
+        local_cache_max_bytes = environment_variables["local_cache_max_bytes"]
         run_environment = environment_variables["run_environment"]
+        storage_backend = environment_variables["storage_backend"]
+        storage_directory = environment_variables["storage_directory"]
+        transfer_concurrency = environment_variables["transfer_concurrency"]
+        transfer_hedge_percentile = environment_variables["transfer_hedge_percentile"]
+        transfer_max_attempts = environment_variables["transfer_max_attempts"]
+        transfer_part_size = environment_variables["transfer_part_size"]
 
         # Runtime Variables
         additional_aggregated_column = runtime_variables["additional_aggregated_column"]
         aggregated_column = runtime_variables["aggregated_column"]
         aggregation_files = runtime_variables["aggregation_files"]
+        batch_runs = runtime_variables["batch_runs"]
         bpm_queue_url = runtime_variables["bpm_queue_url"]
+        bypass_cache = runtime_variables["bypass_cache"]
+        column_types = runtime_variables["column_types"]
+        engine_name = runtime_variables["engine"]
         environment = runtime_variables["environment"]
+        factorised_output = runtime_variables["factorised_output"]
         in_file_name = runtime_variables["in_file_name"]
+        instrumentation_enabled = runtime_variables["instrumentation_enabled"]
+        json_layout = runtime_variables["json_layout"]
+        memory_fraction = runtime_variables["memory_fraction"]
+        memory_instrumentation_enabled = \
+            runtime_variables["memory_instrumentation_enabled"]
+        optimise_dtypes = runtime_variables["optimise_dtypes"]
         out_file_name = runtime_variables["out_file_name"]
+        partition_column = runtime_variables["partition_column"]
+        previous_in_file_name = runtime_variables["previous_in_file_name"]
+        previous_out_file_name = runtime_variables["previous_out_file_name"]
         sns_topic_arn = runtime_variables["sns_topic_arn"]
         survey = runtime_variables["survey"]
         total_steps = runtime_variables["total_steps"]
+        trace_context = runtime_variables["trace_context"]
+        tracemalloc_top = runtime_variables["tracemalloc_top"]
+        tracing_enabled = runtime_variables["tracing_enabled"]
+        unique_identifier = runtime_variables["unique_identifier"]
 
     except Exception as e:
         error_message = general_functions.handle_exception(e, current_module, run_id,
@@ -94,54 +207,232 @@ def lambda_handler(event, context):
                                                            run_id, context=context)
         raise exception_classes.LambdaFailure(error_message)
 
+    tracer = Tracer(run_id, current_module, trace_context, tracing_enabled)
+    instrumentation = Instrumentation(run_id, current_module, instrumentation_enabled,
+                                      memory_instrumentation_enabled, tracemalloc_top,
+                                      tracer)
+    transfer = Transfer(transfer_part_size, transfer_concurrency, json_layout,
+                        transfer_hedge_percentile, transfer_max_attempts)
+    local_cache = LocalCache(local_cache_max_bytes,
+                             read_dataframe=transfer.read_dataframe)
+    storage = open_storage(storage_backend, storage_directory, transfer, local_cache,
+                           partition_column, json_layout)
+    governor = MemoryGovernor(context, memory_fraction)
+    result_cache = ResultCache(bucket_name, cache_prefix, cache_ttl, cache_max_bytes,
+                               bypass_cache)
+
     try:
         logger.info("Started - Retrieved configuration variables.")
-        # Get file from s3
-        imp_df = aws_functions.read_dataframe_from_s3(bucket_name, in_file_name)
-
-        logger.info("Retrieved data from s3")
 
         # Receive the 3 aggregation outputs.
         ent_ref_agg = aggregation_files["ent_ref_agg"]
         cell_agg = aggregation_files["cell_agg"]
         top2_agg = aggregation_files["top2_agg"]
 
-        # Load file content.
-        ent_ref_agg_df = aws_functions.read_dataframe_from_s3(bucket_name, ent_ref_agg)
-        cell_agg_df = aws_functions.read_dataframe_from_s3(bucket_name, cell_agg)
-        top2_agg_df = aws_functions.read_dataframe_from_s3(bucket_name, top2_agg)
-        logger.info("Successfully retrievied aggragation data from s3")
+        # Batched runs are read together and combined in a single pass.
+        in_file_names = [in_file_name]
+        out_file_names = [out_file_name]
+        aggregation_file_sets = [aggregation_files]
+        for batch_run in batch_runs:
+            in_file_names.append(batch_run["in_file_name"])
+            out_file_names.append(batch_run["out_file_name"])
+            aggregation_file_sets.append(batch_run["aggregation_files"])
+        instrumentation.record("runs", len(in_file_names))
+
+        incremental_run = previous_in_file_name != "" and previous_out_file_name != ""
+        if incremental_run and not unique_identifier:
+            raise ValueError("Incremental aggregation requires unique_identifier.")
+        if incremental_run and batch_runs:
+            raise ValueError("Batch runs cannot be aggregated incrementally.")
+        if result_cache.enabled and storage_backend != "s3":
+            raise ValueError("The result cache keys on S3 ETags, so needs s3 storage.")
+        if factorised_output and (batch_runs or incremental_run):
+            raise ValueError("Factorised output cannot be used with batch or "
+                             "incremental runs.")
+        if factorised_output and result_cache.enabled:
+            raise ValueError("The result cache stores a single output, so cannot be "
+                             "used with factorised_output.")
+        if result_cache.enabled and storage.partitioned:
+            raise ValueError("The result cache stores whole outputs, so cannot be "
+                             "used with partition_column.")
+
+        # Unchanged inputs give an unchanged output, so reuse a cached one.
+        final_output = None
+        if result_cache.enabled and not batch_runs:
+            input_files = [in_file_name, ent_ref_agg, cell_agg, top2_agg]
+            if incremental_run:
+                input_files += [previous_in_file_name, previous_out_file_name]
+            with instrumentation.stage("cache"):
+                cache_key = result_cache.key("combiner", runtime_variables,
+                                             result_cache.etags(input_files))
+                final_output = result_cache.get(cache_key)
 
         to_aggregate = [aggregated_column]
         if additional_aggregated_column != "":
             to_aggregate.append(additional_aggregated_column)
-
-        # merge the imputation output from s3 with the 3 aggregation outputs
-        first_merge = pd.merge(
-            imp_df, ent_ref_agg_df, on=to_aggregate, how="left")
-
-        second_merge = pd.merge(
-            first_merge, cell_agg_df, on=to_aggregate, how="left")
-
-        third_merge = pd.merge(
-            second_merge, top2_agg_df, on=to_aggregate, how="left")
-
-        logger.info("Successfully merged dataframes")
-
-        # convert output to json ready to return
-        final_output = third_merge.to_json(orient="records")
+        if batch_runs:
+            to_aggregate.insert(0, BATCH_COLUMN)
+        key_columns = [aggregated_column, additional_aggregated_column]
+
+        if final_output is not None:
+            instrumentation.record("cache_hits", 1)
+            output_files = [(out_file_name, final_output)]
+            logger.info("Retrieved combined output from the result cache")
+        elif storage.partitioned and partition_column in to_aggregate \
+                and not batch_runs and not incremental_run and not factorised_output:
+            # Each partition holds whole groups, so is joined on its own and written
+            # straight to its output partition, several partitions at a time.
+            def join_partition(data, aggregations):
+                frames = [data] + aggregations
+                if optimise_dtypes:
+                    frames = [apply_dtype_policy(frame, column_types, key_columns)
+                              for frame in frames]
+                # DuckDB connections cannot be shared between threads.
+                return join_aggregations(frames[0], frames[1:], to_aggregate,
+                                         get_engine(engine_name))
+
+            with instrumentation.stage("compute"):
+                manifest = storage.map_partitions(
+                    bucket_name, in_file_name, [ent_ref_agg, cell_agg, top2_agg],
+                    out_file_name, join_partition, to_aggregate)
+            instrumentation.record("partitions", len(manifest))
+            instrumentation.record("rows_in", int(manifest["rows"].sum()))
+            output_files = []
+            logger.info("Successfully merged partitions")
+        else:
+            read_files = in_file_names + [files[name]
+                                          for files in aggregation_file_sets
+                                          for name in ["ent_ref_agg", "cell_agg",
+                                                       "top2_agg"]]
+            if incremental_run:
+                read_files += [previous_in_file_name, previous_out_file_name]
+            governor.check_read(storage, bucket_name, read_files)
+
+            # Get file from s3
+            with instrumentation.stage("read"):
+                if batch_runs:
+                    imp_df = read_batch(bucket_name, in_file_names,
+                                        storage.read_dataframe)
+                else:
+                    imp_df = storage.read_dataframe(bucket_name, in_file_name)
+            instrumentation.record("rows_in", len(imp_df))
+            instrumentation.record_frame("input", imp_df)
+
+            logger.info("Retrieved data from s3")
+
+            # Load file content.
+            with instrumentation.stage("read"):
+                if batch_runs:
+                    ent_ref_agg_df = read_batch(bucket_name, [
+                        files["ent_ref_agg"] for files in aggregation_file_sets],
+                        storage.read_dataframe)
+                    cell_agg_df = read_batch(bucket_name, [
+                        files["cell_agg"] for files in aggregation_file_sets],
+                        storage.read_dataframe)
+                    top2_agg_df = read_batch(bucket_name, [
+                        files["top2_agg"] for files in aggregation_file_sets],
+                        storage.read_dataframe)
+                else:
+                    ent_ref_agg_df = storage.read_dataframe(bucket_name, ent_ref_agg)
+                    cell_agg_df = storage.read_dataframe(bucket_name, cell_agg)
+                    top2_agg_df = storage.read_dataframe(bucket_name, top2_agg)
+            instrumentation.record("groups", len(ent_ref_agg_df))
+            logger.info("Successfully retrievied aggragation data from s3")
+
+            if optimise_dtypes:
+                with instrumentation.stage("decode"):
+                    imp_df = apply_dtype_policy(imp_df, column_types, key_columns)
+                    ent_ref_agg_df = apply_dtype_policy(ent_ref_agg_df, column_types,
+                                                        key_columns)
+                    cell_agg_df = apply_dtype_policy(cell_agg_df, column_types,
+                                                     key_columns)
+                    top2_agg_df = apply_dtype_policy(top2_agg_df, column_types,
+                                                     key_columns)
+
+            engine = get_engine(engine_name)
+
+            # Incremental runs only recombine rows in groups whose contributors changed.
+            merge_df = imp_df
+            if incremental_run:
+                with instrumentation.stage("read"):
+                    previous_imp_df = storage.read_dataframe(
+                        bucket_name, previous_in_file_name)
+                    previous_output = storage.read_dataframe(
+                        bucket_name, previous_out_file_name)
+                if optimise_dtypes:
+                    previous_imp_df = apply_dtype_policy(previous_imp_df, column_types,
+                                                         key_columns)
+
+                with instrumentation.stage("compute"):
+                    changed_groups = find_changed_groups(
+                        imp_df, previous_imp_df, unique_identifier, to_aggregate)
+                    merge_df = imp_df[in_groups(imp_df, changed_groups, to_aggregate)]
+                logger.info(f"Incremental run - {len(changed_groups)} groups changed.")
+
+            # merge the imputation output from s3 with the 3 aggregation outputs
+            if factorised_output:
+                # Each group's aggregates are written once, rather than on its rows.
+                with instrumentation.stage("compute"):
+                    factorised = factorise(
+                        merge_df, [ent_ref_agg_df, cell_agg_df, top2_agg_df],
+                        to_aggregate, engine)
+                instrumentation.record("groups_out", len(factorised.aggregates))
+                instrumentation.record_frame("output", factorised.data)
+                logger.info("Successfully factorised dataframes")
+
+                with instrumentation.stage("encode"):
+                    output_files = [
+                        (out_file_name, storage.encode(factorised.data)),
+                        (aggregates_file_name(out_file_name),
+                         storage.encode(factorised.aggregates))]
+            else:
+                chunks = governor.chunk_count(merge_df)
+                instrumentation.record("chunks", chunks)
+                with instrumentation.stage("compute"):
+                    third_merge = apply_chunked(
+                        lambda chunk: join_aggregations(
+                            chunk, [ent_ref_agg_df, cell_agg_df, top2_agg_df],
+                            to_aggregate, engine),
+                        merge_df, chunks=chunks).reset_index(drop=True)
+
+                    if incremental_run:
+                        third_merge = patch_rows(previous_output, third_merge,
+                                                 changed_groups, to_aggregate, imp_df,
+                                                 unique_identifier)
+
+                instrumentation.record_frame("output", third_merge)
+                logger.info("Successfully merged dataframes")
+
+                # convert output to json ready to return
+                with instrumentation.stage("encode"):
+                    outputs = [third_merge]
+                    if batch_runs:
+                        outputs = split_batch(third_merge, len(out_file_names))
+                    output_files = [(file_name, storage.encode(output))
+                                    for file_name, output in zip(out_file_names,
+                                                                 outputs)]
+            for _, final_output in output_files:
+                instrumentation.record_bytes("bytes_out", final_output)
+
+            if result_cache.enabled and not batch_runs:
+                with instrumentation.stage("cache"):
+                    result_cache.put(cache_key, final_output)
 
         # send output onwards
-        aws_functions.save_to_s3(bucket_name, out_file_name, final_output)
+        with instrumentation.stage("write"):
+            for file_name, file_data in output_files:
+                storage.save(bucket_name, file_name, file_data)
         logger.info("Successfully sent data to s3.")
 
         if run_environment != "development":
-            logger.info(aws_functions.delete_data(bucket_name, ent_ref_agg))
-            logger.info(aws_functions.delete_data(bucket_name, cell_agg))
-            logger.info(aws_functions.delete_data(bucket_name, top2_agg))
+            for files in aggregation_file_sets:
+                logger.info(storage.delete(bucket_name, files["ent_ref_agg"]))
+                logger.info(storage.delete(bucket_name, files["cell_agg"]))
+                logger.info(storage.delete(bucket_name, files["top2_agg"]))
             logger.info("Successfully deleted input data.")
 
-        aws_functions.send_sns_message(sns_topic_arn, "Aggregation - Combiner.")
+        with instrumentation.stage("notify"):
+            aws_functions.send_sns_message(sns_topic_arn, "Aggregation - Combiner.")
         logger.info("Successfully sent data to sns.")
 
     except Exception as e:
@@ -152,6 +443,10 @@ def lambda_handler(event, context):
                                                            bpm_queue_url=bpm_queue_url)
 
     finally:
+        if transfer.hedging:
+            instrumentation.record("hedged_reads", transfer.hedged_reads)
+            instrumentation.record("hedges_won", transfer.hedges_won)
+        instrumentation.emit(logger)
         if (len(error_message)) > 0:
             logger.error(error_message)
             raise exception_classes.LambdaFailure(error_message)
@@ -164,3 +459,21 @@ def lambda_handler(event, context):
                                   current_step_num, total_steps)
 
     return {"success": True}
+
+
+def join_aggregations(data, aggregations, to_aggregate, engine):
+    """
+    Left joins each aggregation output onto data in turn. Every row of data is
+    joined on its own, so data may be joined a chunk at a time.
+
+    :param data: Rows to add the aggregations to. - DataFrame.
+    :param aggregations: Aggregation outputs to add. - List.
+    :param to_aggregate: Columns the aggregations are grouped by. - List.
+    :param engine: Compute engine to join with. - PandasEngine/DuckDBEngine.
+
+    :return: data: data with the aggregation columns added. - DataFrame.
+    """
+    for aggregation in aggregations:
+        data = engine.join(data, aggregation, to_aggregate)
+
+    return data
@@ -0,0 +1,80 @@
+import numpy as np
+import pandas as pd
+
+# Integers are never narrowed below this so row-wise sums cannot overflow.
+MINIMUM_INTEGER_DTYPE = np.int32
+
+# Object columns with at most this share of distinct values become categoricals.
+CATEGORICAL_THRESHOLD = 0.5
+
+
+def apply_dtype_policy(dataframe, column_types=None, key_columns=None):
+    """
+    Shrinks the memory footprint of a dataframe loaded from records JSON.
+    - Columns with a declared type in column_types are cast to that type.
+    - Integer columns are downcast to 32 bits when their range allows.
+    - String key columns, and any other low cardinality string columns, are
+      converted to categoricals.
+    Float columns are only changed when declared, as narrowing them would alter
+    aggregated values.
+
+    The dataframe is updated in place and returned.
+
+    :param dataframe: Freshly loaded input data. - DataFrame.
+    :param column_types: Declared dtype per column. e.g. {"region": "int16"} - Dict.
+    :param key_columns: Columns the data is grouped or joined on. - List.
+
+    :return: dataframe: The same dataframe with its dtypes optimised. - DataFrame.
+    """
+    column_types = column_types or {}
+    key_columns = key_columns or []
+
+    for column in dataframe.columns:
+        if column in column_types:
+            dataframe[column] = dataframe[column].astype(column_types[column])
+        elif pd.api.types.is_integer_dtype(dataframe[column]):
+            dataframe[column] = downcast_integer(dataframe[column])
+        elif pd.api.types.is_object_dtype(dataframe[column]) and \
+                is_categorical_candidate(dataframe[column], column in key_columns):
+            dataframe[column] = dataframe[column].astype("category")
+
+    return dataframe
+
+
+def downcast_integer(series):
+    """
+    Downcasts a numpy integer series to MINIMUM_INTEGER_DTYPE when all of its
+    values fit.
+
+    :param series: Integer values. - Series.
+
+    :return: series: Downcast values. - Series.
+    """
+    if len(series) == 0 or not isinstance(series.dtype, np.dtype) or \
+            series.dtype.itemsize <= np.dtype(MINIMUM_INTEGER_DTYPE).itemsize:
+        return series
+
+    limits = np.iinfo(MINIMUM_INTEGER_DTYPE)
+    if limits.min <= series.min() and series.max() <= limits.max:
+        return series.astype(MINIMUM_INTEGER_DTYPE)
+
+    return series
+
+
+def is_categorical_candidate(series, is_key):
+    """
+    Checks whether an object column holds only strings and is either a key column
+    or has few enough distinct values to benefit from a categorical.
+
+    :param series: Object values. - Series.
+    :param is_key: Whether the column is grouped or joined on. - Bool.
+
+    :return: Bool.
+    """
+    if len(series) == 0 or pd.api.types.infer_dtype(series, skipna=True) != "string":
+        return False
+
+    if is_key:
+        return True
+
+    return series.nunique() <= len(series) * CATEGORICAL_THRESHOLD
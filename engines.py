@@ -0,0 +1,397 @@
+import logging
+
+import numpy as np
+import pandas as pd
+
+try:
+    import duckdb
+except ImportError:
+    duckdb = None
+
+ENGINES = ["duckdb", "pandas"]
+
+GROUPBY_STRATEGIES = ["dense", "hash", "presorted", "sort"]
+
+# Key statistics are estimated from this many rows, spread evenly through the data.
+STATISTICS_SAMPLE_ROWS = 1000
+
+# Keys with at most this many combinations of values are grouped into a dense array.
+DENSE_MAX_CELLS = 1 << 16
+
+# Keys estimated to have more distinct combinations than this fraction of the rows
+# are grouped by hash, leaving the groups unsorted.
+HASH_DISTINCT_RATIO = 0.5
+
+# Integer sums are made in float64 by bincount, which is exact below 2 ** 53.
+EXACT_FLOAT_LIMIT = 2 ** 53
+
+# DuckDB aggregate for each pandas aggregation_type supported by the duckdb engine.
+# pandas sums groups holding only missing values to 0 where SQL gives NULL.
+DUCKDB_AGGREGATES = {
+    "count": "count({column})",
+    "max": "max({column})",
+    "mean": "avg({column})",
+    "min": "min({column})",
+    "nunique": "count(DISTINCT {column})",
+    "sum": "coalesce(sum({column}), 0)"
+}
+
+
+class PandasEngine:
+    """
+    Reference implementation of the aggregation kernels, in pandas.
+    Each grouping picks a strategy from cheap statistics of its keys, see
+    choose_strategy. Groups come back in no particular order, as with every
+    engine, so callers sort them where order matters.
+    """
+
+    name = "pandas"
+
+    def group_aggregate(self, data, keys, totals_dict):
+        """
+        Aggregates each column of totals_dict within groups of keys.
+
+        :param data: Data to aggregate. - DataFrame.
+        :param keys: Columns identifying a group. - List.
+        :param totals_dict: Aggregation of each column. e.g. {"Q608_total": "sum"}
+                            - Dict.
+
+        :return: Aggregated columns, indexed by keys. - DataFrame.
+        """
+        strategy = choose_strategy(data, keys, totals_dict)
+        if strategy == "dense":
+            return dense_aggregate(data, keys, totals_dict)
+
+        return data.groupby(keys, observed=True, sort=strategy == "sort") \
+            .agg(totals_dict)
+
+    def group_top_two(self, data, keys, column, top1_column, top2_column):
+        """
+        Finds the largest and second largest value of column within groups of keys.
+        Groups with a single row have a second largest value of 0.
+
+        :param data: Data to aggregate. - DataFrame.
+        :param keys: Columns identifying a group. - List.
+        :param column: Column to find the largest values of. - String.
+        :param top1_column: Name of the largest value column. - String.
+        :param top2_column: Name of the second largest value column. - String.
+
+        :return: keys, top1_column and top2_column of each group. - DataFrame.
+        """
+        # Imported here, as the method module imports this one.
+        from aggregation_top2_method import col_to_list, do_top_two
+
+        sort = choose_strategy(data, keys) == "sort"
+        return data.groupby(keys, as_index=False, observed=True, sort=sort) \
+            .agg({column: col_to_list}) \
+            .apply(lambda x: do_top_two(x, column, top1_column, top2_column),
+                   axis=1) \
+            .drop(column, axis=1)
+
+    def join(self, left, right, keys):
+        """
+        Left joins right onto left on keys, keeping the order of left.
+
+        :param left: Rows to keep. - DataFrame.
+        :param right: Columns to add. - DataFrame.
+        :param keys: Columns to join on. - List.
+
+        :return: Joined data. - DataFrame.
+        """
+        return pd.merge(left, right, on=keys, how="left")
+
+
+class DuckDBEngine:
+    """
+    Runs the aggregation kernels as SQL in an embedded DuckDB database, which
+    scans the dataframes in place and runs vectorised across all CPUs.
+    Results are cast back to the dtypes pandas gives, so either engine produces
+    the same output. The one exception is missing values, which the top two
+    selection ignores, where pandas sorts them wherever they fall in the group.
+    """
+
+    name = "duckdb"
+
+    def __init__(self):
+        self.connection = duckdb.connect()
+
+    def group_aggregate(self, data, keys, totals_dict):
+        selects = []
+        for column, aggregation_type in totals_dict.items():
+            if aggregation_type not in DUCKDB_AGGREGATES:
+                raise ValueError(f"The duckdb engine does not support "
+                                 f"{aggregation_type} aggregation.")
+            selects.append(DUCKDB_AGGREGATES[aggregation_type].format(
+                column=_quote(column)) + " AS " + _quote(column))
+
+        output = self._query(data, f"SELECT {_columns(keys)}, {', '.join(selects)} "
+                                   f"FROM data WHERE {_not_null(keys)} "
+                                   f"GROUP BY {_columns(keys)}")
+
+        expected = data.head(0).groupby(keys, observed=True).agg(totals_dict)
+        return output.astype(expected.dtypes.to_dict()).set_index(keys)
+
+    def group_top_two(self, data, keys, column, top1_column, top2_column):
+        output = self._query(data, f"""
+            SELECT {_columns(keys)},
+                max({_quote(column)}) FILTER (WHERE position = 1)
+                    AS {_quote(top1_column)},
+                coalesce(max({_quote(column)}) FILTER (WHERE position = 2), 0)
+                    AS {_quote(top2_column)}
+            FROM (
+                SELECT *, row_number() OVER (
+                    PARTITION BY {_columns(keys)} ORDER BY {_quote(column)} DESC
+                ) AS position
+                FROM data WHERE {_not_null(keys)}
+            )
+            GROUP BY {_columns(keys)}""")
+
+        return output.astype({top1_column: data[column].dtype,
+                              top2_column: data[column].dtype})
+
+    def join(self, left, right, keys):
+        # DuckDB does not keep row order through a join, so it is restored from the
+        # position of each row of left. NULL keys do not match, unlike in pandas.
+        left = left.assign(_position=range(len(left)))
+        added = [column for column in right.columns if column not in keys]
+        output = self._query(left, f"""
+            SELECT data.*, {", ".join("right_data." + _quote(column)
+                                      for column in added)}
+            FROM data LEFT JOIN right_data USING ({_columns(keys)})
+            ORDER BY data._position""", right_data=right)
+
+        # pandas fills unmatched integer columns with NaN, making them float.
+        for column in added:
+            if output[column].isna().any() and \
+                    pd.api.types.is_integer_dtype(right[column]):
+                output[column] = output[column].astype("float64")
+            else:
+                output[column] = output[column].astype(right[column].dtype)
+
+        return output.drop("_position", axis=1)
+
+    def _query(self, data, sql, **tables):
+        self.connection.register("data", data)
+        for name, table in tables.items():
+            self.connection.register(name, table)
+        try:
+            return self.connection.execute(sql).df()
+        finally:
+            self.connection.unregister("data")
+            for name in tables:
+                self.connection.unregister(name)
+
+
+def key_statistics(data, keys):
+    """
+    Collects statistics of the key columns that are cheap to compute.
+
+    :param data: Data to group. - DataFrame.
+    :param keys: Columns identifying a group. - List.
+
+    :return: statistics: distinct_ratio, the estimated fraction of rows starting a
+             new group, from a sample; categorical, whether any key is
+             categorical; and presorted, whether the rows are already in key
+             order. - Dict.
+    """
+    rows = len(data)
+    categorical = any(isinstance(data[key].dtype, pd.CategoricalDtype)
+                      for key in keys)
+    if rows == 0:
+        return {"distinct_ratio": 0.0, "categorical": categorical,
+                "presorted": True}
+
+    sample = data[keys].iloc[
+        np.linspace(0, rows - 1, min(rows, STATISTICS_SAMPLE_ROWS)).astype(int)]
+    distinct_ratio = len(sample.drop_duplicates()) / len(sample)
+
+    # Rows can only be in key order if they are in order of the first key, which is
+    # much cheaper to check.
+    presorted = data[keys[0]].is_monotonic_increasing
+    if presorted and len(keys) > 1:
+        presorted = pd.MultiIndex.from_frame(data[keys]).is_monotonic_increasing
+
+    return {"distinct_ratio": distinct_ratio, "categorical": categorical,
+            "presorted": presorted}
+
+
+def choose_strategy(data, keys, totals_dict=None):
+    """
+    Chooses how to group data, and logs the choice:
+        dense - integer code each key and sum and count into arrays indexed by the
+                combined code, when there are few combinations and only sums of
+                integers and counts are needed.
+        presorted - hash grouping when the rows are already in key order, which
+                    leaves the groups in order without sorting them.
+        hash - hash grouping without sorting the groups, when nearly every row is
+               its own group and sorting them would cost as much as grouping.
+        sort - hash grouping then sorting the groups, the pandas default.
+    Categorical keys are always sorted, as grouping them unsorted reorders their
+    categories.
+
+    :param data: Data to group. - DataFrame.
+    :param keys: Columns identifying a group. - List.
+    :param totals_dict: Aggregation of each column, when known. - Dict.
+
+    :return: strategy: One of GROUPBY_STRATEGIES. - String.
+    """
+    statistics = key_statistics(data, keys)
+    sample_groups = statistics["distinct_ratio"] * min(len(data),
+                                                       STATISTICS_SAMPLE_ROWS)
+
+    if statistics["categorical"]:
+        strategy = "sort"
+    elif totals_dict is not None and sample_groups <= DENSE_MAX_CELLS ** 0.5 \
+            and _dense_supported(data, totals_dict):
+        strategy = "dense"
+    elif statistics["presorted"]:
+        strategy = "presorted"
+    elif statistics["distinct_ratio"] > HASH_DISTINCT_RATIO:
+        strategy = "hash"
+    else:
+        strategy = "sort"
+
+    logging.getLogger().info(
+        f"Grouping {len(data)} rows by {', '.join(keys)} with the {strategy} "
+        f"strategy, with {statistics['distinct_ratio']:.1%} distinct keys in a "
+        f"sample{', presorted' if statistics['presorted'] else ''}.")
+    return strategy
+
+
+def dense_aggregate(data, keys, totals_dict):
+    """
+    Groups data by integer coding each key, combining the codes into a single cell
+    number, and summing and counting into arrays indexed by cell with bincount.
+    Gives the same output as the pandas groupby, in key order. Falls back to the
+    groupby when the keys have more combinations than DENSE_MAX_CELLS.
+
+    :param data: Data to aggregate. - DataFrame.
+    :param keys: Columns identifying a group. - List.
+    :param totals_dict: Aggregation of each column, sum or count. - Dict.
+
+    :return: Aggregated columns, indexed by keys. - DataFrame.
+    """
+    codes = []
+    uniques = []
+    for key in keys:
+        key_codes, key_uniques = _integer_code(data[key])
+        codes.append(key_codes)
+        uniques.append(key_uniques)
+
+    shape = tuple(max(len(key_uniques), 1) for key_uniques in uniques)
+    if np.prod(shape, dtype=float) > DENSE_MAX_CELLS:
+        logging.getLogger().info(f"Grouping by {', '.join(keys)} with the sort "
+                                 f"strategy, as the keys have too many "
+                                 f"combinations for the dense strategy.")
+        return data.groupby(keys, observed=True).agg(totals_dict)
+
+    # Rows with a missing key belong to no group, as in the groupby.
+    present = slice(None)
+    if any((key_codes < 0).any() for key_codes in codes):
+        present = np.logical_and.reduce([key_codes >= 0 for key_codes in codes])
+        codes = [key_codes[present] for key_codes in codes]
+    cells = codes[0] if len(codes) == 1 else np.ravel_multi_index(codes, shape)
+    cell_count = int(np.prod(shape))
+    rows = np.bincount(cells, minlength=cell_count)
+    groups = np.flatnonzero(rows)
+
+    output = {}
+    for column, aggregation_type in totals_dict.items():
+        values = data[column].to_numpy()[present]
+        if aggregation_type == "sum":
+            output[column] = np.bincount(cells, weights=values,
+                                         minlength=cell_count)[groups]
+        elif values.dtype.kind in "iub":
+            output[column] = rows[groups]
+        else:
+            output[column] = np.bincount(cells[pd.notna(values)],
+                                         minlength=cell_count)[groups]
+
+    group_codes = np.unravel_index(groups, shape)
+    if len(keys) == 1:
+        index = pd.Index(uniques[0].take(group_codes[0]), name=keys[0])
+    else:
+        index = pd.MultiIndex.from_arrays(
+            [key_uniques.take(key_codes)
+             for key_uniques, key_codes in zip(uniques, group_codes)], names=keys)
+
+    expected = data.head(0).groupby(keys, observed=True).agg(totals_dict)
+    dtypes = expected.dtypes.to_dict()
+    for column, aggregation_type in totals_dict.items():
+        if aggregation_type == "sum":
+            dtypes[column] = _sum_dtype(output[column], data[column].dtype)
+    return pd.DataFrame(output, index=index)[list(totals_dict)].astype(dtypes)
+
+
+def _sum_dtype(sums, dtype):
+    # As in the groupby, integer sums are taken in 64 bits and cast back to the
+    # column's own type only when every sum fits in it, so they never wrap.
+    limits = np.iinfo(dtype)
+    if not len(sums) or (sums.min() >= limits.min and sums.max() <= limits.max):
+        return dtype
+
+    return np.dtype("int64" if dtype.kind == "i" else "uint64")
+
+
+def _integer_code(column):
+    # Integers in a small range are coded by their offset from the minimum, which
+    # needs no hashing. Codes of values that do not occur are dropped later.
+    values = column.to_numpy()
+    if isinstance(column.dtype, np.dtype) and column.dtype.kind in "iu" \
+            and len(values):
+        low, high = values.min(), values.max()
+        if int(high) - int(low) < DENSE_MAX_CELLS:
+            # In int64, as offsets and the range end overflow narrow types.
+            return (values.astype(np.int64) - int(low)).astype(np.intp), \
+                np.arange(int(low), int(high) + 1).astype(column.dtype)
+
+    return pd.factorize(column, sort=True)
+
+
+def _dense_supported(data, totals_dict):
+    # bincount only sums and counts, and sums in float64, which is exact for
+    # integers below EXACT_FLOAT_LIMIT. Sums below it also fit the 64 bit types
+    # _sum_dtype widens to. pandas sums floats with compensated summation, which
+    # bincount does not match to the last bit.
+    for column, aggregation_type in totals_dict.items():
+        if aggregation_type == "count":
+            continue
+        dtype = data[column].dtype
+        if aggregation_type != "sum" or not isinstance(dtype, np.dtype) or \
+                dtype.kind not in "iu":
+            return False
+        if len(data) and np.abs(data[column].to_numpy(), dtype=float).max() * \
+                len(data) >= EXACT_FLOAT_LIMIT:
+            return False
+
+    return True
+
+
+def get_engine(name):
+    """
+    Creates the compute engine the aggregation kernels run on.
+
+    :param name: One of ENGINES. - String.
+
+    :return: engine: The engine. - PandasEngine/DuckDBEngine.
+    """
+    if name == "pandas":
+        return PandasEngine()
+    if name == "duckdb":
+        if duckdb is None:
+            raise ValueError("The duckdb engine needs the duckdb package.")
+        return DuckDBEngine()
+
+    raise ValueError(f"Unknown compute engine {name}.")
+
+
+def _columns(columns):
+    return ", ".join(_quote(column) for column in columns)
+
+
+def _not_null(columns):
+    return " AND ".join(f"{_quote(column)} IS NOT NULL" for column in columns)
+
+
+def _quote(column):
+    return '"' + column.replace('"', '""') + '"'
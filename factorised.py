@@ -0,0 +1,113 @@
+import numpy as np
+import pandas as pd
+
+# Column of the granular data and the aggregate table holding each group's id.
+GROUP_ID_COLUMN = "group_id"
+
+# Group id of rows whose group has no aggregates.
+MISSING_GROUP = -1
+
+
+class FactorisedFrame:
+    """
+    Combiner output in factorised form: the granular data with a GROUP_ID_COLUMN,
+    and one aggregate table holding each group's aggregates once, keyed by group
+    id. Single aggregate columns are broadcast onto the rows on request, and the
+    wide view, every aggregate on every row as the combiner otherwise writes, is
+    only built when first asked for.
+    """
+
+    def __init__(self, data, aggregates, keys):
+        """
+        :param data: Granular data with a GROUP_ID_COLUMN. - DataFrame.
+        :param aggregates: Aggregate table with a GROUP_ID_COLUMN. - DataFrame.
+        :param keys: Columns the aggregates are grouped by. - List.
+        """
+        self.data = data
+        self.aggregates = aggregates
+        self.keys = keys
+        self._wide = None
+
+    @property
+    def aggregate_columns(self):
+        return [column for column in self.aggregates.columns
+                if column != GROUP_ID_COLUMN and column not in self.keys]
+
+    def column(self, name):
+        """
+        Broadcasts one aggregate column onto the granular rows.
+
+        :param name: Name of the aggregate column. - String.
+        :return: Value of the column for every row, missing for rows without a
+                 group. - Series.
+        """
+        values = self.aggregates.set_index(GROUP_ID_COLUMN)[name]
+        return pd.Series(values.reindex(self.data[GROUP_ID_COLUMN]).to_numpy(),
+                         index=self.data.index, name=name)
+
+    def wide(self):
+        """
+        :return: The granular data with every aggregate column, identical to the
+                 combiner's wide output. - DataFrame.
+        """
+        if self._wide is None:
+            self._wide = pd.merge(
+                self.data, self.aggregates.drop(columns=self.keys), on=GROUP_ID_COLUMN,
+                how="left").drop(columns=GROUP_ID_COLUMN)
+
+        return self._wide
+
+
+def aggregates_file_name(file_name):
+    """
+    :param file_name: Name of the granular output file. - String.
+    :return: Name of the aggregate table written alongside it. - String.
+    """
+    if file_name.endswith(".json"):
+        return file_name[:-len(".json")] + "_aggregates.json"
+
+    return file_name + "_aggregates"
+
+
+def factorise(data, aggregations, keys, engine):
+    """
+    Joins the aggregation outputs into one aggregate table, with a row for every
+    group in any of them, numbered in key order. Each row of data is tagged with
+    the number of its group, and rows of a group with no aggregates are given
+    MISSING_GROUP.
+
+    :param data: Granular rows. - DataFrame.
+    :param aggregations: Aggregation outputs, each with a row per group. - List.
+    :param keys: Columns the aggregations are grouped by. - List.
+    :param engine: Compute engine to join with. - PandasEngine/DuckDBEngine.
+
+    :return: factorised: The factorised output. - FactorisedFrame.
+    """
+    aggregates = pd.concat([aggregation[keys] for aggregation in aggregations]) \
+        .drop_duplicates().sort_values(keys, ignore_index=True)
+    for aggregation in aggregations:
+        aggregates = engine.join(aggregates, aggregation, keys)
+    aggregates.insert(0, GROUP_ID_COLUMN, np.arange(len(aggregates), dtype="int64"))
+
+    data = engine.join(data, aggregates[keys + [GROUP_ID_COLUMN]], keys)
+    data[GROUP_ID_COLUMN] = data[GROUP_ID_COLUMN].fillna(MISSING_GROUP) \
+        .astype("int64")
+
+    return FactorisedFrame(data, aggregates, keys)
+
+
+def read_factorised(read_dataframe, bucket_name, file_name, keys):
+    """
+    Reads a factorised combiner output, without building the wide view.
+
+    :param read_dataframe: Reads one file, such as a storage backend's
+                           read_dataframe. - Function.
+    :param bucket_name: Name of the bucket holding the output. - String.
+    :param file_name: Name of the granular output file. - String.
+    :param keys: Columns the aggregates are grouped by. - List.
+
+    :return: factorised: The factorised output. - FactorisedFrame.
+    """
+    return FactorisedFrame(
+        read_dataframe(bucket_name, file_name),
+        read_dataframe(bucket_name, aggregates_file_name(file_name)), keys)
@@ -0,0 +1,102 @@
+import pandas as pd
+
+
+def find_changed_groups(data, previous_data, unique_identifier, group_columns):
+    """
+    Compares the current input against the previous run's input and finds every
+    group containing a contributor that was added, removed or changed. A contributor
+    that moved between groups marks both its old and new group.
+
+    :param data: Current input data. - DataFrame.
+    :param previous_data: Input data of the previous run. - DataFrame.
+    :param unique_identifier: Columns identifying a contributor. - List.
+    :param group_columns: Columns the data is aggregated by. - List.
+
+    :return: changed_groups: Distinct group keys needing re-aggregation. - DataFrame.
+    """
+    compare_columns = sorted(set(data.columns) & set(previous_data.columns))
+
+    current = data[unique_identifier + group_columns].copy()
+    current["_row_hash"] = pd.util.hash_pandas_object(data[compare_columns],
+                                                      index=False).values
+    previous = previous_data[unique_identifier + group_columns].copy()
+    previous["_row_hash"] = pd.util.hash_pandas_object(previous_data[compare_columns],
+                                                       index=False).values
+
+    compared = current.merge(previous, on=unique_identifier, how="outer",
+                             suffixes=("", "_previous"), indicator=True)
+    changed = compared[(compared["_merge"] != "both") |
+                       (compared["_row_hash"] != compared["_row_hash_previous"])]
+
+    current_groups = changed.loc[changed["_merge"] != "right_only", group_columns]
+    previous_groups = changed.loc[changed["_merge"] != "left_only",
+                                  [column + "_previous" for column in group_columns]]
+    previous_groups.columns = group_columns
+
+    return pd.concat([current_groups, previous_groups]).drop_duplicates()\
+        .reset_index(drop=True)
+
+
+def in_groups(data, groups, group_columns):
+    """
+    Flags the rows of data belonging to one of the given groups.
+
+    :param data: Data containing the group columns. - DataFrame.
+    :param groups: Distinct group keys. - DataFrame.
+    :param group_columns: Columns the data is aggregated by. - List.
+
+    :return: Boolean mask aligned to data. - Array.
+    """
+    data_keys = pd.MultiIndex.from_frame(data[group_columns])
+    group_keys = pd.MultiIndex.from_frame(groups[group_columns])
+
+    return data_keys.isin(group_keys)
+
+
+def patch_groups(previous_output, new_output, groups, group_columns):
+    """
+    Replaces the changed groups of a previous aggregation with freshly aggregated
+    values. The result is sorted by the group columns to match a full run.
+
+    :param previous_output: Aggregated output of the previous run. - DataFrame.
+    :param new_output: Aggregates recalculated for the changed groups. - DataFrame.
+    :param groups: Distinct group keys that were recalculated. - DataFrame.
+    :param group_columns: Columns the data is aggregated by. - List.
+
+    :return: patched_output: Aggregates for every group. - DataFrame.
+    """
+    unchanged = previous_output[~in_groups(previous_output, groups, group_columns)]
+    if len(new_output) == 0:
+        return unchanged.reset_index(drop=True)
+
+    return pd.concat([unchanged, new_output[previous_output.columns]])\
+        .sort_values(group_columns, kind="mergesort").reset_index(drop=True)
+
+
+def patch_rows(previous_output, new_rows, groups, group_columns, data,
+               unique_identifier):
+    """
+    Replaces the rows of the changed groups in a previous granular output with
+    freshly combined rows. The result follows the row order of data to match a
+    full run.
+
+    :param previous_output: Granular output of the previous run. - DataFrame.
+    :param new_rows: Rows recombined for the changed groups. - DataFrame.
+    :param groups: Distinct group keys that were recombined. - DataFrame.
+    :param group_columns: Columns the data is aggregated by. - List.
+    :param data: Current input data, giving the output row order. - DataFrame.
+    :param unique_identifier: Columns identifying a contributor. - List.
+
+    :return: patched_output: Granular output for every contributor. - DataFrame.
+    """
+    unchanged = previous_output[~in_groups(previous_output, groups, group_columns)]
+    patched_output = unchanged
+    if len(new_rows) > 0:
+        patched_output = pd.concat([unchanged, new_rows[previous_output.columns]])
+
+    row_order = data[unique_identifier].reset_index(drop=True)
+    row_order["_row_order"] = row_order.index
+
+    return patched_output.merge(row_order, on=unique_identifier, how="inner")\
+        .sort_values("_row_order", kind="mergesort")\
+        .drop("_row_order", axis=1).reset_index(drop=True)
@@ -0,0 +1,223 @@
+import json
+import resource
+import time
+import tracemalloc
+from contextlib import nullcontext
+
+METRIC_NAMESPACE = "es-aggregation-sg"
+
+# Shared no-op context used for every stage when instrumentation is disabled.
+_DISABLED_STAGE = nullcontext()
+
+
+class Instrumentation:
+    """
+    Records wall time per named stage (read, decode, compute, encode, invoke,
+    write, notify) along with row counts, group counts and payload sizes for a
+    single lambda invocation. The collected values are emitted as a single
+    CloudWatch embedded metric format log line tagged with the run_id and module.
+
+    Memory instrumentation can be switched on separately. It records the peak RSS
+    reached by the end of each stage, the deep memory footprint of the major
+    dataframes broken down by dtype and, optionally, the top allocating lines
+    from tracemalloc.
+
+    When a tracer is given, each stage is also recorded as a trace span.
+
+    When disabled every call returns immediately so the handlers can be left
+    instrumented permanently.
+    """
+
+    def __init__(self, run_id, current_module, enabled=False, memory_enabled=False,
+                 tracemalloc_top=0, tracer=None):
+        """
+        :param run_id: The run_id of the current invocation. - String.
+        :param current_module: Name of the module being instrumented. - String.
+        :param enabled: Whether to collect and emit timing metrics. - Bool.
+        :param memory_enabled: Whether to collect memory metrics. - Bool.
+        :param tracemalloc_top: Number of top allocators to report, 0 for none. - Int.
+        :param tracer: Tracer recording each stage as a span. - Tracer.
+        """
+        self.run_id = run_id
+        self.current_module = current_module
+        self.enabled = enabled
+        self.memory_enabled = memory_enabled
+        self.tracemalloc_top = tracemalloc_top
+        self.tracer = tracer
+        self.active = enabled or memory_enabled or (tracer is not None and
+                                                    tracer.enabled)
+        self.metrics = {}
+        self.units = {}
+        self.frames = {}
+
+        if self.memory_enabled and self.tracemalloc_top > 0 \
+                and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def stage(self, name):
+        """
+        Context manager timing the enclosed block as the named stage.
+        Repeated stages of the same name are summed.
+
+        :param name: Name of the stage. e.g. read, compute. - String.
+        :return: Context manager.
+        """
+        if not self.active:
+            return _DISABLED_STAGE
+
+        return _Stage(self, name)
+
+    def record(self, name, value, unit="Count"):
+        """
+        Adds a value to the named metric.
+
+        :param name: Name of the metric. e.g. rows_in. - String.
+        :param value: Value to add. - Int/Float.
+        :param unit: CloudWatch unit of the metric. - String.
+        :return: None
+        """
+        if not self.enabled:
+            return
+
+        self.metrics[name] = self.metrics.get(name, 0) + value
+        self.units[name] = unit
+
+    def record_bytes(self, name, data):
+        """
+        Records the size of a serialised payload. Output from to_json is ascii
+        escaped so the length of the string is its size in bytes. Dataframes
+        handed over without serialisation have no payload size and are skipped.
+
+        :param name: Name of the metric. e.g. bytes_in. - String.
+        :param data: The serialised payload. - String/Bytes.
+        :return: None
+        """
+        if not self.enabled or not isinstance(data, (str, bytes)):
+            return
+
+        self.record(name, len(data), "Bytes")
+
+    def record_peak(self, name, value, unit="Bytes"):
+        """
+        Keeps the largest value seen for the named metric.
+
+        :param name: Name of the metric. e.g. compute_peak_rss. - String.
+        :param value: Value to compare. - Int/Float.
+        :param unit: CloudWatch unit of the metric. - String.
+        :return: None
+        """
+        if not self.memory_enabled:
+            return
+
+        self.metrics[name] = max(self.metrics.get(name, 0), value)
+        self.units[name] = unit
+
+    def record_frame(self, name, dataframe):
+        """
+        Records the deep memory footprint of a dataframe, in total and by dtype.
+
+        :param name: Name to report the dataframe under. e.g. input. - String.
+        :param dataframe: The dataframe to measure. - DataFrame.
+        :return: None
+        """
+        if not self.memory_enabled:
+            return
+
+        usage = dataframe.memory_usage(deep=True)
+        by_dtype = {}
+        for column, dtype in dataframe.dtypes.items():
+            by_dtype[str(dtype)] = by_dtype.get(str(dtype), 0) + int(usage[column])
+
+        self.frames[name] = {
+            "rows": len(dataframe),
+            "columns": len(dataframe.columns),
+            "bytes": int(usage.sum()),
+            "bytes_by_dtype": by_dtype
+        }
+        self.record_peak(name + "_frame_bytes", int(usage.sum()))
+
+    def emit(self, logger):
+        """
+        Writes all collected metrics to the log as an embedded metric format line,
+        followed by the memory report when memory instrumentation is enabled and
+        the trace spans when tracing is enabled.
+
+        :param logger: The handler's logger.
+        :return: None
+        """
+        if not self.active:
+            return
+
+        if self.metrics:
+            metric_line = {
+                "_aws": {
+                    "Timestamp": int(time.time() * 1000),
+                    "CloudWatchMetrics": [{
+                        "Namespace": METRIC_NAMESPACE,
+                        "Dimensions": [["module"]],
+                        "Metrics": [{"Name": name, "Unit": self.units[name]}
+                                    for name in self.metrics]
+                    }]
+                },
+                "module": self.current_module,
+                "run_id": self.run_id
+            }
+            metric_line.update(self.metrics)
+
+            logger.info(json.dumps(metric_line))
+
+        if self.memory_enabled:
+            memory_report = {
+                "module": self.current_module,
+                "run_id": self.run_id,
+                "peak_rss": peak_rss(),
+                "frames": self.frames
+            }
+
+            if tracemalloc.is_tracing() and self.tracemalloc_top > 0:
+                snapshot = tracemalloc.take_snapshot()
+                tracemalloc.stop()
+                memory_report["top_allocators"] = [
+                    {"location": str(statistic.traceback),
+                     "size": statistic.size,
+                     "count": statistic.count}
+                    for statistic in
+                    snapshot.statistics("lineno")[:self.tracemalloc_top]
+                ]
+
+            logger.info(json.dumps(memory_report))
+
+        if self.tracer is not None:
+            self.tracer.emit(logger)
+
+
+def peak_rss():
+    """
+    Peak resident set size of the current process. ru_maxrss is reported in
+    kilobytes on linux.
+
+    :return: Peak RSS in bytes. - Int.
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class _Stage:
+    def __init__(self, instrumentation, name):
+        self.instrumentation = instrumentation
+        self.name = name
+        self.start = None
+        self.wall_start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        self.wall_start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        elapsed = (time.perf_counter() - self.start) * 1000
+        self.instrumentation.record(self.name + "_time", elapsed, "Milliseconds")
+        self.instrumentation.record_peak(self.name + "_peak_rss", peak_rss())
+        if self.instrumentation.tracer is not None:
+            self.instrumentation.tracer.add_span(self.name, self.wall_start,
+                                                 time.time())
+        return False
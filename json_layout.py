@@ -0,0 +1,39 @@
+import json
+
+import pandas as pd
+
+JSON_LAYOUTS = ["records", "split"]
+
+
+def encode_frame(data, json_layout="records"):
+    """
+    Encodes a dataframe as JSON. The records layout repeats every column name on
+    every row. The split layout is pandas' orient="split" without the index: a
+    "columns" header naming each column once, then "data" holding each row as a
+    list of values in column order.
+
+    :param data: Data to encode. - DataFrame.
+    :param json_layout: One of JSON_LAYOUTS. - String.
+
+    :return: Encoded data. - String.
+    """
+    if json_layout == "split":
+        return data.to_json(orient="split", index=False)
+
+    return data.to_json(orient="records")
+
+
+def decode_frame(content):
+    """
+    Decodes JSON written in either layout, telling them apart by the top level
+    type: records are a list, split is an object.
+
+    :param content: Encoded data. - String/Bytes.
+
+    :return: data: Decoded data. - DataFrame.
+    """
+    parsed = json.loads(content)
+    if isinstance(parsed, dict):
+        return pd.DataFrame(parsed["data"], columns=parsed["columns"])
+
+    return pd.DataFrame(parsed)
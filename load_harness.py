@@ -0,0 +1,272 @@
+import argparse
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+import numpy as np
+import pandas as pd
+
+from pipeline_runner import PipelineRunner, load_steps, scale_frame
+
+PERCENTILES = [50, 95, 99]
+
+
+class RequestCounter:
+    """
+    Records the time of every S3 request made through the default boto3 session,
+    which the handlers, aws_functions and the stand-ins all use.
+    """
+
+    def __init__(self):
+        self.times = []
+        self._lock = threading.Lock()
+
+    def __call__(self, **kwargs):
+        with self._lock:
+            self.times.append(time.perf_counter())
+
+    def __enter__(self):
+        if boto3.DEFAULT_SESSION is None:
+            boto3.setup_default_session()
+        boto3.DEFAULT_SESSION.events.register("before-call.s3", self)
+        return self
+
+    def __exit__(self, *args):
+        boto3.DEFAULT_SESSION.events.unregister("before-call.s3", self)
+
+
+class LoadTest:
+    """
+    Drives many concurrent runs of a pipeline through one set of local stand-ins,
+    as many run_ids reach the deployed functions at once. Runs arrive as a Poisson
+    process at arrival_rate runs per second, or all at once when it is 0. Each run
+    has its own run_id, load-<number>, and its own copies of the inputs, scaled by
+    one of scales in turn. Its files are kept apart under a directory named after
+    the run.
+
+    A concurrency limit stands in for the Lambda concurrency limit: a step that
+    finds every slot taken queues for one. A wrangler's method runs within the
+    wrangler's slot. Every run shares the process, so the timings include
+    contention for the GIL and CPUs that separate Lambdas would not have.
+    """
+
+    def __init__(self, steps, input_files, runs, arrival_rate=0.0, scales=(1,),
+                 scale_columns=(), concurrency=0, environment=None, seed=0):
+        """
+        :param steps: Steps of one run. - List of Step.
+        :param input_files: Contents of each input, keyed on file name. - Dict.
+        :param runs: Number of runs. - Int.
+        :param arrival_rate: Mean runs arriving per second, all at once when 0.
+                             - Float.
+        :param scales: Factors to scale the inputs of successive runs by. - List.
+        :param scale_columns: Contributor identifier columns made unique in each
+                              copy of a scaled input. - List.
+        :param concurrency: Most steps to run at once, unlimited when 0. - Int.
+        :param environment: Extra environment variables for every handler. - Dict.
+        :param seed: Seed of the arrival times. - Int.
+        """
+        self.input_files = input_files
+        self.runs = runs
+        self.scales = list(scales)
+        self.scale_columns = list(scale_columns)
+        self.runner = PipelineRunner(steps, environment=environment,
+                                     concurrency=concurrency)
+        self.arrivals = arrival_times(runs, arrival_rate, seed)
+
+    def run(self):
+        """
+        Runs every run and reports the load.
+
+        :return: report: Throughput, latency percentiles per handler, queueing and
+                         S3 request rates. - Dict.
+        """
+        input_files = {}
+        for index in range(self.runs):
+            scale = self.scales[index % len(self.scales)]
+            for file_name, content in self.input_files.items():
+                if scale > 1:
+                    content = scale_frame(pd.DataFrame(json.loads(content)), scale,
+                                          self.scale_columns).to_json(orient="records")
+                input_files[f"load-{index}/{file_name}"] = content
+
+        with self.runner.stand_ins(input_files) as (topic_arn, queue_url), \
+                RequestCounter() as requests:
+            started = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=self.runs) as executor:
+                results = list(executor.map(
+                    lambda index: self._run(index, topic_arn, queue_url, started),
+                    range(self.runs)))
+            wall_seconds = time.perf_counter() - started
+
+        return load_report(results, wall_seconds, requests.times, started)
+
+    def _run(self, index, topic_arn, queue_url, started):
+        arrival = self.arrivals[index]
+        time.sleep(max(0.0, started + arrival - time.perf_counter()))
+        steps = [step._replace(runtime_variables=run_variables(
+            step.runtime_variables, f"load-{index}")) for step in self.runner.steps]
+        timings = self.runner.execute(steps, topic_arn, queue_url, started)
+        end = max(timing["end"] for timing in timings.values())
+
+        return {
+            "arrival": arrival,
+            "handlers": {step.name: step.handler for step in steps},
+            "seconds": end - arrival,
+            "success": all(timing["status"] == "success"
+                           for timing in timings.values()),
+            "timings": timings
+        }
+
+
+def arrival_times(runs, arrival_rate, seed=0):
+    """
+    :param runs: Number of runs. - Int.
+    :param arrival_rate: Mean runs arriving per second, all at once when 0. - Float.
+    :param seed: Seed of the random gaps. - Int.
+
+    :return: arrivals: Seconds after the start that each run arrives. - List.
+    """
+    if arrival_rate <= 0:
+        return [0.0] * runs
+
+    gaps = np.random.default_rng(seed).exponential(1 / arrival_rate, runs)
+    return list(np.cumsum(gaps) - gaps[0])
+
+
+def run_variables(runtime_variables, run):
+    """
+    Gives a run its own run_id, and moves every file it reads and writes under a
+    directory named after the run.
+
+    :param runtime_variables: Runtime variables of a step. - Dict.
+    :param run: run_id of the run. - String.
+
+    :return: runtime_variables: Runtime variables of the step in this run. - Dict.
+    """
+    variables = dict(runtime_variables, run_id=run)
+    for key, value in runtime_variables.items():
+        if "file_name" in key and value:
+            variables[key] = f"{run}/{value}"
+    if "aggregation_files" in variables:
+        variables["aggregation_files"] = {
+            key: f"{run}/{value}"
+            for key, value in variables["aggregation_files"].items()}
+    if "batch_runs" in variables:
+        variables["batch_runs"] = [
+            {key: f"{run}/{value}" for key, value in batch_run.items()}
+            for batch_run in variables["batch_runs"]]
+
+    return variables
+
+
+def percentiles(values):
+    """
+    :param values: Values to summarise. - List.
+    :return: The 50th, 95th and 99th percentiles and the maximum, empty when there
+             are no values. - Dict.
+    """
+    if not values:
+        return {}
+
+    summary = {f"p{percentile}": float(value) for percentile, value in
+               zip(PERCENTILES, np.percentile(values, PERCENTILES))}
+    summary["max"] = float(max(values))
+    return summary
+
+
+def peak_concurrency(intervals):
+    """
+    :param intervals: Start and end of every step. - List of tuples.
+    :return: The most steps running at the same time. - Int.
+    """
+    events = sorted([(start, 1) for start, _ in intervals] +
+                    [(end, -1) for _, end in intervals])
+    running = peak = 0
+    for _, change in events:
+        running += change
+        peak = max(peak, running)
+
+    return peak
+
+
+def load_report(results, wall_seconds, request_times, started):
+    """
+    :param results: Result of every run. - List.
+    :param wall_seconds: Time from the first arrival to the last run ending. - Float.
+    :param request_times: perf_counter time of every S3 request. - List.
+    :param started: perf_counter time of the first arrival. - Float.
+
+    :return: report: The load report. - Dict.
+    """
+    handlers = {}
+    intervals = []
+    for result in results:
+        for name, timing in result["timings"].items():
+            if timing["status"] == "skipped":
+                continue
+            handler = handlers.setdefault(result["handlers"][name], {
+                "failed": 0, "invocations": 0, "queued": [], "seconds": []})
+            handler["invocations"] += 1
+            handler["failed"] += timing["status"] != "success"
+            handler["queued"].append(timing["queued"])
+            handler["seconds"].append(timing["seconds"])
+            intervals.append((timing["start"], timing["end"]))
+
+    per_second = np.bincount([int(request_time - started)
+                              for request_time in request_times]) \
+        if request_times else np.zeros(1, dtype=int)
+    succeeded = sum(result["success"] for result in results)
+
+    return {
+        "failed_runs": len(results) - succeeded,
+        "handlers": {name: {"failed": handler["failed"],
+                            "invocations": handler["invocations"],
+                            "queued_seconds": percentiles(handler["queued"]),
+                            "seconds": percentiles(handler["seconds"])}
+                     for name, handler in sorted(handlers.items())},
+        "peak_concurrency": peak_concurrency(intervals),
+        "queued_seconds": percentiles([queued for handler in handlers.values()
+                                       for queued in handler["queued"]]),
+        "run_seconds": percentiles([result["seconds"] for result in results]),
+        "runs": len(results),
+        "s3_requests": {"peak_per_second": int(per_second.max()),
+                        "per_second": len(request_times) / wall_seconds,
+                        "total": len(request_times)},
+        "throughput": succeeded / wall_seconds,
+        "wall_seconds": wall_seconds
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Run many concurrent pipeline runs locally and report the load.")
+    parser.add_argument("config", help="Pipeline config JSON file.")
+    parser.add_argument("--runs", type=int, default=10, help="Number of runs.")
+    parser.add_argument("--arrival-rate", type=float, default=0.0,
+                        help="Mean runs arriving per second, all at once when 0.")
+    parser.add_argument("--concurrency", type=int, default=0,
+                        help="Most steps to run at once, unlimited when 0.")
+    parser.add_argument("--scale", type=int, nargs="*", default=[1],
+                        help="Factors to scale the inputs of successive runs by.")
+    parser.add_argument("--scale-columns", nargs="*", default=[],
+                        help="Contributor identifier columns made unique per copy.")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="Seed of the arrival times.")
+    arguments = parser.parse_args()
+
+    with open(arguments.config, "r") as config_file:
+        pipeline_config = json.load(config_file)
+
+    inputs = {}
+    for key, path in pipeline_config["inputs"].items():
+        with open(path, "r") as input_file:
+            inputs[key] = input_file.read()
+
+    report = LoadTest(load_steps(pipeline_config), inputs, arguments.runs,
+                      arguments.arrival_rate, arguments.scale,
+                      arguments.scale_columns, arguments.concurrency,
+                      pipeline_config.get("environment"), arguments.seed).run()
+    print(json.dumps(report, indent=4, default=str))
+    raise SystemExit(0 if report["failed_runs"] == 0 else 1)
@@ -0,0 +1,165 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+import boto3
+import numpy as np
+import pandas as pd
+from es_aws_functions import aws_functions
+
+from result_cache import object_key
+
+# Lambda can only write under /tmp, which survives between warm invocations.
+CACHE_DIRECTORY = "/tmp/dataframe_cache"
+
+# Column dtype kinds stored as .npy files, which can be memory mapped on read.
+MAPPED_KINDS = "biufcmM"
+
+
+class LocalCache:
+    """
+    Size bounded LRU cache of dataframes read from S3, kept on local disk so that
+    warm invocations of a function can reuse them without a download and parse.
+    Entries are keyed on the bucket, key and ETag of the object, so a HEAD request
+    confirms an entry is still current before it is used.
+    The cache does nothing when max_bytes is 0.
+    Misses are read with read_dataframe, which defaults to
+    aws_functions.read_dataframe_from_s3.
+    """
+
+    def __init__(self, max_bytes, directory=CACHE_DIRECTORY, read_dataframe=None):
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.enabled = max_bytes > 0
+        self.hits = 0
+        self._read_dataframe = read_dataframe or aws_functions.read_dataframe_from_s3
+        self._client = None
+
+    @property
+    def client(self):
+        if self._client is None:
+            self._client = boto3.client("s3", region_name="eu-west-2")
+        return self._client
+
+    def read_dataframe(self, bucket_name, file_name):
+        """
+        Drop in replacement for aws_functions.read_dataframe_from_s3 which serves
+        current objects from the local cache.
+
+        :param bucket_name: Name of the bucket holding the file. - String.
+        :param file_name: Name of the file. - String.
+
+        :return: data: Contents of the file. - DataFrame.
+        """
+        if not self.enabled:
+            return self._read_dataframe(bucket_name, file_name)
+
+        key = object_key(file_name)
+        etag = self.client.head_object(Bucket=bucket_name, Key=key)["ETag"]
+        entry = os.path.join(self.directory, hashlib.sha256(
+            f"{bucket_name}/{key}/{etag}".encode("utf-8")).hexdigest())
+
+        if os.path.isdir(entry):
+            os.utime(entry)
+            self.hits += 1
+            return load_frame(entry)
+
+        data = self._read_dataframe(bucket_name, file_name)
+        self._store(entry, data)
+
+        return data
+
+    def evict(self):
+        """
+        Deletes the least recently used entries until the cache fits within
+        max_bytes.
+
+        :return: evicted: Number of entries deleted. - Int.
+        """
+        entries = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.startswith(".") or not os.path.isdir(path):
+                continue
+            size = sum(entry.stat().st_size for entry in os.scandir(path))
+            entries.append((os.stat(path).st_mtime, size, path))
+
+        entries.sort()
+        total_bytes = sum(size for _, size, _ in entries)
+        evicted = 0
+        for _, size, path in entries:
+            if total_bytes <= self.max_bytes:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total_bytes -= size
+            evicted += 1
+
+        return evicted
+
+    def _store(self, entry, data):
+        # The entry is written to a temporary directory and renamed into place, so
+        # a partly written entry is never read. A full disk only skips caching.
+        os.makedirs(self.directory, exist_ok=True)
+        staging = tempfile.mkdtemp(prefix=".", dir=self.directory)
+        try:
+            save_frame(data, staging)
+            os.rename(staging, entry)
+        except OSError:
+            shutil.rmtree(staging, ignore_errors=True)
+            return
+
+        self.evict()
+
+
+def load_frame(directory):
+    """
+    Loads a dataframe saved by save_frame, memory mapping its numeric columns.
+    Mapped columns are copy-on-write, so changing the dataframe never alters the
+    cached files.
+
+    :param directory: Directory the dataframe was saved to. - String.
+
+    :return: data: The saved dataframe. - DataFrame.
+    """
+    with open(os.path.join(directory, "manifest.json"), "r") as manifest_file:
+        manifest = json.load(manifest_file)
+
+    columns = {}
+    for column in manifest["columns"]:
+        path = os.path.join(directory, column["file"])
+        if column["mapped"]:
+            columns[column["name"]] = np.load(path, mmap_mode="c")
+        else:
+            columns[column["name"]] = pd.read_pickle(path)
+
+    return pd.DataFrame(columns, columns=[column["name"] for column in
+                                          manifest["columns"]],
+                        index=pd.RangeIndex(manifest["rows"]))
+
+
+def save_frame(data, directory):
+    """
+    Saves a dataframe column by column. Numeric, boolean and datetime columns are
+    saved as .npy files, any other column is pickled.
+
+    :param data: Dataframe with a default index. - DataFrame.
+    :param directory: Existing directory to save to. - String.
+
+    :return: None
+    """
+    columns = []
+    for position, name in enumerate(data.columns):
+        values = data[name].values
+        mapped = isinstance(values, np.ndarray) and values.dtype.kind in MAPPED_KINDS
+        if mapped:
+            file_name = f"{position}.npy"
+            np.save(os.path.join(directory, file_name), values)
+        else:
+            file_name = f"{position}.pkl"
+            data[name].to_pickle(os.path.join(directory, file_name))
+        columns.append({"file": file_name, "mapped": mapped, "name": name})
+
+    with open(os.path.join(directory, "manifest.json"), "w") as manifest_file:
+        json.dump({"columns": columns, "rows": len(data)}, manifest_file)
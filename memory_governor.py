@@ -0,0 +1,99 @@
+import math
+
+import numpy as np
+
+MEBIBYTE = 1024 * 1024
+
+# Peak memory taken to parse each byte of a JSON records object into a dataframe.
+JSON_PARSE_FACTOR = 3.5
+
+# Memory taken by groupby and merge intermediates for each byte of their input.
+COMPUTE_FACTOR = 1.0
+
+# Rows sampled to estimate the size of object (string) columns.
+SAMPLE_ROWS = 1000
+
+
+class MemoryGovernor:
+    """
+    Chooses between running a compute step in one pass and running it in chunks,
+    from the memory limit the Lambda context reports. The working set of the step
+    is estimated from the schema of its input, and the input is split into enough
+    chunks for each chunk's working set to fit within fraction of the limit.
+    Chunking only caps the intermediates of the step, as the whole input is
+    already in memory. Reads cannot be chunked, so a read whose estimated working
+    set exceeds the limit fails straight away rather than running out of memory.
+    When fraction is 0 everything is processed in one pass.
+    """
+
+    def __init__(self, context, fraction=0.0):
+        """
+        :param context: The Lambda context. - LambdaContext.
+        :param fraction: Fraction of the memory limit a chunk may use. - Float.
+        """
+        self.enabled = fraction > 0
+        self.limit = int(context.memory_limit_in_mb) * MEBIBYTE if self.enabled \
+            else 0
+        self.budget = int(self.limit * fraction)
+
+    def check_read(self, storage, bucket_name, file_names):
+        """
+        Raises a MemoryError if reading the files would need more memory than the
+        limit.
+
+        :param storage: Storage backend the files are read from. - Storage.
+        :param bucket_name: Name of the bucket holding the files. - String.
+        :param file_names: Names of the files. - List.
+        :return: None
+        """
+        if not self.enabled:
+            return
+
+        size = sum(storage.size(bucket_name, file_name) for file_name in file_names)
+        needed = size if storage.in_memory else int(size * JSON_PARSE_FACTOR)
+        if needed > self.limit:
+            raise MemoryError(f"Reading {', '.join(file_names)} needs about "
+                              f"{needed // MEBIBYTE} MB, over the memory limit of "
+                              f"{self.limit // MEBIBYTE} MB.")
+
+    def chunk_count(self, data):
+        """
+        Number of chunks data must be processed in for each chunk's working set to
+        fit within the budget. data is already in memory, so this caps the
+        intermediates, not the input.
+
+        :param data: Input of the compute step. - DataFrame.
+
+        :return: chunks: 1 when data fits in one pass. - Int.
+        """
+        if not self.enabled:
+            return 1
+
+        working_set = estimate_frame_bytes(data) * (1 + COMPUTE_FACTOR)
+        return max(1, math.ceil(working_set / self.budget))
+
+
+def estimate_frame_bytes(data):
+    """
+    Estimates the memory data takes from its schema. Fixed width columns take
+    their item size per row, and object columns the mean deep size of a sample of
+    their values, which is much cheaper than measuring every string.
+
+    :param data: Data to estimate the size of. - DataFrame.
+
+    :return: Estimated size in bytes. - Int.
+    """
+    rows = len(data)
+    if rows == 0:
+        return 0
+
+    sample = data.iloc[np.linspace(0, rows - 1, min(rows, SAMPLE_ROWS)).astype(int)]
+    row_bytes = 0
+    for column, dtype in data.dtypes.items():
+        if dtype == object:
+            row_bytes += sample[column].memory_usage(deep=True, index=False) / \
+                len(sample)
+        else:
+            row_bytes += data[column].memory_usage(index=False) / rows
+
+    return int(row_bytes * rows)
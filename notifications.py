@@ -0,0 +1,74 @@
+import queue
+import threading
+
+
+class NotificationDispatcher:
+    """
+    Sends SNS and BPM notifications from a background thread so that their network
+    round trips overlap with compute. A single thread sends them in the order they
+    were submitted, and stops sending once one fails, as a synchronous run would.
+    When disabled, every notification is sent as soon as it is submitted.
+    """
+
+    def __init__(self, logger, enabled=False):
+        self.logger = logger
+        self.enabled = enabled
+        self._errors = []
+        self._queue = queue.Queue()
+        self._thread = None
+
+    def submit(self, func, *args, **kwargs):
+        """
+        Sends a notification, or queues it for the background thread.
+
+        :param func: Sending function. e.g. aws_functions.send_sns_message - Function.
+        :param args: Arguments of func.
+        :param kwargs: Keyword arguments of func.
+
+        :return: None
+        """
+        if not self.enabled:
+            self._log(func(*args, **kwargs))
+            return
+
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+        self._queue.put((func, args, kwargs))
+
+    def flush(self, raise_errors=True):
+        """
+        Waits until every queued notification has been sent. Must be called before
+        the handler returns, as Lambda freezes background threads between
+        invocations.
+
+        :param raise_errors: Raise the first error hit while sending. - Bool.
+
+        :return: None
+        """
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+
+        errors, self._errors = self._errors, []
+        if errors and raise_errors:
+            raise errors[0]
+
+    def _log(self, response):
+        if response is not None:
+            self.logger.info(response)
+
+    def _run(self):
+        while True:
+            notification = self._queue.get()
+            if notification is None:
+                return
+            if self._errors:
+                continue
+
+            func, args, kwargs = notification
+            try:
+                self._log(func(*args, **kwargs))
+            except Exception as e:
+                self._errors.append(e)
@@ -0,0 +1,167 @@
+import logging
+import multiprocessing
+import os
+import tempfile
+import threading
+
+import numpy as np
+import pandas as pd
+
+# Inputs are not split into partitions smaller than this, so that small inputs
+# are never worth the cost of starting workers and run in process instead.
+MINIMUM_PARTITION_ROWS = 10000
+
+# Chunk results are spilled here while the remaining chunks are computed.
+SPILL_DIRECTORY = "/tmp"
+
+# Partitions hash the keys with the pandas default key. Chunks use another key, so
+# that the rows of a chunk still spread across every partition.
+PARTITION_HASH_KEY = "0123456789123456"
+CHUNK_HASH_KEY = "es-aggregation-c"
+
+
+def available_workers():
+    """
+    Counts the CPUs this process may run on. Lambda allocates vCPUs in proportion
+    to the memory setting.
+
+    :return: workers: Number of usable CPUs. - Int.
+    """
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def apply_partitioned(func, data, keys=None, workers=1, chunks=1):
+    """
+    Applies func to partitions of data in parallel worker processes and
+    concatenates the results in partition order.
+    With keys, rows are partitioned by a hash of the key columns so that every
+    group lands in a single partition, making any groupby inside func exact.
+    Without keys, data is split into contiguous blocks of rows.
+
+    Workers are forked, so they read data through copy-on-write memory rather than
+    receiving a pickled copy; only the results are sent back, over a pipe. Lambda
+    provides no /dev/shm, which rules out multiprocessing pools and queues.
+    A fork copies only the calling thread, so a lock another thread holds, such as
+    a logging or connection pool lock held by the notification dispatcher or the
+    sampling profiler, stays locked in the workers forever. While any other thread
+    is running, func is run in process instead.
+
+    With several chunks, data is first split the same way into chunks that are
+    processed one after another, each across the workers, to bound the memory
+    func's intermediates take. See apply_chunked.
+
+    :param func: Takes a partition and returns a DataFrame or Series. - Function.
+    :param data: Data to partition. - DataFrame.
+    :param keys: Columns identifying a group. - List.
+    :param workers: Maximum number of worker processes. - Int.
+    :param chunks: Number of chunks to process in turn. - Int.
+
+    :return: Concatenated results of func. - DataFrame.
+    """
+    if chunks > 1:
+        return apply_chunked(
+            lambda chunk: apply_partitioned(func, chunk, keys, workers), data, keys,
+            chunks)
+
+    partitions = min(workers, len(data) // MINIMUM_PARTITION_ROWS)
+    if partitions <= 1 or "fork" not in multiprocessing.get_all_start_methods():
+        return func(data)
+    if threading.active_count() > 1:
+        logging.getLogger().info(
+            f"Running in process rather than across {partitions} workers, as "
+            f"{threading.active_count() - 1} other threads are running.")
+        return func(data)
+
+    labels = partition_labels(data, keys, partitions)
+
+    # Partitions left empty by the hash are skipped, as func may not handle them.
+    context = multiprocessing.get_context("fork")
+    running = []
+    for partition in np.flatnonzero(np.bincount(labels, minlength=partitions)):
+        receiver, sender = context.Pipe(duplex=False)
+        process = context.Process(target=_run_partition,
+                                  args=(func, data, labels, partition, sender))
+        process.start()
+        sender.close()
+        running.append((process, receiver))
+
+    results = []
+    errors = []
+    for process, receiver in running:
+        try:
+            success, result = receiver.recv()
+        except EOFError:
+            success, result = False, f"Worker exited with code {process.exitcode}."
+        receiver.close()
+        process.join()
+        if success:
+            results.append(result)
+        else:
+            errors.append(result)
+
+    if errors:
+        raise RuntimeError(f"Parallel partition failed: {errors[0]}")
+
+    return pd.concat(results)
+
+
+def apply_chunked(func, data, keys=None, chunks=1):
+    """
+    Applies func to chunks of data one after another and concatenates the results
+    in chunk order, splitting rows as apply_partitioned does. Each result is
+    spilled to disk as its chunk finishes, so only one chunk's intermediates are
+    held in memory at a time, alongside the input.
+
+    :param func: Takes a chunk and returns a DataFrame or Series. - Function.
+    :param data: Data to chunk. - DataFrame.
+    :param keys: Columns identifying a group. - List.
+    :param chunks: Number of chunks. - Int.
+
+    :return: Concatenated results of func. - DataFrame.
+    """
+    chunks = min(chunks, len(data))
+    if chunks <= 1:
+        return func(data)
+
+    labels = partition_labels(data, keys, chunks, CHUNK_HASH_KEY)
+    with tempfile.TemporaryDirectory(dir=SPILL_DIRECTORY) as spill_directory:
+        spilled = []
+        for chunk in np.flatnonzero(np.bincount(labels, minlength=chunks)):
+            path = os.path.join(spill_directory, f"{chunk}.pkl")
+            func(data.take(np.flatnonzero(labels == chunk))).to_pickle(path)
+            spilled.append(path)
+
+        return pd.concat([pd.read_pickle(path) for path in spilled])
+
+
+def partition_labels(data, keys, partitions, hash_key=PARTITION_HASH_KEY):
+    """
+    Assigns each row of data to one of partitions. With keys, rows are assigned by
+    a hash of the key columns, so that every group lands in a single partition.
+    Without keys, data is split into contiguous blocks of rows.
+
+    :param data: Data to partition. - DataFrame.
+    :param keys: Columns identifying a group. - List.
+    :param partitions: Number of partitions. - Int.
+    :param hash_key: Key of the hash, for a different assignment. - String.
+
+    :return: labels: The partition of each row. - Array.
+    """
+    if keys:
+        hashes = pd.util.hash_pandas_object(data[keys], index=False,
+                                            hash_key=hash_key).values
+        return (hashes % partitions).astype(np.int64)
+
+    return np.arange(len(data)) * partitions // len(data)
+
+
+def _run_partition(func, data, labels, partition, sender):
+    try:
+        sender.send((True, func(data.take(np.flatnonzero(labels == partition)))))
+    except Exception as e:
+        sender.send((False, repr(e)))
+    finally:
+        sender.close()
@@ -0,0 +1,422 @@
+import argparse
+import importlib
+import io
+import json
+import os
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from unittest import mock
+
+import boto3
+import pandas as pd
+from botocore.response import StreamingBody
+from moto import mock_s3, mock_sns, mock_sqs
+
+from storage import MEMORY_STORE, STORAGE_DIRECTORY, open_storage
+
+REGION = "eu-west-2"
+
+# Environment shared by every handler. Lambda invokes are routed by step rather
+# than by function name, so method_name only needs to be present.
+LOCAL_ENVIRONMENT = {
+    "AWS_ACCESS_KEY_ID": "testing",
+    "AWS_DEFAULT_REGION": REGION,
+    "AWS_SECRET_ACCESS_KEY": "testing",
+    "method_name": "local",
+    "run_environment": "local"
+}
+
+# handler and method are module names. method is None for a handler that invokes
+# no method, such as the combiner.
+Step = namedtuple("Step", ["name", "handler", "method", "runtime_variables",
+                           "depends_on"])
+
+
+class LocalContext:
+    """
+    Stand-in for the Lambda context object.
+    """
+
+    def __init__(self, function_name, memory_limit_in_mb=1024):
+        self.aws_request_id = "local"
+        self.function_name = function_name
+        self.memory_limit_in_mb = memory_limit_in_mb
+
+    def get_remaining_time_in_millis(self):
+        return 900000
+
+
+class LocalLambda:
+    """
+    Stand-in for the Lambda client that runs a method handler in process.
+    """
+
+    def __init__(self, handler, context):
+        self.handler = handler
+        self.context = context
+
+    def invoke(self, FunctionName, Payload, **kwargs):  # noqa: N803
+        response = json.dumps(self.handler(json.loads(Payload), self.context))
+        body = response.encode("utf-8")
+
+        return {"Payload": StreamingBody(io.BytesIO(body), len(body)),
+                "StatusCode": 200}
+
+
+class PipelineRunner:
+    """
+    Runs the aggregation handlers locally as a DAG of steps, starting each step as
+    soon as the steps it depends on have succeeded, so independent aggregations
+    run concurrently. S3, SNS and SQS (BPM) are backed by moto and each wrangler's
+    Lambda client invokes its method in process.
+
+    Steps share the process, so concurrent steps contend for the GIL and CPUs.
+    Running with concurrent=False gives uncontended step timings, from which the
+    critical path shows the end to end time with each step on its own Lambda.
+    With a concurrency limit, at most that many steps run at once, across every
+    pipeline executed, and the time a step waits for a slot is its queueing time.
+    """
+
+    def __init__(self, steps, bucket_name="local-bucket", environment=None,
+                 concurrent=True, memory_limit_in_mb=1024, concurrency=0):
+        """
+        :param steps: Steps of the pipeline. - List of Step.
+        :param bucket_name: Name of the local bucket. - String.
+        :param environment: Extra environment variables for every handler. - Dict.
+        :param concurrent: Run independent steps at the same time. - Bool.
+        :param memory_limit_in_mb: Memory limit reported by the context. - Int.
+        :param concurrency: Most steps to run at once, unlimited when 0. - Int.
+        """
+        self.steps = order_steps(steps)
+        self.bucket_name = bucket_name
+        self.environment = {**LOCAL_ENVIRONMENT, "bucket_name": bucket_name}
+        self.environment.update({key: str(value) for key, value in
+                                 (environment or {}).items()})
+        self.concurrent = concurrent
+        self.memory_limit_in_mb = memory_limit_in_mb
+        self.slots = threading.BoundedSemaphore(concurrency) if concurrency else None
+        self._local = threading.local()
+        self._client = boto3.client
+
+    def run(self, input_files, output_directory=None):
+        """
+        Uploads the inputs, runs every step and reports the timings.
+
+        :param input_files: Contents of each input, keyed on file name. - Dict.
+        :param output_directory: Directory to download every output to. - String.
+
+        :return: report: Wall time, per step timings and the critical path. - Dict.
+        """
+        storage_backend = self.environment.get("storage_backend", "s3")
+
+        with self.stand_ins(input_files) as (topic_arn, queue_url):
+            started = time.perf_counter()
+            timings = self.execute(self.steps, topic_arn, queue_url, started)
+            wall_seconds = time.perf_counter() - started
+
+            sqs = boto3.client("sqs", region_name=REGION)
+            bpm_messages = int(sqs.get_queue_attributes(
+                QueueUrl=queue_url, AttributeNames=["ApproximateNumberOfMessages"]
+            )["Attributes"]["ApproximateNumberOfMessages"])
+
+            if output_directory and storage_backend == "s3":
+                s3 = boto3.client("s3", region_name=REGION)
+                download_outputs(s3, self.bucket_name, output_directory,
+                                 exclude=input_files)
+            elif output_directory and storage_backend == "memory":
+                save_memory_outputs(self.bucket_name, output_directory,
+                                    exclude=input_files)
+
+        path, path_seconds = critical_path(self.steps, timings)
+
+        return {
+            "bpm_messages": bpm_messages,
+            "critical_path": path,
+            "critical_path_seconds": path_seconds,
+            "steps": timings,
+            "success": all(timing["status"] == "success"
+                           for timing in timings.values()),
+            "wall_seconds": wall_seconds
+        }
+
+    @contextmanager
+    def stand_ins(self, input_files):
+        """
+        Starts the local stand-ins for S3, SNS, SQS and Lambda, with the handlers'
+        environment set, and uploads the inputs.
+
+        :param input_files: Contents of each input, keyed on file name. - Dict.
+
+        :return: topic_arn: ARN of the local SNS topic. - String.
+                 queue_url: URL of the local BPM queue. - String.
+        """
+        storage = open_storage(self.environment.get("storage_backend", "s3"),
+                               self.environment.get("storage_directory",
+                                                    STORAGE_DIRECTORY))
+        MEMORY_STORE.clear()
+
+        # Newer botocore sends checksummed parts aws-chunked encoded, which moto may
+        # store as is, so checksums are only sent where the operation requires one.
+        environment = dict(self.environment,
+                           AWS_REQUEST_CHECKSUM_CALCULATION="when_required")
+        with mock_s3(), mock_sns(), mock_sqs(), \
+                mock.patch.dict(os.environ, environment), \
+                mock.patch("boto3.client", side_effect=self._route):
+            s3 = boto3.client("s3", region_name=REGION)
+            s3.create_bucket(Bucket=self.bucket_name,
+                             CreateBucketConfiguration={"LocationConstraint": REGION})
+            for file_name, content in input_files.items():
+                storage.save(self.bucket_name, file_name, content)
+
+            topic_arn = boto3.client("sns", region_name=REGION).create_topic(
+                Name="local-topic")["TopicArn"]
+            queue_url = boto3.client("sqs", region_name=REGION).create_queue(
+                QueueName="local-bpm")["QueueUrl"]
+
+            yield topic_arn, queue_url
+
+    def execute(self, steps, topic_arn, queue_url, started):
+        """
+        Runs steps as a DAG within the stand-ins. Several pipelines can be executed
+        at once, sharing the stand-ins and the concurrency limit.
+
+        :param steps: Steps in dependency order. - List of Step.
+        :param topic_arn: ARN of the SNS topic. - String.
+        :param queue_url: URL of the BPM queue. - String.
+        :param started: perf_counter time the timings are relative to. - Float.
+
+        :return: timings: Timing of each step, keyed on step name. - Dict.
+        """
+        pending = list(steps)
+        running = {}
+        timings = {}
+        workers = len(steps) if self.concurrent else 1
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            while pending or running:
+                for step in list(pending):
+                    if len(running) >= workers:
+                        break
+                    if any(dependency not in timings for dependency in step.depends_on):
+                        continue
+                    pending.remove(step)
+                    if any(timings[dependency]["status"] != "success"
+                           for dependency in step.depends_on):
+                        timings[step.name] = {"end": 0.0, "error": None, "queued": 0.0,
+                                              "seconds": 0.0, "start": 0.0,
+                                              "status": "skipped"}
+                        continue
+                    future = executor.submit(self._run_step, step, topic_arn,
+                                             queue_url, started)
+                    running[future] = step.name
+
+                if running:
+                    done, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        timings[running.pop(future)] = future.result()
+
+        return timings
+
+    def _route(self, service, *args, **kwargs):
+        if service == "lambda":
+            return self._local.lambda_client
+        return self._client(service, *args, **kwargs)
+
+    def _run_step(self, step, topic_arn, queue_url, started):
+        runtime_variables = dict(step.runtime_variables)
+        runtime_variables.setdefault("bpm_queue_url", queue_url)
+        runtime_variables.setdefault("sns_topic_arn", topic_arn)
+
+        if step.method:
+            self._local.lambda_client = LocalLambda(
+                importlib.import_module(step.method).lambda_handler,
+                LocalContext(step.method, self.memory_limit_in_mb))
+        handler = importlib.import_module(step.handler).lambda_handler
+        context = LocalContext(step.handler, self.memory_limit_in_mb)
+
+        ready = time.perf_counter()
+        if self.slots:
+            self.slots.acquire()
+        start = time.perf_counter()
+        try:
+            response = handler({"RuntimeVariables": runtime_variables}, context)
+            status = "success" if response and response.get("success") else "failed"
+            error = None if status == "success" else response
+        except Exception as e:
+            status = "failed"
+            error = repr(e)
+        finally:
+            if self.slots:
+                self.slots.release()
+        end = time.perf_counter()
+
+        return {"end": end - started, "error": error, "queued": start - ready,
+                "seconds": end - start, "start": start - started, "status": status}
+
+
+def critical_path(steps, timings):
+    """
+    Finds the chain of dependent steps with the longest total run time, which
+    bounds the end to end time however many steps run at once.
+
+    :param steps: Steps in dependency order. - List of Step.
+    :param timings: Timing of each step, keyed on step name. - Dict.
+
+    :return: path: Names of the steps on the critical path. - List.
+             seconds: Total run time of the critical path. - Float.
+    """
+    finish = {}
+    previous = {}
+    for step in steps:
+        before = max(step.depends_on, key=finish.get, default=None)
+        previous[step.name] = before
+        finish[step.name] = timings[step.name]["seconds"] + finish.get(before, 0.0)
+
+    name = max(finish, key=finish.get)
+    seconds = finish[name]
+    path = []
+    while name is not None:
+        path.insert(0, name)
+        name = previous[name]
+
+    return path, seconds
+
+
+def download_outputs(s3, bucket_name, output_directory, exclude=()):
+    """
+    Downloads every object in the bucket other than the excluded ones.
+
+    :param s3: S3 client. - Client.
+    :param bucket_name: Name of the bucket. - String.
+    :param output_directory: Directory to download to. - String.
+    :param exclude: Keys not to download. - Collection.
+
+    :return: None
+    """
+    os.makedirs(output_directory, exist_ok=True)
+    paginator = s3.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket_name):
+        for entry in page.get("Contents", []):
+            if entry["Key"] not in exclude:
+                s3.download_file(bucket_name, entry["Key"],
+                                 os.path.join(output_directory, entry["Key"]))
+
+
+def save_memory_outputs(bucket_name, output_directory, exclude=()):
+    """
+    Saves every dataframe the memory storage backend holds for the bucket, other
+    than the excluded ones, as JSON.
+
+    :param bucket_name: Name of the bucket. - String.
+    :param output_directory: Directory to save to. - String.
+    :param exclude: Keys not to save. - Collection.
+
+    :return: None
+    """
+    os.makedirs(output_directory, exist_ok=True)
+    for (store_bucket, key), data in MEMORY_STORE.items():
+        if store_bucket == bucket_name and key not in exclude:
+            data.to_json(os.path.join(output_directory, key), orient="records")
+
+
+def order_steps(steps):
+    """
+    Orders steps so that every step follows the steps it depends on.
+
+    :param steps: Steps of the pipeline. - List of Step.
+
+    :return: ordered: Steps in dependency order. - List of Step.
+    """
+    names = {step.name for step in steps}
+    for step in steps:
+        unknown = set(step.depends_on) - names
+        if unknown:
+            raise ValueError(f"Step {step.name} depends on unknown steps {unknown}.")
+
+    ordered = []
+    placed = set()
+    while len(ordered) < len(steps):
+        ready = [step for step in steps if step.name not in placed and
+                 set(step.depends_on) <= placed]
+        if not ready:
+            raise ValueError("Pipeline steps have a dependency cycle.")
+        ordered.extend(ready)
+        placed.update(step.name for step in ready)
+
+    return ordered
+
+
+def scale_frame(data, factor, id_columns):
+    """
+    Builds a larger synthetic input by repeating data factor times. Each copy is
+    given its own identifiers, so the copies are separate contributors within the
+    same groups.
+
+    :param data: Input to scale. - DataFrame.
+    :param factor: Number of copies. - Int.
+    :param id_columns: Columns identifying a contributor. - List.
+
+    :return: scaled: The scaled input. - DataFrame.
+    """
+    copies = []
+    for copy in range(factor):
+        frame = data.copy()
+        for column in id_columns:
+            if pd.api.types.is_integer_dtype(frame[column]):
+                frame[column] = frame[column] * factor + copy
+            else:
+                frame[column] = frame[column].astype(str) + f"_{copy}"
+        copies.append(frame)
+
+    return pd.concat(copies, ignore_index=True)
+
+
+def load_steps(config):
+    """
+    Builds steps from a pipeline config.
+
+    :param config: Pipeline config with a "steps" list, each step holding a name,
+                   handler, optional method and depends_on, and its
+                   RuntimeVariables. - Dict.
+
+    :return: steps: Steps of the pipeline. - List of Step.
+    """
+    return [Step(step["name"], step["handler"], step.get("method"),
+                 step["RuntimeVariables"], step.get("depends_on", []))
+            for step in config["steps"]]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Run the aggregation pipeline locally and report timings.")
+    parser.add_argument("config", help="Pipeline config JSON file.")
+    parser.add_argument("--output-directory", help="Directory to save outputs to.")
+    parser.add_argument("--scale", type=int, default=1,
+                        help="Repeat every input this many times.")
+    parser.add_argument("--scale-columns", nargs="*", default=[],
+                        help="Contributor identifier columns made unique per copy.")
+    parser.add_argument("--sequential", action="store_true",
+                        help="Run one step at a time for uncontended timings.")
+    arguments = parser.parse_args()
+
+    with open(arguments.config, "r") as config_file:
+        pipeline_config = json.load(config_file)
+
+    inputs = {}
+    for key, path in pipeline_config["inputs"].items():
+        with open(path, "r") as input_file:
+            content = input_file.read()
+        if arguments.scale > 1:
+            content = scale_frame(pd.DataFrame(json.loads(content)), arguments.scale,
+                                  arguments.scale_columns).to_json(orient="records")
+        inputs[key] = content
+
+    runner = PipelineRunner(load_steps(pipeline_config),
+                            environment=pipeline_config.get("environment"),
+                            concurrent=not arguments.sequential)
+    report = runner.run(inputs, arguments.output_directory)
+    print(json.dumps(report, indent=4, default=str))
+    raise SystemExit(0 if report["success"] else 1)
@@ -0,0 +1,204 @@
+import cProfile
+import functools
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from collections import Counter
+
+import boto3
+
+PROFILERS = ["cprofile", "sampling"]
+
+# Where profiles are written when profile_location is not set.
+PROFILE_LOCATION = "/tmp/profiles"
+
+# Seconds between samples of the sampling profiler.
+SAMPLE_INTERVAL = 0.005
+
+
+class SamplingProfiler:
+    """
+    Samples the call stack of a single thread every interval seconds from a
+    background thread, counting how often each stack is seen. The thread being
+    profiled is never paused or traced, so the overhead is the cost of walking its
+    stack at each sample, whatever the code being run.
+    """
+
+    def __init__(self, interval=SAMPLE_INTERVAL, thread_id=None):
+        """
+        :param interval: Seconds between samples. - Float.
+        :param thread_id: Ident of the thread to sample, defaults to the
+                          current thread. - Int.
+        """
+        self.interval = interval
+        self.thread_id = thread_id or threading.get_ident()
+        self.stacks = Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._sampler = None
+
+    def start(self):
+        self._sampler = threading.Thread(target=self._sample, daemon=True)
+        self._sampler.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._sampler is not None:
+            self._sampler.join()
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(frame_name(frame))
+                frame = frame.f_back
+            self.stacks[";".join(reversed(stack))] += 1
+            self.samples += 1
+
+    def folded(self):
+        """
+        The samples in the folded stack format read by flamegraph.pl, speedscope
+        and most flame graph tools: one line per distinct stack, outermost frame
+        first, frames separated by semicolons, then the number of samples.
+
+        :return: Folded stacks. - String.
+        """
+        return "".join(f"{stack} {count}\n" for stack, count
+                       in sorted(self.stacks.items()))
+
+
+def frame_name(frame):
+    """
+    :param frame: Stack frame. - Frame.
+    :return: Function name, file and line it is defined on. - String.
+    """
+    code = frame.f_code
+    file_name = os.path.basename(code.co_filename)
+    return f"{code.co_name} ({file_name}:{code.co_firstlineno})".replace(";", ":")
+
+
+def profiling_settings(event):
+    """
+    Whether and how to profile an invocation. Profiling is enabled by the
+    profiling_enabled runtime variable, or for every invocation by the
+    profiling_enabled environment variable. The profiler, profile_location and
+    profile_interval environment variables configure it. An unknown profiler is
+    logged and the invocation runs unprofiled, rather than failing it.
+
+    :param event: Event the handler was invoked with. - Dict.
+    :return: Settings, or None when not profiling. - Dict.
+    """
+    runtime_variables = event.get("RuntimeVariables", {}) \
+        if isinstance(event, dict) else {}
+    enabled = runtime_variables.get("profiling_enabled") is True or \
+        os.environ.get("profiling_enabled", "").lower() == "true"
+    if not enabled:
+        return None
+
+    profiler = os.environ.get("profiler", "sampling")
+    if profiler not in PROFILERS:
+        logging.getLogger().warning(
+            f"Not profiling, unknown profiler {profiler}, expected one of {PROFILERS}")
+        return None
+
+    return {
+        "interval": float(os.environ.get("profile_interval", SAMPLE_INTERVAL)),
+        "location": os.environ.get("profile_location", PROFILE_LOCATION),
+        "profiler": profiler,
+        "run_id": runtime_variables.get("run_id", 0)
+    }
+
+
+def profile_name(location, module, run_id, extension):
+    """
+    Name of a profile, tagged with the module and run_id. The time it was written
+    and a random suffix keep repeated invocations in the same run apart.
+
+    :param location: S3 prefix, as s3://bucket/prefix, or a local directory. - String.
+    :param module: Module of the profiled handler. - String.
+    :param run_id: run_id of the invocation. - String.
+    :param extension: File extension of the profile. - String.
+    :return: Location the profile is written to. - String.
+    """
+    file_name = f"{run_id}-{time.strftime('%Y%m%dT%H%M%S')}-{uuid.uuid4().hex[:8]}" \
+        f".{extension}"
+    return "/".join([location.rstrip("/"), module, file_name])
+
+
+def write_object(name, content):
+    """
+    Writes to S3 or the local filesystem, depending on the name.
+
+    :param name: S3 URL, as s3://bucket/key, or a local path. - String.
+    :param content: Content to write. - Bytes.
+    :return: None
+    """
+    if name.startswith("s3://"):
+        bucket_name, key = name[len("s3://"):].split("/", 1)
+        boto3.client("s3", region_name="eu-west-2").put_object(
+            Body=content, Bucket=bucket_name, Key=key)
+        return
+
+    os.makedirs(os.path.dirname(name), exist_ok=True)
+    with open(name, "wb") as file:
+        file.write(content)
+
+
+def profiled(handler):
+    """
+    Wraps a lambda_handler so an invocation can be profiled on demand, without
+    redeploying. The sampling profiler writes folded stacks, for a flame graph.
+    cProfile writes pstats data, which is exact but slows the handler down, and is
+    read with pstats, snakeviz or flameprof.
+
+    The profile is written when the handler returns or raises, and a profile that
+    cannot be written is logged without failing the invocation.
+    When not profiling, the handler is called directly.
+
+    :param handler: lambda_handler to wrap. - Function.
+    :return: Wrapped handler. - Function.
+    """
+    module = handler.__module__
+
+    @functools.wraps(handler)
+    def wrapper(event, context):
+        settings = profiling_settings(event)
+        if settings is None:
+            return handler(event, context)
+
+        if settings["profiler"] == "sampling":
+            profiler = SamplingProfiler(settings["interval"])
+            profiler.start()
+        else:
+            profiler = cProfile.Profile()
+            profiler.enable()
+
+        try:
+            return handler(event, context)
+        finally:
+            try:
+                if settings["profiler"] == "sampling":
+                    profiler.stop()
+                    name = profile_name(settings["location"], module,
+                                        settings["run_id"], "folded")
+                    content = profiler.folded().encode("utf-8")
+                else:
+                    profiler.disable()
+                    name = profile_name(settings["location"], module,
+                                        settings["run_id"], "prof")
+                    with tempfile.NamedTemporaryFile(suffix=".prof") as file:
+                        profiler.dump_stats(file.name)
+                        content = file.read()
+                write_object(name, content)
+                logging.getLogger().info(f"Wrote profile to {name}")
+            except Exception as e:
+                logging.getLogger().warning(f"Could not write profile: {e}")
+
+    return wrapper
@@ -0,0 +1,159 @@
+import argparse
+import json
+import logging
+import os
+
+from pipeline_runner import PipelineRunner, Step
+from result_cache import object_key
+
+# Method each wrangler invokes. The splitter's regionless method lives in another
+# repository, so it is given on the command line.
+METHODS = {
+    "aggregation_column_wrangler": "aggregation_column_method",
+    "aggregation_top2_wrangler": "aggregation_top2_method"
+}
+SPLITTER = "aggregation_bricks_splitter_wrangler"
+
+# Environment the runner sets itself, to point the handlers at the stand-ins.
+RUNNER_ENVIRONMENT = {"bucket_name", "method_name", "run_environment"}
+
+
+class MetricCollector(logging.Handler):
+    """
+    Collects the embedded metric format lines the instrumentation writes.
+    """
+
+    def __init__(self):
+        super().__init__(logging.INFO)
+        self.metrics = []
+
+    def emit(self, record):
+        message = record.getMessage()
+        if not message.startswith("{"):
+            return
+        try:
+            line = json.loads(message)
+        except ValueError:
+            return
+        if isinstance(line, dict) and "_aws" in line:
+            self.metrics.append({key: value for key, value in line.items()
+                                 if key != "_aws"})
+
+
+def load_captures(directory):
+    """
+    Finds every capture under a directory, such as a capture_location synced
+    down from S3.
+
+    :param directory: Directory to search. - String.
+    :return: captures: Directory and record of each capture, in path order.
+                       - List of tuples.
+    """
+    captures = []
+    for root, _, files in sorted(os.walk(directory)):
+        if "capture.json" in files:
+            with open(os.path.join(root, "capture.json"), "r") as capture_file:
+                captures.append((root, json.load(capture_file)))
+
+    return captures
+
+
+def replay(capture_directory, capture, splitter_method=None):
+    """
+    Replays a captured invocation through the local pipeline runner, against
+    moto S3, SNS and SQS, with instrumentation enabled. The captured input copies
+    are uploaded first, and a wrangler invokes its method in process.
+
+    :param capture_directory: Directory holding the capture. - String.
+    :param capture: The capture record. - Dict.
+    :param splitter_method: Module of the splitter's regionless method. - String.
+    :return: result: Captured and replayed seconds, status and the metrics of
+                     every handler run. - Dict.
+    """
+    module = capture["module"]
+    result = {"captured_seconds": capture["seconds"], "error": None, "metrics": [],
+              "module": module, "replayed_seconds": None, "run_id": capture["run_id"],
+              "status": "skipped"}
+
+    method = splitter_method if module == SPLITTER else METHODS.get(module)
+    if module == SPLITTER and not method:
+        result["error"] = "The splitter needs --splitter-method to replay."
+        return result
+
+    runtime_variables = dict(capture["runtime_variables"], capture_enabled=False,
+                             instrumentation_enabled=True)
+    # The runner points these at its own topic and queue.
+    runtime_variables.pop("bpm_queue_url", None)
+    runtime_variables.pop("sns_topic_arn", None)
+
+    inputs = {}
+    for input_name, captured_input in capture["inputs"].items():
+        if captured_input["copy"] is None:
+            result["error"] = f"Input {input_name} was not copied."
+            return result
+        with open(os.path.join(capture_directory, captured_input["copy"]),
+                  "r") as input_file:
+            content = input_file.read()
+        if input_name == "data":
+            runtime_variables["data"] = content
+        else:
+            inputs[object_key(input_name)] = content
+
+    environment = {key: value for key, value in capture["environment"].items()
+                   if key not in RUNNER_ENVIRONMENT}
+    runner = PipelineRunner([Step(module, module, method, runtime_variables, [])],
+                            environment=environment,
+                            memory_limit_in_mb=capture["memory_limit_in_mb"] or 1024)
+
+    collector = MetricCollector()
+    logger = logging.getLogger()
+    level = logger.level
+    logger.addHandler(collector)
+    logger.setLevel(logging.INFO)
+    try:
+        report = runner.run(inputs)
+    finally:
+        logger.removeHandler(collector)
+        logger.setLevel(level)
+
+    step = report["steps"][module]
+    result.update({"error": step["error"], "metrics": collector.metrics,
+                   "replayed_seconds": step["seconds"], "status": step["status"]})
+
+    return result
+
+
+def replay_all(directory, splitter_method=None):
+    """
+    Replays every capture under a directory. A method captured in the same run as
+    its wrangler is replayed by the wrangler, so is not replayed on its own.
+
+    :param directory: Directory holding the captures. - String.
+    :param splitter_method: Module of the splitter's regionless method. - String.
+    :return: results: Result of each capture, from replay. - List.
+    """
+    captures = load_captures(directory)
+    wrangled = {(METHODS[capture["module"]], str(capture["run_id"]))
+                for _, capture in captures if capture["module"] in METHODS}
+
+    results = []
+    for capture_directory, capture in captures:
+        if (capture["module"], str(capture["run_id"])) in wrangled:
+            continue
+        results.append(replay(capture_directory, capture, splitter_method))
+
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Replay captured invocations locally with instrumentation.")
+    parser.add_argument("directory", help="Directory holding the captures.")
+    parser.add_argument("--splitter-method",
+                        help="Module of the splitter's regionless method.")
+    arguments = parser.parse_args()
+
+    replay_results = replay_all(arguments.directory, arguments.splitter_method)
+    print(json.dumps(replay_results, indent=4, default=str))
+    raise SystemExit(0 if all(result["status"] != "failed"
+                              for result in replay_results) else 1)
@@ -0,0 +1,201 @@
+import hashlib
+import json
+import time
+from datetime import datetime, timezone
+
+import boto3
+from botocore.exceptions import ClientError
+
+# Runtime variables left out of cache keys. They either never change a result or
+# name an input file, whose ETag is part of the key instead.
+VOLATILE_PARAMETERS = {
+    "aggregation_files",
+    "async_notifications",
+    "bpm_queue_url",
+    "bypass_cache",
+    "engine",
+    "environment",
+    "in_file_name",
+    "instrumentation_enabled",
+    "memory_fraction",
+    "memory_instrumentation_enabled",
+    "out_file_name",
+    "parallel_enabled",
+    "previous_in_file_name",
+    "previous_out_file_name",
+    "profiling_enabled",
+    "run_id",
+    "sns_topic_arn",
+    "total_steps",
+    "trace_context",
+    "tracemalloc_top",
+    "tracing_enabled"
+}
+
+# Seconds between evictions of the same cache by one container. Eviction lists the
+# whole prefix, so is not repeated on every put.
+EVICTION_INTERVAL = 300
+
+# monotonic time of the last eviction of each bucket and prefix.
+LAST_EVICTIONS = {}
+
+
+class ResultCache:
+    """
+    Content-addressed store of results, kept under a prefix of the bucket.
+    Results are keyed on a hash of their inputs and normalised parameters, expire
+    after ttl seconds and the oldest are evicted once the prefix exceeds max_bytes.
+    Eviction runs at most every EVICTION_INTERVAL seconds in each container, so the
+    prefix may briefly exceed max_bytes. The cache does nothing when prefix is
+    empty.
+    """
+
+    def __init__(self, bucket_name, prefix, ttl, max_bytes=0, bypass=False):
+        self.bucket_name = bucket_name
+        self.prefix = prefix.strip("/")
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.bypass = bypass
+        self.enabled = self.prefix != ""
+        self._client = None
+
+    @property
+    def client(self):
+        if self._client is None:
+            self._client = boto3.client("s3", region_name="eu-west-2")
+        return self._client
+
+    def key(self, namespace, parameters, inputs=()):
+        """
+        Builds the cache key of a result.
+
+        :param namespace: Name of the step producing the result. - String.
+        :param parameters: Runtime variables of the step. - Dict.
+        :param inputs: ETags or content hashes of input files, in order. - List.
+
+        :return: key: Object key the result is stored under. - String.
+        """
+        normalised = {name: value for name, value in parameters.items()
+                      if name not in VOLATILE_PARAMETERS}
+        digest = hashlib.sha256(
+            json.dumps([normalised, inputs], sort_keys=True, default=str)
+            .encode("utf-8")).hexdigest()
+
+        return f"{self.prefix}/{namespace}/{digest}.json"
+
+    def etags(self, file_names):
+        """
+        Looks up the ETags of input files without downloading them.
+
+        :param file_names: Names of files in the bucket. - List.
+
+        :return: etags: ETag per file, in order. - List.
+        """
+        return [self.client.head_object(Bucket=self.bucket_name,
+                                        Key=object_key(file_name))["ETag"]
+                for file_name in file_names]
+
+    def get(self, key):
+        """
+        Fetches a cached result, unless bypassed or expired.
+
+        :param key: Cache key. - String.
+
+        :return: The cached result, or None on a miss. - String.
+        """
+        if not self.enabled or self.bypass:
+            return None
+
+        try:
+            response = self.client.get_object(Bucket=self.bucket_name, Key=key)
+        except ClientError as e:
+            if e.response["Error"]["Code"] in ("404", "NoSuchKey"):
+                return None
+            raise
+
+        if self._expired(response["LastModified"]):
+            response["Body"].close()
+            self.client.delete_object(Bucket=self.bucket_name, Key=key)
+            return None
+
+        return response["Body"].read().decode("utf-8")
+
+    def put(self, key, data):
+        """
+        Stores a result, then evicts expired and surplus entries when an eviction
+        is due.
+
+        :param key: Cache key. - String.
+        :param data: Result to store. - String.
+
+        :return: None
+        """
+        if not self.enabled:
+            return
+
+        self.client.put_object(Bucket=self.bucket_name, Key=key,
+                               Body=data.encode("utf-8"))
+        last_eviction = LAST_EVICTIONS.get((self.bucket_name, self.prefix))
+        if last_eviction is None or \
+                time.monotonic() - last_eviction >= EVICTION_INTERVAL:
+            self.evict()
+
+    def evict(self):
+        """
+        Deletes expired entries, then the least recently written entries until the
+        prefix fits within max_bytes.
+
+        :return: evicted: Number of entries deleted. - Int.
+        """
+        LAST_EVICTIONS[(self.bucket_name, self.prefix)] = time.monotonic()
+        entries = []
+        paginator = self.client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.bucket_name,
+                                       Prefix=self.prefix + "/"):
+            entries.extend(page.get("Contents", []))
+
+        entries.sort(key=lambda entry: entry["LastModified"])
+        total_bytes = sum(entry["Size"] for entry in entries)
+        evicted = []
+        for entry in entries:
+            if not self._expired(entry["LastModified"]) and \
+                    (self.max_bytes <= 0 or total_bytes <= self.max_bytes):
+                continue
+            evicted.append({"Key": entry["Key"]})
+            total_bytes -= entry["Size"]
+
+        # DeleteObjects accepts at most 1000 keys per request.
+        for start in range(0, len(evicted), 1000):
+            self.client.delete_objects(
+                Bucket=self.bucket_name,
+                Delete={"Objects": evicted[start:start + 1000], "Quiet": True})
+
+        return len(evicted)
+
+    def _expired(self, last_modified):
+        age = (datetime.now(timezone.utc) - last_modified).total_seconds()
+        return self.ttl > 0 and age > self.ttl
+
+
+def content_hash(data):
+    """
+    Hashes content that has no ETag, such as a payload built in memory.
+
+    :param data: Content to hash. - String.
+
+    :return: Hex digest. - String.
+    """
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+
+def object_key(file_name):
+    """
+    Resolves a file name to its object key the same way aws_functions does.
+
+    :param file_name: Name of a file in the bucket. - String.
+
+    :return: Object key. - String.
+    """
+    if not file_name.endswith(".json"):
+        return file_name + ".json"
+    return file_name
@@ -0,0 +1,353 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+from es_aws_functions import aws_functions
+
+from json_layout import decode_frame, encode_frame
+from local_cache import LocalCache
+from result_cache import content_hash, object_key
+from transfer import Transfer
+
+STORAGE_BACKENDS = ["local", "memory", "s3"]
+
+# Default root of the local backend.
+STORAGE_DIRECTORY = "/tmp/storage"
+
+# Shared by every MemoryStorage in the process, so that stages run in the same
+# process hand their outputs to each other.
+MEMORY_STORE = {}
+
+# Columns of the manifest a partitioned file is stored as.
+MANIFEST_COLUMNS = ["partition", "file_name", "rows", "digest"]
+
+
+class S3Storage:
+    """
+    Stores files as JSON objects in S3, the deployed behaviour. Reads go through
+    the local data cache and both reads and writes through the transfer layer.
+    Files are written and read in json_layout.
+    """
+
+    in_memory = False
+    partitioned = False
+
+    def __init__(self, transfer=None, local_cache=None, json_layout="records"):
+        self.transfer = transfer or Transfer(json_layout=json_layout)
+        self.local_cache = local_cache or LocalCache(
+            0, read_dataframe=self.transfer.read_dataframe)
+        self.json_layout = json_layout
+
+    def delete(self, bucket_name, file_name):
+        return aws_functions.delete_data(bucket_name, file_name)
+
+    def encode(self, data):
+        return encode_frame(data, self.json_layout)
+
+    def read_dataframe(self, bucket_name, file_name):
+        return self.local_cache.read_dataframe(bucket_name, file_name)
+
+    def save(self, bucket_name, file_name, data):
+        self.transfer.save_to_s3(bucket_name, file_name, data)
+
+    def size(self, bucket_name, file_name):
+        return self.transfer.client.head_object(
+            Bucket=bucket_name, Key=object_key(file_name))["ContentLength"]
+
+
+class LocalStorage:
+    """
+    Stores files as JSON on the local filesystem, one directory per bucket.
+    Files are written in json_layout, and read in either layout.
+    """
+
+    in_memory = False
+    partitioned = False
+
+    def __init__(self, directory, json_layout="records"):
+        self.directory = directory
+        self.json_layout = json_layout
+
+    def delete(self, bucket_name, file_name):
+        os.remove(self.path(bucket_name, file_name))
+        return f"Deleted {file_name} from {bucket_name}."
+
+    def encode(self, data):
+        return encode_frame(data, self.json_layout)
+
+    def path(self, bucket_name, file_name):
+        return os.path.join(self.directory, bucket_name, object_key(file_name))
+
+    def read_dataframe(self, bucket_name, file_name):
+        with open(self.path(bucket_name, file_name), "r") as storage_file:
+            return decode_frame(storage_file.read())
+
+    def save(self, bucket_name, file_name, data):
+        path = self.path(bucket_name, file_name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as storage_file:
+            storage_file.write(data)
+
+    def size(self, bucket_name, file_name):
+        return os.path.getsize(self.path(bucket_name, file_name))
+
+
+class MemoryStorage:
+    """
+    Keeps files as dataframes in process memory, so stages in the same process
+    hand their outputs to each other with no serialisation. Handlers modify the
+    dataframes they read, so every read returns its own copy. That costs a memory
+    copy, which is far cheaper than encoding and parsing JSON.
+    """
+
+    in_memory = True
+    partitioned = False
+
+    def __init__(self, store=None):
+        self.store = MEMORY_STORE if store is None else store
+
+    def delete(self, bucket_name, file_name):
+        del self.store[(bucket_name, object_key(file_name))]
+        return f"Deleted {file_name} from {bucket_name}."
+
+    def encode(self, data):
+        return data
+
+    def read_dataframe(self, bucket_name, file_name):
+        return self.store[(bucket_name, object_key(file_name))].copy()
+
+    def save(self, bucket_name, file_name, data):
+        # Method outputs arrive as JSON and are parsed once here, in place of the
+        # parse the next stage would do on reading them.
+        if isinstance(data, str):
+            data = decode_frame(data)
+        self.store[(bucket_name, object_key(file_name))] = data
+
+    def size(self, bucket_name, file_name):
+        return int(self.store[(bucket_name, object_key(file_name))]
+                   .memory_usage(deep=True).sum())
+
+
+class PartitionedStorage:
+    """
+    Stores each file as one file per value of partition_column, under a directory
+    named after the file, with a small manifest in place of the file itself. The
+    manifest lists the partition value, file name, row count and content digest
+    of every partition, so a changed partition also changes the manifest.
+    Consumers can read only the partitions they need. Files without
+    partition_column are saved whole, and files that are not manifests, such as
+    inputs from earlier pipelines, are read as they are.
+    Partitions are read and written concurrently through the wrapped storage.
+    """
+
+    partitioned = True
+
+    def __init__(self, storage, partition_column, concurrency=10):
+        self.storage = storage
+        self.partition_column = partition_column
+        self.concurrency = concurrency
+        self.in_memory = storage.in_memory
+
+    def delete(self, bucket_name, file_name):
+        manifest = self.read_manifest(bucket_name, file_name)
+        if manifest is not None:
+            for partition_file in manifest["file_name"]:
+                self.storage.delete(bucket_name, partition_file)
+
+        return self.storage.delete(bucket_name, file_name)
+
+    def encode(self, data):
+        # Partitions are encoded by the wrapped storage as they are saved.
+        return data
+
+    def map_partitions(self, bucket_name, file_name, other_file_names, out_file_name,
+                       func, key_columns=None):
+        """
+        Applies func to each partition of a file along with the matching partition
+        of each of the other files, and saves the results as a partitioned file.
+        A file that is not partitioned is split into partitions in memory. Where
+        another file has no matching partition, func is given an empty frame, with
+        that file's columns, or only key_columns when the file is empty.
+
+        :param bucket_name: Name of the bucket holding the files. - String.
+        :param file_name: Name of the file to map. - String.
+        :param other_file_names: Names of the files to match partitions from. - List.
+        :param out_file_name: Name of the file to save the results as. - String.
+        :param func: Takes a partition and a list of the matching partitions, and
+                     returns a DataFrame. - Function.
+        :param key_columns: Columns func joins on, defaults to partition_column.
+                            - List.
+
+        :return: manifest: Manifest of the saved results. - DataFrame.
+        """
+        partitions = self._partitions(bucket_name, file_name)
+        others = [self._partitions(bucket_name, other_file_name)
+                  for other_file_name in other_file_names]
+
+        def map_partition(partition):
+            data = partitions[partition]()
+            matching = []
+            for other in others:
+                if partition in other:
+                    matching.append(other[partition]())
+                elif other:
+                    # No rows match, but the columns are still needed to join.
+                    matching.append(next(iter(other.values()))().iloc[0:0])
+                else:
+                    # The file is empty, so only the keys, typed as in data, are
+                    # known.
+                    matching.append(
+                        data[key_columns or [self.partition_column]].iloc[0:0])
+            return self._save_partition(bucket_name, out_file_name, partition,
+                                        func(data, matching))
+
+        with ThreadPoolExecutor(self.concurrency) as executor:
+            manifest = pd.DataFrame(list(executor.map(map_partition, partitions)),
+                                    columns=MANIFEST_COLUMNS)
+        self.storage.save(bucket_name, out_file_name, self.storage.encode(manifest))
+
+        return manifest
+
+    def read_dataframe(self, bucket_name, file_name, partitions=None):
+        """
+        Reads a file, or only some of its partitions.
+
+        :param bucket_name: Name of the bucket holding the file. - String.
+        :param file_name: Name of the file. - String.
+        :param partitions: Values of partition_column to read, all by default.
+                           - List.
+
+        :return: data: Rows of the partitions read, in partition order. - DataFrame.
+        """
+        data = self.storage.read_dataframe(bucket_name, file_name)
+        if not is_manifest(data):
+            return data
+
+        if partitions is not None:
+            data = data[data["partition"].isin([str(partition)
+                                                for partition in partitions])]
+        with ThreadPoolExecutor(self.concurrency) as executor:
+            frames = list(executor.map(
+                lambda partition_file: self.storage.read_dataframe(
+                    bucket_name, partition_file), data["file_name"]))
+        if not frames:
+            return pd.DataFrame()
+
+        return pd.concat(frames, ignore_index=True)
+
+    def read_manifest(self, bucket_name, file_name):
+        """
+        :param bucket_name: Name of the bucket holding the file. - String.
+        :param file_name: Name of the file. - String.
+
+        :return: manifest: None when the file is not partitioned. - DataFrame.
+        """
+        data = self.storage.read_dataframe(bucket_name, file_name)
+        return data if is_manifest(data) else None
+
+    def save(self, bucket_name, file_name, data):
+        if isinstance(data, str):
+            data = decode_frame(data)
+
+        # Files without the column, such as outputs grouped above it, are saved
+        # whole.
+        if self.partition_column not in data.columns:
+            self.storage.save(bucket_name, file_name, self.storage.encode(data))
+            return
+
+        groups = data.groupby(self.partition_column, sort=True, dropna=False,
+                              observed=True)
+        with ThreadPoolExecutor(self.concurrency) as executor:
+            manifest = pd.DataFrame(list(executor.map(
+                lambda group: self._save_partition(
+                    bucket_name, file_name, str(group[0]),
+                    group[1].reset_index(drop=True)),
+                groups)), columns=MANIFEST_COLUMNS)
+
+        self.storage.save(bucket_name, file_name, self.storage.encode(manifest))
+
+    def size(self, bucket_name, file_name):
+        manifest = self.read_manifest(bucket_name, file_name)
+        if manifest is None:
+            return self.storage.size(bucket_name, file_name)
+
+        return sum(self.storage.size(bucket_name, partition_file)
+                   for partition_file in manifest["file_name"])
+
+    def _partitions(self, bucket_name, file_name):
+        # Loaders of each partition of a file, by partition value.
+        data = self.storage.read_dataframe(bucket_name, file_name)
+        if is_manifest(data):
+            return {partition: (lambda partition_file=partition_file:
+                                self.storage.read_dataframe(bucket_name,
+                                                            partition_file))
+                    for partition, partition_file in zip(data["partition"],
+                                                         data["file_name"])}
+
+        # Empty files, such as an aggregation output without any groups, are
+        # saved without the column.
+        if self.partition_column not in data.columns:
+            if data.empty:
+                return {}
+            raise ValueError(f"{file_name} has no {self.partition_column} column "
+                             f"to partition by.")
+
+        return {str(partition): (lambda group=group: group.reset_index(drop=True))
+                for partition, group in data.groupby(self.partition_column, sort=True,
+                                                     dropna=False, observed=True)}
+
+    def _save_partition(self, bucket_name, file_name, partition, data):
+        # Named with the extension, as aws_functions.save_to_s3 does not add it.
+        partition_file = object_key(f"{object_key(file_name)[:-len('.json')]}/"
+                                    f"{self.partition_column}={partition}")
+        encoded = self.storage.encode(data)
+        self.storage.save(bucket_name, partition_file, encoded)
+        if isinstance(encoded, str):
+            digest = content_hash(encoded)
+        else:
+            digest = str(pd.util.hash_pandas_object(encoded).sum())
+
+        return [partition, partition_file, len(data), digest]
+
+
+def is_manifest(data):
+    """
+    :param data: Contents of a file. - DataFrame.
+
+    :return: Whether data is the manifest of a partitioned file. - Bool.
+    """
+    return list(data.columns) == MANIFEST_COLUMNS
+
+
+def open_storage(backend, directory="", transfer=None, local_cache=None,
+                 partition_column="", json_layout="records"):
+    """
+    Creates the storage backend handlers read their inputs from and write their
+    outputs to.
+
+    :param backend: One of STORAGE_BACKENDS. - String.
+    :param directory: Root directory of the local backend. - String.
+    :param transfer: Transfer used by the s3 backend. - Transfer.
+    :param local_cache: Local data cache used by the s3 backend. - LocalCache.
+    :param partition_column: Column to partition files by, none when empty.
+                             - String.
+    :param json_layout: Layout to write JSON files in, one of JSON_LAYOUTS.
+                        - String.
+
+    :return: storage: The storage backend. - S3Storage/LocalStorage/MemoryStorage,
+             or a PartitionedStorage wrapping one.
+    """
+    if backend == "s3":
+        storage = S3Storage(transfer, local_cache, json_layout)
+    elif backend == "local":
+        storage = LocalStorage(directory, json_layout)
+    elif backend == "memory":
+        storage = MemoryStorage()
+    else:
+        raise ValueError(f"Unknown storage backend {backend}.")
+
+    if partition_column:
+        return PartitionedStorage(storage, partition_column,
+                                  transfer.concurrency if transfer else 10)
+
+    return storage
@@ -1,6 +1,13 @@
 import json
+import logging
+import os
+import pstats
+import threading
+import time
+from datetime import datetime, timedelta, timezone
 from unittest import mock
 
+import numpy as np
 import pandas as pd
 import pytest
 from es_aws_functions import exception_classes, test_generic_library
@@ -12,7 +19,27 @@ import aggregation_column_method as lambda_method_col_function
 import aggregation_column_wrangler as lambda_wrangler_col_function
 import aggregation_top2_method as lambda_method_top2_function
 import aggregation_top2_wrangler as lambda_wrangler_top2_function
+import batch
+import capture
 import combiner as lambda_combiner_function
+import dtype_policy
+import engines
+import factorised
+import incremental
+import instrumentation
+import json_layout
+import load_harness
+import local_cache
+import memory_governor
+import notifications
+import parallel
+import pipeline_runner
+import profiling
+import replay
+import result_cache
+import storage
+import tracing
+import transfer
 
 combiner_runtime_variables = {
     "RuntimeVariables":
@@ -46,12 +73,25 @@ method_cell_runtime_variables = {
         "additional_aggregated_column": "strata",
         "aggregated_column": "region",
         "aggregation_type": "sum",
+        "batch_column": "",
         "cell_total_column": "cell_total",
+        "column_types": {},
         "data": None,
+        "engine": "pandas",
         "environment": "test - environment",
+        "instrumentation_enabled": False,
+        "json_layout": "records",
+        "memory_fraction": 0.0,
+        "memory_instrumentation_enabled": False,
+        "optimise_dtypes": False,
+        "parallel_enabled": False,
+        "profiling_enabled": False,
         "run_id": "bob",
         "survey": "survey",
-        "total_columns": ["Q608_total"]
+        "total_columns": ["Q608_total"],
+        "trace_context": {},
+        "tracemalloc_top": 0,
+        "tracing_enabled": False
     }
 }
 
@@ -60,12 +100,25 @@ method_ent_runtime_variables = {
         "additional_aggregated_column": "strata",
         "aggregated_column": "region",
         "aggregation_type": "nunique",
+        "batch_column": "",
         "cell_total_column": "ent_ref_count",
+        "column_types": {},
         "data": None,
+        "engine": "pandas",
         "environment": "test - environment",
+        "instrumentation_enabled": False,
+        "json_layout": "records",
+        "memory_fraction": 0.0,
+        "memory_instrumentation_enabled": False,
+        "optimise_dtypes": False,
+        "parallel_enabled": False,
+        "profiling_enabled": False,
         "run_id": "bob",
         "survey": "survey",
-        "total_columns": ["enterprise_reference"]
+        "total_columns": ["enterprise_reference"],
+        "trace_context": {},
+        "tracemalloc_top": 0,
+        "tracing_enabled": False
     }
 }
 
@@ -73,14 +126,27 @@ method_top2_runtime_variables = {
     "RuntimeVariables": {
         "additional_aggregated_column": "strata",
         "aggregated_column": "region",
+        "batch_column": "",
         "bpm_queue_url": "fake_queue_url",
+        "column_types": {},
         "data": None,
+        "engine": "pandas",
         "environment": "test - environment",
+        "instrumentation_enabled": False,
+        "json_layout": "records",
+        "memory_fraction": 0.0,
+        "memory_instrumentation_enabled": False,
+        "optimise_dtypes": False,
+        "parallel_enabled": False,
+        "profiling_enabled": False,
         "run_id": "bob",
         "survey": "survey",
         "top1_column": "largest_contributor",
         "top2_column": "second_largest_contributor",
-        "total_columns": ["Q608_total"]
+        "total_columns": ["Q608_total"],
+        "trace_context": {},
+        "tracemalloc_top": 0,
+        "tracing_enabled": False
     }
 }
 
@@ -88,14 +154,24 @@ method_top2_multi_runtime_variables = {
     "RuntimeVariables": {
         "additional_aggregated_column": "strata",
         "aggregated_column": "region",
+        "batch_column": "",
         "bpm_queue_url": "fake_queue_url",
+        "column_types": {},
         "data": None,
+        "engine": "pandas",
         "environment": "test - environment",
+        "instrumentation_enabled": False,
+        "json_layout": "records",
+        "memory_fraction": 0.0,
+        "memory_instrumentation_enabled": False,
+        "optimise_dtypes": False,
+        "parallel_enabled": False,
         "run_id": "bob",
         "survey": "survey",
         "top1_column": "largest_contributor",
         "top2_column": "second_largest_contributor",
         "total_columns": ["Q608_total", "Q607_constructional_fill"],
+        "tracemalloc_top": 0,
     }
 }
 
@@ -414,6 +490,62 @@ def test_calc_top_two():
     assert_frame_equal(produced_data, prepared_data)
 
 
+@mock.patch("parallel.MINIMUM_PARTITION_ROWS", 1)
+def test_calc_top_two_parallel():
+    """
+    Runs the calc_top_two function with its input partitioned across worker
+    processes.
+    :param None.
+    :return Test Pass/Fail
+    """
+    runtime = method_top2_runtime_variables["RuntimeVariables"]
+
+    with open("tests/fixtures/test_calc_top_two_prepared_output.json", "r") as file_1:
+        file_data = file_1.read()
+    prepared_data = pd.DataFrame(json.loads(file_data))
+
+    with open("tests/fixtures/test_calc_top_two_input.json", "r") as file_2:
+        test_data = file_2.read()
+    input_data = pd.DataFrame(json.loads(test_data))
+
+    output = lambda_method_top2_function.calc_top_two(
+        input_data, runtime["total_columns"][0], runtime["aggregated_column"],
+        runtime["additional_aggregated_column"], runtime["top1_column"],
+        runtime["top2_column"], workers=3)
+
+    produced_data = output.sort_index(axis=1)
+    assert_frame_equal(produced_data, prepared_data)
+
+
+@mock.patch("parallel.MINIMUM_PARTITION_ROWS", 1)
+def test_apply_partitioned_threads():
+    """
+    Checks partitions are forked into workers when no other thread is running, and
+    run in process while the notification dispatcher's thread is, as a fork could
+    inherit a lock it holds.
+    :param None.
+    :return Test Pass/Fail
+    """
+    data = pd.DataFrame({"region": range(10)})
+
+    def worker_ids(partition):
+        return pd.Series(os.getpid(), index=partition.index)
+
+    assert threading.active_count() == 1
+    assert os.getpid() not in set(parallel.apply_partitioned(worker_ids, data,
+                                                             workers=2))
+
+    sending = threading.Event()
+    dispatcher = notifications.NotificationDispatcher(mock.Mock(), True)
+    dispatcher.submit(sending.wait)
+    try:
+        assert set(parallel.apply_partitioned(worker_ids, data, workers=2)) == \
+            {os.getpid()}
+    finally:
+        sending.set()
+        dispatcher.flush()
+
+
 @mock_s3
 def test_calculate_row_type():
     """
@@ -447,6 +579,43 @@ def test_calculate_row_type():
     assert_frame_equal(produced_data, prepared_data)
 
 
+def test_collate_brick_types_sparse():
+    """
+    Runs the long form collation against the row by row collation.
+    :param None.
+    :return Test Pass/Fail
+    """
+    brick_type = {
+        "clay": 3,
+        "concrete": 2,
+        "sandlime": 4
+    }
+
+    runtime = pre_wrangler_runtime_variables["RuntimeVariables"]
+    column_list = runtime["total_columns"]
+    questions_list = [brick + "_" + column
+                      for column in column_list
+                      for brick in brick_type.keys()]
+
+    with open("tests/fixtures/test_wrangler_splitter_input.json", "r") as file_1:
+        test_data = file_1.read()
+    input_data = pd.DataFrame(json.loads(test_data))
+
+    long_form = lambda_pre_wrangler_function.melt_brick_types(
+        input_data, brick_type, column_list)
+    assert (long_form["value"] != 0).all()
+    assert len(long_form) == (input_data[questions_list] != 0).sum().sum()
+
+    prepared_data = lambda_pre_wrangler_function.collate_brick_types(
+        input_data.copy(), brick_type, column_list, questions_list,
+        runtime["unique_identifier"])
+    produced_data = lambda_pre_wrangler_function.collate_brick_types_sparse(
+        input_data.copy(), brick_type, column_list, questions_list,
+        runtime["unique_identifier"])
+
+    assert_frame_equal(produced_data, prepared_data)
+
+
 @mock_s3
 @mock.patch('combiner.aws_functions.save_to_s3',
             side_effect=test_generic_library.replacement_save_to_s3)
@@ -494,6 +663,213 @@ def test_combiner_success(mock_bpm_status, mock_sns, mock_s3_put):
     assert_frame_equal(produced_data, prepared_data)
 
 
+def test_dtype_policy():
+    """
+    Checks declared types are applied, integers are downcast, string keys become
+    categoricals and floats are left untouched.
+    :param None.
+    :return Test Pass/Fail
+    """
+    with open("tests/fixtures/test_wrangler_agg_input.json", "r") as file_1:
+        input_data = pd.DataFrame(json.loads(file_1.read()))
+    input_data["Q607_constructional_fill"] = \
+        input_data["Q607_constructional_fill"].astype(float)
+
+    produced_data = dtype_policy.apply_dtype_policy(
+        input_data.copy(), {"period": "int64"}, ["region", "strata"])
+
+    assert produced_data["period"].dtype == "int64"
+    assert produced_data["Q608_total"].dtype == "int32"
+    assert produced_data["Q607_constructional_fill"].dtype == "float64"
+    assert produced_data["enterprise_reference"].dtype == "int64"
+    assert produced_data["strata"].dtype == "category"
+    assert produced_data.to_json(orient="records") == \
+        input_data.to_json(orient="records")
+
+
+def test_groupby_strategy(caplog):
+    """
+    Checks each grouping strategy is chosen from the key statistics, logged, and
+    gives the same groups as the pandas groupby.
+    :param caplog: Captured log records.
+    :return Test Pass/Fail
+    """
+    with open("tests/fixtures/test_wrangler_agg_input.json", "r") as file_1:
+        input_data = pd.DataFrame(json.loads(file_1.read()))
+    input_data = pd.concat([input_data] * 300, ignore_index=True)
+    input_data["row"] = range(len(input_data))
+    totals_dict = {"Q608_total": "sum", "county": "count"}
+    engine = engines.PandasEngine()
+
+    for data, keys, totals_dict, strategy in [
+            (input_data, ["region", "strata"], totals_dict, "dense"),
+            (input_data, ["region", "strata"], {"Q608_total": "mean"}, "sort"),
+            (input_data.sample(frac=1, random_state=0), ["row"], totals_dict, "hash"),
+            (input_data, ["row"], totals_dict, "presorted"),
+            (input_data.astype({"strata": "category"}), ["strata"], totals_dict,
+             "sort")]:
+        caplog.clear()
+        with caplog.at_level(logging.INFO):
+            assert engines.choose_strategy(data, keys, totals_dict) == strategy
+        assert f"with the {strategy} strategy" in caplog.text
+
+        assert_frame_equal(
+            engine.group_aggregate(data, keys, totals_dict).sort_index(),
+            data.groupby(keys, observed=True).agg(totals_dict).sort_index())
+
+
+def test_dense_aggregate_overflow():
+    """
+    Checks dense sums of narrow integers match the pandas groupby, keeping the
+    column's type where the sums fit and widening it where they would overflow.
+    :param None.
+    :return Test Pass/Fail
+    """
+    totals_dict = {"total": "sum", "count": "count"}
+    for values, dtype in [([2 ** 30] * 3 + [1], "int64"), ([1, 2, 3, 4], "int32"),
+                          ([-2 ** 30] * 3 + [1], "int64")]:
+        data = pd.DataFrame({"region": [1, 1, 1, 2],
+                             "total": np.array(values, dtype="int32"),
+                             "count": np.array(values, dtype="int32")})
+
+        produced_data = engines.dense_aggregate(data, ["region"], totals_dict)
+        expected_data = data.groupby(["region"]).agg(totals_dict)
+        assert produced_data["total"].dtype == dtype
+        assert_frame_equal(produced_data, expected_data)
+
+
+@pytest.mark.parametrize("engine_name", engines.ENGINES)
+def test_engines(engine_name):
+    """
+    Checks every compute engine gives the pandas reference output for each kernel.
+    :param engine_name: Name of the engine.
+    :return Test Pass/Fail
+    """
+    if engine_name == "duckdb":
+        pytest.importorskip("duckdb")
+    runtime = method_top2_runtime_variables["RuntimeVariables"]
+    keys = [runtime["aggregated_column"], runtime["additional_aggregated_column"]]
+    engine = engines.get_engine(engine_name)
+    reference = engines.PandasEngine()
+
+    with open("tests/fixtures/test_calc_top_two_input.json", "r") as file_1:
+        input_data = pd.DataFrame(json.loads(file_1.read()))
+    with open("tests/fixtures/test_calc_top_two_prepared_output.json", "r") as file_2:
+        prepared_data = pd.DataFrame(json.loads(file_2.read()))
+
+    output = lambda_method_top2_function.calc_top_two(
+        input_data, runtime["total_columns"][0], runtime["aggregated_column"],
+        runtime["additional_aggregated_column"], runtime["top1_column"],
+        runtime["top2_column"], engine=engine)
+    assert_frame_equal(output.sort_index(axis=1), prepared_data.sort_index(axis=1))
+
+    totals_dict = {"Q608_total": "sum", "enterprise_reference": "nunique"}
+    assert_frame_equal(
+        engine.group_aggregate(input_data, keys, totals_dict).sort_index(),
+        reference.group_aggregate(input_data, keys, totals_dict).sort_index())
+
+    totals = reference.group_aggregate(input_data, keys, {"Q608_total": "sum"}) \
+        .add_suffix("_sum").reset_index()
+    assert_frame_equal(engine.join(input_data, totals.iloc[1:], keys),
+                       reference.join(input_data, totals.iloc[1:], keys))
+
+
+def test_incremental_patch_groups():
+    """
+    Checks that re-aggregating only the changed groups and patching the previous
+    output gives the same result as aggregating everything again.
+    :param None.
+    :return Test Pass/Fail
+    """
+    to_aggregate = ["region", "strata"]
+    totals_dict = {"Q608_total": "sum", "enterprise_reference": "nunique"}
+
+    with open("tests/fixtures/test_wrangler_agg_input.json", "r") as file_1:
+        previous_data = pd.DataFrame(json.loads(file_1.read()))
+    input_data = previous_data.copy()
+    input_data.loc[0, "Q608_total"] += 5
+    input_data.loc[3, "strata"] = "Z"
+    input_data = input_data.drop(index=5)
+
+    previous_output = previous_data.groupby(to_aggregate).agg(totals_dict)\
+        .reset_index()
+    prepared_data = input_data.groupby(to_aggregate).agg(totals_dict).reset_index()
+
+    changed_groups = incremental.find_changed_groups(
+        input_data, previous_data, ["responder_id"], to_aggregate)
+    changed_data = input_data[
+        incremental.in_groups(input_data, changed_groups, to_aggregate)]
+    produced_data = incremental.patch_groups(
+        previous_output,
+        changed_data.groupby(to_aggregate).agg(totals_dict).reset_index(),
+        changed_groups, to_aggregate)
+
+    assert len(changed_groups) == 4
+    assert len(changed_data) == 2
+    assert_frame_equal(produced_data, prepared_data)
+
+
+@pytest.mark.parametrize(
+    "enabled,expected_calls",
+    [
+        (True, 1),
+        (False, 0)
+    ])
+def test_instrumentation_emit(enabled, expected_calls):
+    """
+    Checks stage timings and metrics are emitted as a single embedded metric line,
+    and that nothing is collected when disabled.
+    :param enabled: Whether instrumentation is enabled. - Bool.
+    :param expected_calls: Number of log lines expected. - Int.
+    :return Test Pass/Fail
+    """
+    logger = mock.Mock()
+    recorder = instrumentation.Instrumentation("bob", "test module", enabled)
+
+    with recorder.stage("compute"):
+        recorder.record("rows_in", 10)
+    recorder.record_bytes("bytes_out", "[{}]")
+    recorder.emit(logger)
+
+    assert logger.info.call_count == expected_calls
+    if enabled:
+        metric_line = json.loads(logger.info.call_args[0][0])
+        metric_names = [metric["Name"] for metric in
+                        metric_line["_aws"]["CloudWatchMetrics"][0]["Metrics"]]
+        assert metric_line["run_id"] == "bob"
+        assert metric_line["module"] == "test module"
+        assert metric_line["rows_in"] == 10
+        assert metric_line["bytes_out"] == 4
+        assert "compute_time" in metric_names
+
+
+def test_instrumentation_memory_report():
+    """
+    Checks the memory report contains the dataframe footprint by dtype and the
+    requested number of top allocators.
+    :param None.
+    :return Test Pass/Fail
+    """
+    logger = mock.Mock()
+    recorder = instrumentation.Instrumentation("bob", "test module",
+                                               memory_enabled=True, tracemalloc_top=3)
+
+    with recorder.stage("decode"):
+        input_data = pd.DataFrame({"region": ["a", "b"], "Q608_total": [1, 2]})
+    recorder.record_frame("input", input_data)
+    recorder.emit(logger)
+
+    metric_line = json.loads(logger.info.call_args_list[0][0][0])
+    memory_report = json.loads(logger.info.call_args_list[1][0][0])
+
+    assert metric_line["decode_peak_rss"] > 0
+    assert memory_report["run_id"] == "bob"
+    assert memory_report["frames"]["input"]["rows"] == 2
+    assert set(memory_report["frames"]["input"]["bytes_by_dtype"]) == \
+        {"int64", "object"}
+    assert len(memory_report["top_allocators"]) <= 3
+
+
 @pytest.mark.parametrize(
     "input_data,prepared_data",
     [
@@ -556,6 +932,672 @@ def test_method_success(which_lambda, which_runtime_variables, input_data, prepa
     assert_frame_equal(produced_data, prepared_data)
 
 
+@mock_s3
+def test_json_layout(tmp_path):
+    """
+    Checks the split layout is smaller than records and reads back unchanged,
+    directly, from local storage and from S3, and that records still read back.
+    :param tmp_path: Root directory of the local backend.
+    :return Test Pass/Fail
+    """
+    bucket_name = "test_bucket"
+    test_generic_library.create_bucket(bucket_name)
+
+    with open("tests/fixtures/test_wrangler_agg_input.json", "r") as file_1:
+        prepared_data = pd.DataFrame(json.loads(file_1.read()))
+
+    split_data = json_layout.encode_frame(prepared_data, "split")
+    records_data = json_layout.encode_frame(prepared_data)
+    assert len(split_data) < len(records_data)
+    assert_frame_equal(json_layout.decode_frame(split_data), prepared_data)
+    assert_frame_equal(json_layout.decode_frame(records_data), prepared_data)
+
+    split_storage = storage.open_storage("local", str(tmp_path), json_layout="split")
+    split_storage.save(bucket_name, "test_split", split_storage.encode(prepared_data))
+    assert_frame_equal(split_storage.read_dataframe(bucket_name, "test_split"),
+                       prepared_data)
+
+    split_transfer = transfer.Transfer(json_layout="split")
+    split_transfer.save_to_s3(bucket_name, "test_split.json", split_data)
+    assert_frame_equal(split_transfer.read_dataframe(bucket_name, "test_split"),
+                       prepared_data)
+
+
+def test_capture_replay(tmp_path):
+    """
+    Checks a captured invocation records a fingerprint and an anonymised copy of
+    its input, and replays locally with instrumentation, and that sampling keeps
+    whole contributors.
+    :param tmp_path: Directory to write the captures to.
+    :return Test Pass/Fail
+    """
+    with open("tests/fixtures/test_wrangler_agg_input.json", "r") as file_1:
+        input_data = file_1.read()
+    prepared_data = pd.DataFrame(json.loads(input_data))
+
+    variables = dict(wrangler_top2_runtime_variables["RuntimeVariables"],
+                     capture_enabled=True,
+                     unique_identifier=["region", "responder_id"])
+    variables.pop("bpm_queue_url")
+    variables.pop("sns_topic_arn")
+    environment = {"capture_anonymise": "true",
+                   "capture_anonymise_columns": "responder_id",
+                   "capture_location": str(tmp_path / "captures"),
+                   "capture_sample_fraction": 1.0}
+    report = pipeline_runner.PipelineRunner(
+        [pipeline_runner.Step("top2", "aggregation_top2_wrangler",
+                              "aggregation_top2_method", variables, [])],
+        bucket_name="test_bucket", environment=environment).run(
+        {"test_wrangler_agg_input.json": input_data})
+    assert report["success"]
+
+    captures = replay.load_captures(str(tmp_path / "captures"))
+    assert len(captures) == 1
+    capture_directory, record = captures[0]
+    assert record["module"] == "aggregation_top2_wrangler"
+    assert record["run_id"] == "bob"
+    assert record["success"]
+    assert "capture_enabled" not in record["environment"]
+    captured_input = record["inputs"]["test_wrangler_agg_input"]
+    assert captured_input["fingerprint"]["rows"] == len(prepared_data)
+    assert captured_input["fingerprint"]["columns"]["region"]["distinct"] == \
+        prepared_data["region"].nunique()
+
+    with open(os.path.join(capture_directory, captured_input["copy"]), "r") \
+            as file_2:
+        copied_data = pd.DataFrame(json.loads(file_2.read()))
+    for column in ["responder_id", "enterprise_reference"]:
+        assert not set(copied_data[column]) & set(prepared_data[column])
+        assert copied_data[column].nunique() == prepared_data[column].nunique()
+    assert_frame_equal(copied_data.drop(columns=["responder_id",
+                                                 "enterprise_reference"]),
+                       prepared_data.drop(columns=["responder_id",
+                                                   "enterprise_reference"]))
+
+    results = replay.replay_all(str(tmp_path / "captures"))
+    assert [result["status"] for result in results] == ["success"]
+    modules = {metric["module"] for metric in results[0]["metrics"]}
+    assert len(modules) == 2
+
+    scaled_data = pipeline_runner.scale_frame(
+        pd.concat([prepared_data] * 3, ignore_index=True), 20, ["responder_id"])
+    sampled_data = capture.sample_frame(scaled_data, 0.5, "responder_id")
+    assert 0 < len(sampled_data) < len(scaled_data)
+    assert (scaled_data["responder_id"].isin(sampled_data["responder_id"]).sum() ==
+            len(sampled_data))
+
+    # The splitter's unique_identifier holds the columns it groups by, which are
+    # neither the sampling key nor anonymised.
+    with mock.patch.dict(os.environ, {"capture_anonymise": "true"}):
+        settings = capture.capture_settings({"RuntimeVariables": {
+            "capture_enabled": True,
+            "unique_identifier": ["brick_type", "enterprise_reference", "region"]}})
+    assert settings["key_column"] == "enterprise_reference"
+    assert settings["anonymise_columns"] == ["enterprise_reference"]
+
+
+def test_load_harness():
+    """
+    Checks the load test drives concurrent runs through the shared stand-ins,
+    keeping each run's files apart, holding to the concurrency limit and reporting
+    the queueing it causes.
+    :param None.
+    :return Test Pass/Fail
+    """
+    with open("tests/fixtures/test_wrangler_agg_input.json", "r") as file_1:
+        input_data = file_1.read()
+
+    assert load_harness.arrival_times(3, 0.0) == [0.0, 0.0, 0.0]
+    arrivals = load_harness.arrival_times(50, 10.0)
+    assert arrivals[0] == 0.0
+    assert all(later >= earlier for earlier, later in zip(arrivals, arrivals[1:]))
+
+    variables = load_harness.run_variables(
+        {"aggregation_files": {"cell_agg": "cell.json"}, "in_file_name": "input",
+         "previous_in_file_name": "", "run_id": "bob"}, "load-1")
+    assert variables == {"aggregation_files": {"cell_agg": "load-1/cell.json"},
+                         "in_file_name": "load-1/input", "previous_in_file_name": "",
+                         "run_id": "load-1"}
+
+    report = load_harness.LoadTest(pipeline_steps(),
+                                   {"test_wrangler_agg_input.json": input_data}, 3,
+                                   scales=[1, 2], scale_columns=["responder_id"],
+                                   concurrency=2).run()
+
+    assert report["runs"] == 3
+    assert report["failed_runs"] == 0
+    assert report["throughput"] > 0
+    assert report["peak_concurrency"] <= 2
+    assert report["handlers"]["aggregation_column_wrangler"]["invocations"] == 6
+    assert report["handlers"]["combiner"]["invocations"] == 3
+    assert report["queued_seconds"]["max"] > 0
+    assert report["s3_requests"]["total"] > 0
+
+
+def test_factorised_output(tmp_path):
+    """
+    Checks the combiner's factorised output holds each group's aggregates once,
+    and that its wide view matches the combiner's wide output.
+    :param tmp_path: Directory to download the outputs to.
+    :return Test Pass/Fail
+    """
+    steps = [step._replace(runtime_variables=dict(step.runtime_variables,
+                                                  factorised_output=True))
+             if step.name == "combiner" else step for step in pipeline_steps()]
+
+    with open("tests/fixtures/test_wrangler_agg_input.json", "r") as file_1:
+        input_data = file_1.read()
+    with open("tests/fixtures/test_wrangler_combiner_prepared_output.json", "r") \
+            as file_2:
+        prepared_data = pd.DataFrame(json.loads(file_2.read()))
+
+    report = pipeline_runner.PipelineRunner(steps, bucket_name="test_bucket").run(
+        {"test_wrangler_agg_input.json": input_data}, str(tmp_path))
+    assert report["success"]
+
+    def read_dataframe(bucket_name, file_name):
+        with open(tmp_path / file_name, "r") as file_3:
+            return pd.DataFrame(json.loads(file_3.read()))
+
+    assert factorised.aggregates_file_name("test_wrangler_combiner_output.json") == \
+        "test_wrangler_combiner_output_aggregates.json"
+    produced_data = factorised.read_factorised(
+        read_dataframe, "test_bucket", "test_wrangler_combiner_output.json",
+        ["region", "strata"])
+
+    assert len(produced_data.aggregates) == \
+        len(prepared_data[["region", "strata"]].drop_duplicates())
+    assert factorised.GROUP_ID_COLUMN in produced_data.data.columns
+    assert "ent_ref_count" not in produced_data.data.columns
+    assert_frame_equal(produced_data.wide().sort_index(axis=1),
+                       prepared_data.sort_index(axis=1))
+    assert produced_data.column("ent_ref_count").tolist() == \
+        prepared_data["ent_ref_count"].tolist()
+
+
+@mock_s3
+def test_local_cache(tmp_path):
+    """
+    Checks a repeated read is served from the local cache, and that the cached copy
+    is ignored once the object in S3 changes.
+    :param tmp_path: Directory to keep the cache in.
+    :return Test Pass/Fail
+    """
+    bucket_name = "test_bucket"
+    client = test_generic_library.create_bucket(bucket_name)
+    test_generic_library.upload_files(client, bucket_name,
+                                      ["test_wrangler_agg_input.json"])
+
+    with open("tests/fixtures/test_wrangler_agg_input.json", "r") as file_1:
+        prepared_data = pd.DataFrame(json.loads(file_1.read()))
+
+    cache = local_cache.LocalCache(10 ** 8, str(tmp_path))
+    assert_frame_equal(cache.read_dataframe(bucket_name, "test_wrangler_agg_input"),
+                       prepared_data)
+    assert_frame_equal(cache.read_dataframe(bucket_name, "test_wrangler_agg_input"),
+                       prepared_data)
+    assert cache.hits == 1
+
+    client.put_object(Bucket=bucket_name, Key="test_wrangler_agg_input.json",
+                      Body=prepared_data.head(2).to_json(orient="records"))
+    assert_frame_equal(cache.read_dataframe(bucket_name, "test_wrangler_agg_input"),
+                       prepared_data.head(2))
+    assert cache.hits == 1
+
+
+def test_notification_dispatcher():
+    """
+    Checks background notifications are sent in order by flush, and that a failed
+    notification is raised by flush and stops the ones queued after it.
+    :param None.
+    :return Test Pass/Fail
+    """
+    sent = []
+    dispatcher = notifications.NotificationDispatcher(mock.Mock(), True)
+    dispatcher.submit(sent.append, "IN PROGRESS")
+    dispatcher.submit(sent.append, "SNS")
+    dispatcher.flush()
+    assert sent == ["IN PROGRESS", "SNS"]
+
+    dispatcher.submit(mock.Mock(side_effect=ValueError("Failed to send.")))
+    dispatcher.submit(sent.append, "Skipped")
+    with pytest.raises(ValueError):
+        dispatcher.flush()
+    assert sent == ["IN PROGRESS", "SNS"]
+
+
+@mock_s3
+# Newer botocore sends checksummed parts aws-chunked encoded, which moto may store
+# as is, so checksums are only sent where the operation requires one.
+@mock.patch.dict(os.environ, {"AWS_REQUEST_CHECKSUM_CALCULATION": "when_required"})
+def test_transfer():
+    """
+    Checks that a file written as a multipart upload and read back with ranged GETs
+    is unchanged.
+    :param None.
+    :return Test Pass/Fail
+    """
+    bucket_name = "test_bucket"
+    client = test_generic_library.create_bucket(bucket_name)
+
+    with open("tests/fixtures/test_wrangler_splitter_input.json", "r") as file_1:
+        prepared_data = pd.DataFrame(json.loads(file_1.read()))
+
+    large_transfer = transfer.Transfer(part_size=1024, concurrency=4)
+    large_transfer.save_to_s3(bucket_name, "test_transfer",
+                              prepared_data.to_json(orient="records"))
+    etag = client.head_object(Bucket=bucket_name, Key="test_transfer.json")["ETag"]
+
+    assert "-" in etag
+    assert_frame_equal(large_transfer.read_dataframe(bucket_name, "test_transfer"),
+                       prepared_data)
+
+
+@mock_s3
+def test_transfer_hedging():
+    """
+    Checks a GET slower than the hedging threshold is sent again and the faster
+    response used, and that retries use the adaptive mode.
+    :param None.
+    :return Test Pass/Fail
+    """
+    bucket_name = "test_bucket"
+    test_generic_library.create_bucket(bucket_name)
+
+    with open("tests/fixtures/test_wrangler_agg_input.json", "r") as file_1:
+        prepared_data = pd.DataFrame(json.loads(file_1.read()))
+
+    latencies = transfer.LatencyTracker()
+    hedged_transfer = transfer.Transfer(hedge_percentile=95, max_attempts=5,
+                                        latencies=latencies)
+    assert hedged_transfer.client.meta.config.retries == {
+        "mode": "adaptive", "total_max_attempts": 5}
+    hedged_transfer.save_to_s3(bucket_name, "test_hedging",
+                               prepared_data.to_json(orient="records"))
+
+    # Reads are not hedged until enough latencies have been seen.
+    get_object = hedged_transfer.client.get_object
+    for _ in range(transfer.HEDGE_MINIMUM_SAMPLES):
+        hedged_transfer.read_dataframe(bucket_name, "test_hedging")
+    assert hedged_transfer.hedged_reads == 0
+
+    # The first request stalls, as a slow S3 partition would, until released.
+    calls = []
+    released = threading.Event()
+    stalled_done = threading.Event()
+
+    def delayed_get_object(**kwargs):
+        calls.append(kwargs)
+        if len(calls) > 1:
+            return get_object(**kwargs)
+        try:
+            released.wait(2)
+            return get_object(**kwargs)
+        finally:
+            stalled_done.set()
+
+    start = time.perf_counter()
+    with mock.patch.object(hedged_transfer.client, "get_object",
+                           side_effect=delayed_get_object):
+        produced_data = hedged_transfer.read_dataframe(bucket_name, "test_hedging")
+
+    assert time.perf_counter() - start < 2
+    released.set()
+    stalled_done.wait()
+    assert len(calls) == 2
+    assert hedged_transfer.hedged_reads == 1
+    assert hedged_transfer.hedges_won == 1
+    assert_frame_equal(produced_data, prepared_data)
+
+
+@pytest.mark.parametrize("backend", ["local", "memory"])
+def test_partitioned_storage(backend, tmp_path):
+    """
+    Checks a partitioned file reads back whole or by partition, that partitions are
+    joined one by one, and that deleting the file removes every partition.
+    :param backend: Name of the wrapped storage backend.
+    :param tmp_path: Root directory of the local backend.
+    :return Test Pass/Fail
+    """
+    with open("tests/fixtures/test_wrangler_agg_input.json", "r") as file_1:
+        prepared_data = pd.DataFrame(json.loads(file_1.read()))
+    prepared_data = prepared_data.sort_values("region", kind="stable") \
+        .reset_index(drop=True)
+    regions = prepared_data.groupby("region", as_index=False)["Q608_total"].sum() \
+        .rename(columns={"Q608_total": "region_total"})
+
+    partitioned_storage = storage.open_storage(backend, str(tmp_path),
+                                               partition_column="region")
+    wrapped_storage = partitioned_storage.storage
+    partitioned_storage.save("test_bucket", "test_storage",
+                             partitioned_storage.encode(prepared_data))
+    partitioned_storage.save("test_bucket", "test_regions",
+                             partitioned_storage.encode(regions))
+
+    manifest = partitioned_storage.read_manifest("test_bucket", "test_storage")
+    assert list(manifest["partition"]) == [str(region) for region in regions["region"]]
+    assert manifest["rows"].sum() == len(prepared_data)
+    assert_frame_equal(partitioned_storage.read_dataframe("test_bucket", "test_storage"),
+                       prepared_data)
+
+    region = regions["region"][0]
+    assert_frame_equal(
+        partitioned_storage.read_dataframe("test_bucket", "test_storage", [region]),
+        prepared_data[prepared_data["region"] == region].reset_index(drop=True))
+
+    partitioned_storage.map_partitions(
+        "test_bucket", "test_storage", ["test_regions"], "test_joined",
+        lambda data, others: pd.merge(data, others[0], on="region", how="left"))
+    assert_frame_equal(partitioned_storage.read_dataframe("test_bucket", "test_joined"),
+                       pd.merge(prepared_data, regions, on="region", how="left"))
+
+    # An empty aggregation output has no partitions, so is joined as an empty frame.
+    partitioned_storage.save("test_bucket", "test_empty",
+                             partitioned_storage.encode(regions.iloc[0:0]))
+    partitioned_storage.map_partitions(
+        "test_bucket", "test_storage", ["test_regions", "test_empty"],
+        "test_joined_empty",
+        lambda data, others: pd.merge(pd.merge(data, others[0], on="region",
+                                               how="left"),
+                                      others[1], on="region", how="left"))
+    assert_frame_equal(
+        partitioned_storage.read_dataframe("test_bucket", "test_joined_empty"),
+        pd.merge(prepared_data, regions, on="region", how="left"))
+
+    partitioned_storage.delete("test_bucket", "test_storage")
+    with pytest.raises((FileNotFoundError, KeyError)):
+        wrapped_storage.read_dataframe("test_bucket", manifest["file_name"][0])
+
+
+def pipeline_steps():
+    """
+    Steps of the aggregation stage, for the local pipeline runner.
+    :return Steps
+    """
+    def runtime_variables(which_runtime_variables, **overrides):
+        variables = dict(which_runtime_variables["RuntimeVariables"], **overrides)
+        # The runner points these at its own topic and queue.
+        variables.pop("bpm_queue_url")
+        variables.pop("sns_topic_arn")
+        return variables
+
+    steps = [
+        pipeline_runner.Step("ent", "aggregation_column_wrangler",
+                             "aggregation_column_method", runtime_variables(
+                                 wrangler_cell_runtime_variables,
+                                 aggregation_type="nunique",
+                                 cell_total_column="ent_ref_count",
+                                 out_file_name="ent.json",
+                                 total_columns=["enterprise_reference"]), []),
+        pipeline_runner.Step("cell", "aggregation_column_wrangler",
+                             "aggregation_column_method", runtime_variables(
+                                 wrangler_cell_runtime_variables,
+                                 out_file_name="cell.json"), []),
+        pipeline_runner.Step("top2", "aggregation_top2_wrangler",
+                             "aggregation_top2_method", runtime_variables(
+                                 wrangler_top2_runtime_variables,
+                                 out_file_name="top2.json"), []),
+        pipeline_runner.Step("combiner", "combiner", None, runtime_variables(
+            combiner_runtime_variables,
+            aggregation_files={"ent_ref_agg": "ent.json", "cell_agg": "cell.json",
+                               "top2_agg": "top2.json"}), ["ent", "cell", "top2"])
+    ]
+
+    return steps
+
+
+def test_pipeline_runner(tmp_path):
+    """
+    Checks the local pipeline runner runs the aggregations and the combiner as a
+    DAG, producing the expected combiner output and ending the critical path on the
+    combiner.
+    :param tmp_path: Directory to download the outputs to.
+    :return Test Pass/Fail
+    """
+    steps = pipeline_steps()
+
+    with open("tests/fixtures/test_wrangler_agg_input.json", "r") as file_1:
+        input_data = file_1.read()
+    with open("tests/fixtures/test_wrangler_combiner_prepared_output.json", "r") \
+            as file_2:
+        prepared_data = pd.DataFrame(json.loads(file_2.read()))
+
+    report = pipeline_runner.PipelineRunner(steps, bucket_name="test_bucket").run(
+        {"test_wrangler_agg_input.json": input_data}, str(tmp_path))
+
+    with open(tmp_path / "test_wrangler_combiner_output.json", "r") as file_3:
+        produced_data = pd.DataFrame(json.loads(file_3.read()))
+
+    assert report["success"]
+    assert report["critical_path"][-1] == "combiner"
+    assert_frame_equal(produced_data.sort_index(axis=1),
+                       prepared_data.sort_index(axis=1))
+
+
+@pytest.mark.parametrize("profiler", profiling.PROFILERS)
+def test_profiling(profiler, tmp_path):
+    """
+    Checks a profiled handler is profiled only when asked to, writing a profile
+    tagged with the module and run_id even when the handler raises.
+    :param profiler: Profiler to use.
+    :param tmp_path: Directory to write the profiles to.
+    :return Test Pass/Fail
+    """
+    def busy_work(seconds):
+        end = time.perf_counter() + seconds
+        while time.perf_counter() < end:
+            sum(range(1000))
+
+    @profiling.profiled
+    def handler(event, context):
+        busy_work(0.2)
+        if event["RuntimeVariables"].get("fail"):
+            raise ValueError("Failed")
+        return {"success": True}
+
+    environment = {"profile_interval": "0.001", "profile_location": str(tmp_path),
+                   "profiler": profiler}
+    with mock.patch.dict("os.environ", environment):
+        assert handler({"RuntimeVariables": {"run_id": "bob"}}, None) == \
+            {"success": True}
+        assert not list(tmp_path.iterdir())
+
+        handler({"RuntimeVariables": {"profiling_enabled": True, "run_id": "bob"}},
+                None)
+        with pytest.raises(ValueError):
+            handler({"RuntimeVariables": {"fail": True, "profiling_enabled": True,
+                                          "run_id": "bob"}}, None)
+
+    profiles = sorted((tmp_path / __name__).iterdir())
+    assert len(profiles) == 2
+    for profile in profiles:
+        assert profile.name.startswith("bob-")
+        if profiler == "sampling":
+            assert profile.suffix == ".folded"
+            folded = profile.read_text()
+            assert "busy_work (test_aggregation.py:" in folded
+            assert all(line.rsplit(" ", 1)[1].isdigit()
+                       for line in folded.splitlines())
+        else:
+            assert profile.suffix == ".prof"
+            functions = pstats.Stats(str(profile)).stats
+            assert any(name == "busy_work" for _, _, name in functions)
+
+
+@pytest.mark.parametrize("backend", ["local", "memory"])
+def test_storage(backend, tmp_path):
+    """
+    Checks the local and memory storage backends return what was saved, and that
+    changing a dataframe read from memory storage leaves the stored one unchanged.
+    :param backend: Name of the storage backend.
+    :param tmp_path: Root directory of the local backend.
+    :return Test Pass/Fail
+    """
+    with open("tests/fixtures/test_wrangler_agg_input.json", "r") as file_1:
+        prepared_data = pd.DataFrame(json.loads(file_1.read()))
+
+    backend_storage = storage.open_storage(backend, str(tmp_path))
+    backend_storage.save("test_bucket", "test_storage",
+                         backend_storage.encode(prepared_data.copy()))
+
+    produced_data = backend_storage.read_dataframe("test_bucket", "test_storage")
+    produced_data["Q608_total"] = 0
+    assert_frame_equal(backend_storage.read_dataframe("test_bucket", "test_storage"),
+                       prepared_data)
+
+    backend_storage.delete("test_bucket", "test_storage.json")
+    with pytest.raises((FileNotFoundError, KeyError)):
+        backend_storage.read_dataframe("test_bucket", "test_storage")
+
+
+def test_tracing():
+    """
+    Checks a method's spans join the wrangler's trace through the trace context,
+    and that the critical path replaces the invoke wait with the method's spans.
+    :param None.
+    :return Test Pass/Fail
+    """
+    logger = mock.Mock()
+    wrangler = tracing.Tracer("bob", "Wrangler", enabled=True)
+    method = tracing.Tracer("bob", "Method", wrangler.child_context(), True)
+    wrangler.start, method.start = 0.0, 1.5
+    wrangler.add_span("read", 0.0, 1.0)
+    wrangler.add_span("invoke", 1.0, 4.0)
+    method.add_span("compute", 1.5, 3.5)
+    method.emit(logger)
+    wrangler.emit(logger)
+
+    traces = tracing.read_traces(
+        "INFO " + call[0][0] for call in logger.info.call_args_list)
+    path = tracing.critical_path(traces["bob"])
+
+    assert [invocation["module"] for invocation in traces["bob"]] == \
+        ["Wrangler", "Method"]
+    assert [(entry["module"], entry["name"]) for entry in path[:4]] == [
+        ("Wrangler", "read"), ("Method", "compute"), ("Method", "other"),
+        ("Wrangler", "invoke overhead")]
+    assert path[1]["seconds"] == 2.0
+
+
+@mock.patch("parallel.MINIMUM_PARTITION_ROWS", 1)
+def test_memory_governor(tmp_path):
+    """
+    Checks the governor splits data too large for its budget into chunks, that
+    chunked calculations match one pass, and that oversized reads are refused.
+    :param tmp_path: Directory to spill chunk results to.
+    :return Test Pass/Fail
+    """
+    runtime = method_top2_runtime_variables["RuntimeVariables"]
+
+    with open("tests/fixtures/test_calc_top_two_prepared_output.json", "r") as file_1:
+        file_data = file_1.read()
+    prepared_data = pd.DataFrame(json.loads(file_data))
+
+    with open("tests/fixtures/test_calc_top_two_input.json", "r") as file_2:
+        test_data = file_2.read()
+    input_data = pd.DataFrame(json.loads(test_data))
+
+    context = mock.Mock(memory_limit_in_mb=1)
+    assert memory_governor.MemoryGovernor(context).chunk_count(input_data) == 1
+
+    frame_bytes = memory_governor.estimate_frame_bytes(input_data)
+    assert frame_bytes == pytest.approx(input_data.memory_usage(deep=True).sum(),
+                                        rel=0.1)
+
+    # A budget just over a quarter of the working set needs four chunks.
+    governor = memory_governor.MemoryGovernor(
+        context, frame_bytes * (1 + memory_governor.COMPUTE_FACTOR) /
+        (3.9 * memory_governor.MEBIBYTE))
+    assert governor.chunk_count(input_data) == 4
+
+    with mock.patch("parallel.SPILL_DIRECTORY", str(tmp_path)):
+        output = lambda_method_top2_function.calc_top_two(
+            input_data, runtime["total_columns"][0], runtime["aggregated_column"],
+            runtime["additional_aggregated_column"], runtime["top1_column"],
+            runtime["top2_column"], workers=2, chunks=4)
+    assert_frame_equal(output.sort_index(axis=1), prepared_data)
+    assert list(tmp_path.iterdir()) == []
+
+    memory_storage = storage.MemoryStorage({})
+    memory_storage.save("test_bucket", "small", input_data.head(1))
+    memory_storage.save("test_bucket", "large",
+                        pd.DataFrame({"value": range(memory_governor.MEBIBYTE)}))
+    governor.check_read(memory_storage, "test_bucket", ["small"])
+    with pytest.raises(MemoryError):
+        governor.check_read(memory_storage, "test_bucket", ["small", "large"])
+
+
+def test_method_batch():
+    """
+    Checks that aggregating two runs together in a batch gives each run the same
+    output as aggregating it alone.
+    :param None.
+    :return Test Pass/Fail
+    """
+    with open("tests/fixtures/test_method_cell_input.json", "r") as file_1:
+        input_data = pd.DataFrame(json.loads(file_1.read()))
+    with open("tests/fixtures/test_method_cell_prepared_output.json", "r") as file_2:
+        prepared_data = pd.DataFrame(json.loads(file_2.read())).sort_index(axis=1)
+
+    batch_data = pd.concat([input_data, input_data], keys=[0, 1],
+                           names=[batch.BATCH_COLUMN]).reset_index(level=0)
+    runtime_variables = json.loads(json.dumps(method_cell_runtime_variables))
+    runtime_variables["RuntimeVariables"]["batch_column"] = batch.BATCH_COLUMN
+    runtime_variables["RuntimeVariables"]["data"] = batch_data.to_json(orient="records")
+
+    output = lambda_method_col_function.lambda_handler(
+        runtime_variables, test_generic_library.context_object)
+    produced_data = batch.split_batch(pd.DataFrame(json.loads(output["data"])), 2)
+
+    assert output["success"]
+    for run_output in produced_data:
+        assert_frame_equal(run_output.sort_index(axis=1), prepared_data)
+
+
+@mock_s3
+def test_result_cache():
+    """
+    Checks results are returned from the cache while fresh, are ignored when
+    bypassed or expired, and are evicted once the cache exceeds its size limit.
+    :param None.
+    :return Test Pass/Fail
+    """
+    bucket_name = "test_bucket"
+    client = test_generic_library.create_bucket(bucket_name)
+    parameters = wrangler_cell_runtime_variables["RuntimeVariables"]
+
+    result_cache.LAST_EVICTIONS.clear()
+    cache = result_cache.ResultCache(bucket_name, "cache", 3600, 20)
+    cache_key = cache.key("column", parameters, [result_cache.content_hash("[]")])
+
+    assert cache_key == cache.key("column", dict(parameters, run_id="other"),
+                                  [result_cache.content_hash("[]")])
+    assert cache_key != cache.key("column", dict(parameters, aggregation_type="count"),
+                                  [result_cache.content_hash("[]")])
+    assert cache.get(cache_key) is None
+
+    cache.put(cache_key, '[{"region": 1}]')
+    assert cache.get(cache_key) == '[{"region": 1}]'
+    assert result_cache.ResultCache(bucket_name, "cache", 3600, bypass=True)\
+        .get(cache_key) is None
+
+    with mock.patch("result_cache.datetime") as mock_datetime:
+        mock_datetime.now.return_value = datetime.now(timezone.utc) + timedelta(days=1)
+        assert cache.get(cache_key) is None
+
+    assert cache_key == cache.key("column", dict(parameters, engine="duckdb",
+                                                 parallel_enabled=True),
+                                  [result_cache.content_hash("[]")])
+
+    # Eviction ran on the first put, so is not due again yet.
+    cache.put(cache.key("column", parameters, ["a"]), '[{"region": 2}]')
+    cache.put(cache.key("column", parameters, ["b"]), '[{"region": 3}]')
+    assert client.list_objects_v2(Bucket=bucket_name, Prefix="cache/")["KeyCount"] == 2
+    with mock.patch.object(result_cache, "EVICTION_INTERVAL", 0):
+        cache.put(cache.key("column", parameters, ["c"]), '[{"region": 4}]')
+    assert client.list_objects_v2(Bucket=bucket_name, Prefix="cache/")["KeyCount"] == 1
+
+
 @mock_s3
 @mock.patch('aggregation_bricks_splitter_wrangler.aws_functions.save_to_s3',
             side_effect=test_generic_library.replacement_save_to_s3)
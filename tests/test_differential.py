@@ -0,0 +1,397 @@
+from functools import lru_cache
+from unittest import mock
+
+import numpy as np
+import pandas as pd
+import pytest
+from pandas.testing import assert_frame_equal, assert_series_equal
+
+import aggregation_bricks_splitter_wrangler as lambda_pre_wrangler_function
+import aggregation_column_method as lambda_method_col_function
+import aggregation_top2_method as lambda_method_top2_function
+import combiner as lambda_combiner_function
+import engines
+import factorised
+import parallel
+
+# Differential tests: every fast path must give exactly the output of the
+# implementation it replaced, which is kept here, or in the handler modules, as the
+# reference. Inputs are generated at random from fixed seeds, and reshaped into the
+# edge cases the fast paths are most likely to get wrong.
+
+SEEDS = range(3)
+
+EDGE_CASES = ["random", "ties", "single_contributor", "missing_values", "all_zero",
+              "no_additional_column", "presorted"]
+
+BRICK_EDGE_CASES = ["random", "all_zero", "several_types", "negative_values"]
+
+BRICK_TYPE = {
+    "clay": 3,
+    "concrete": 2,
+    "sandlime": 4
+}
+
+BRICK_COLUMNS = ["opening_stock_commons", "opening_stock_facings",
+                 "opening_stock_engineering", "produced_commons", "produced_facings",
+                 "produced_engineering", "deliveries_commons", "deliveries_facings",
+                 "deliveries_engineering", "closing_stock_commons",
+                 "closing_stock_facings", "closing_stock_engineering"]
+
+# Engine name, workers and chunks of each fast path. Partitions are forced down to a
+# single row so that the generated inputs are split across the workers.
+VARIANTS = [
+    ("pandas", 1, 3),
+    ("pandas", 3, 1),
+    ("pandas", 2, 2),
+    ("duckdb", 1, 1),
+    ("duckdb", 1, 3)
+]
+
+# Whether the collation is from the long form, workers and chunks of each fast path.
+BRICK_VARIANTS = [
+    (False, 1, 3),
+    (False, 3, 1),
+    (True, 1, 1),
+    (True, 1, 3),
+    (True, 3, 1)
+]
+
+
+def make_contributions(seed, edge_case, rows=300):
+    """
+    Generates contributor level data like the aggregation input.
+    :param seed: Seed of the random generator. - Int.
+    :param edge_case: One of EDGE_CASES. - String.
+    :param rows: Number of contributors. - Int.
+    :return: data, aggregated_column, additional_aggregated_column. - Tuple.
+    """
+    rng = np.random.default_rng(seed)
+    data = pd.DataFrame({
+        "enterprise_reference": rng.integers(1000000000, 1000000000 + rows // 3, rows),
+        "region": rng.integers(1, 13, rows),
+        "strata": rng.choice(["A", "B", "C", "D", "E"], rows),
+        "Q608_total": rng.integers(0, 1000000, rows)
+    })
+
+    if edge_case == "ties":
+        data["Q608_total"] = rng.choice([0, 500, 500000], rows)
+    elif edge_case == "single_contributor":
+        data["region"] = rng.permutation(rows)
+    elif edge_case == "missing_values":
+        data["Q608_total"] = data["Q608_total"].astype("float64") \
+            .mask(rng.random(rows) < 0.2)
+    elif edge_case == "all_zero":
+        data["Q608_total"] = 0
+    elif edge_case == "presorted":
+        data = data.sort_values(["region", "strata"], ignore_index=True)
+
+    additional_aggregated_column = "" if edge_case == "no_additional_column" \
+        else "strata"
+
+    return data, "region", additional_aggregated_column
+
+
+def make_bricks(seed, edge_case, rows=60):
+    """
+    Generates splitter input, each row reporting for one brick type.
+    :param seed: Seed of the random generator. - Int.
+    :param edge_case: One of BRICK_EDGE_CASES. - String.
+    :param rows: Number of contributors. - Int.
+    :return: data, questions_list. - Tuple.
+    """
+    rng = np.random.default_rng(seed)
+    questions_list = [brick + "_" + column
+                      for column in BRICK_COLUMNS
+                      for brick in BRICK_TYPE.keys()]
+
+    data = pd.DataFrame(0, index=range(rows), columns=questions_list)
+    reported = rng.choice(list(BRICK_TYPE.keys()), rows)
+    for brick in BRICK_TYPE.keys():
+        columns = [brick + "_" + column for column in BRICK_COLUMNS]
+        values = rng.integers(0, 10000, (rows, len(columns))) * \
+            (rng.random((rows, len(columns))) < 0.7)
+        data.loc[reported == brick, columns] = values[reported == brick]
+
+    if edge_case == "all_zero":
+        data.loc[rng.random(rows) < 0.3, questions_list] = 0
+    elif edge_case == "several_types":
+        data.loc[rng.random(rows) < 0.3, questions_list] = \
+            rng.integers(0, 10000, (rows, len(questions_list)))[:1]
+    elif edge_case == "negative_values":
+        data[questions_list] = data[questions_list] * rng.choice([-1, 1], rows)[:, None]
+
+    data["enterprise_reference"] = rng.integers(1000000000, 1000000100, rows)
+    data["region"] = rng.integers(1, 13, rows)
+
+    return data, questions_list
+
+
+def reference_column_totals(data, to_aggregate, totals_dict):
+    """
+    The column method aggregation before compute engines and partitioning.
+    """
+    return data.groupby(to_aggregate).agg(totals_dict).reset_index()
+
+
+def reference_top_two(data, total_column, aggregated_column,
+                      additional_aggregated_column, top1_column, top2_column):
+    """
+    calc_top_two before compute engines and partitioning.
+    """
+    top1_column = total_column + "_" + top1_column
+    top2_column = total_column + "_" + top2_column
+
+    to_aggregate = [aggregated_column]
+    if additional_aggregated_column != "":
+        to_aggregate.append(additional_aggregated_column)
+
+    grouped_data = data.groupby(to_aggregate, as_index=False)\
+        .agg({total_column: lambda_method_top2_function.col_to_list})
+
+    grouped_data = grouped_data.apply(
+        lambda x: lambda_method_top2_function.do_top_two(
+            x, total_column, top1_column, top2_column), axis=1)
+
+    filter_output = [aggregated_column, top1_column, top2_column]
+    if additional_aggregated_column != "":
+        filter_output.append(additional_aggregated_column)
+
+    return grouped_data.drop(total_column, axis=1)[filter_output]
+
+
+@lru_cache(maxsize=None)
+def reference_collation(seed, edge_case):
+    """
+    The row by row brick type collation of generated input, which is slow enough to
+    be worth running once for all the variants.
+    """
+    data, questions_list = make_bricks(seed, edge_case)
+    return lambda_pre_wrangler_function.collate_brick_types(
+        data, BRICK_TYPE, BRICK_COLUMNS, questions_list, ["brick_type"])
+
+
+def reference_join(data, aggregations, to_aggregate):
+    """
+    The combiner merges before compute engines and chunking.
+    """
+    for aggregation in aggregations:
+        data = pd.merge(data, aggregation, on=to_aggregate, how="left")
+
+    return data
+
+
+def get_variant_engine(engine_name):
+    if engine_name == "duckdb":
+        pytest.importorskip("duckdb")
+    return engines.get_engine(engine_name)
+
+
+@pytest.mark.parametrize("engine_name,workers,chunks", VARIANTS)
+@pytest.mark.parametrize("edge_case", EDGE_CASES)
+@pytest.mark.parametrize("seed", SEEDS)
+@mock.patch("parallel.MINIMUM_PARTITION_ROWS", 1)
+def test_column_totals_differential(seed, edge_case, engine_name, workers, chunks,
+                                    tmp_path):
+    """
+    Checks the column method aggregation matches the reference exactly.
+    :param seed: Seed of the generated input.
+    :param edge_case: Shape of the generated input.
+    :param engine_name: Name of the compute engine.
+    :param workers: Number of worker processes.
+    :param chunks: Number of chunks.
+    :param tmp_path: Directory to spill chunk results to.
+    :return Test Pass/Fail
+    """
+    engine = get_variant_engine(engine_name)
+    data, aggregated_column, additional_aggregated_column = \
+        make_contributions(seed, edge_case)
+    to_aggregate = [aggregated_column]
+    if additional_aggregated_column != "":
+        to_aggregate.append(additional_aggregated_column)
+
+    for totals_dict in [{"Q608_total": "sum"}, {"enterprise_reference": "nunique"},
+                        {"Q608_total": "count"}]:
+        prepared_data = reference_column_totals(data, to_aggregate, totals_dict)
+        with mock.patch.object(parallel, "SPILL_DIRECTORY", str(tmp_path)):
+            produced_data = lambda_method_col_function.calc_column_totals(
+                data, to_aggregate, totals_dict, workers, engine, chunks)
+
+        assert_frame_equal(produced_data, prepared_data, check_exact=True)
+
+
+@pytest.mark.parametrize("dtype", ["int8", "int16", "uint8"])
+@pytest.mark.parametrize("seed", SEEDS)
+def test_dense_narrow_keys_differential(seed, dtype):
+    """
+    Checks the dense strategy matches the groupby exactly for keys of a narrow
+    integer type whose values span its whole range.
+    :param seed: Seed of the generated input.
+    :param dtype: Type of the key column.
+    :return Test Pass/Fail
+    """
+    rng = np.random.default_rng(seed)
+    limits = np.iinfo(dtype)
+    region = np.concatenate([[limits.min, limits.max, 0],
+                             rng.integers(limits.min, int(limits.max) + 1, 297)])
+    data = pd.DataFrame({"region": region.astype(dtype),
+                         "Q608_total": rng.integers(0, 1000000, 300)})
+    totals_dict = {"Q608_total": "sum"}
+
+    prepared_data = data.groupby(["region"]).agg(totals_dict)
+    produced_data = engines.dense_aggregate(data, ["region"], totals_dict)
+
+    assert_frame_equal(produced_data, prepared_data, check_exact=True)
+
+
+@pytest.mark.parametrize("engine_name,workers,chunks", VARIANTS)
+@pytest.mark.parametrize("edge_case", EDGE_CASES)
+@pytest.mark.parametrize("seed", SEEDS)
+@mock.patch("parallel.MINIMUM_PARTITION_ROWS", 1)
+def test_top_two_differential(seed, edge_case, engine_name, workers, chunks,
+                              tmp_path):
+    """
+    Checks calc_top_two matches the reference exactly.
+    :param seed: Seed of the generated input.
+    :param edge_case: Shape of the generated input.
+    :param engine_name: Name of the compute engine.
+    :param workers: Number of worker processes.
+    :param chunks: Number of chunks.
+    :param tmp_path: Directory to spill chunk results to.
+    :return Test Pass/Fail
+    """
+    engine = get_variant_engine(engine_name)
+    if engine_name == "duckdb" and edge_case == "missing_values":
+        pytest.skip("The reference sorts missing values wherever they fall in the "
+                    "group, where the duckdb engine ignores them.")
+    data, aggregated_column, additional_aggregated_column = \
+        make_contributions(seed, edge_case)
+
+    prepared_data = reference_top_two(
+        data, "Q608_total", aggregated_column, additional_aggregated_column,
+        "largest_contributor", "second_largest_contributor")
+    with mock.patch.object(parallel, "SPILL_DIRECTORY", str(tmp_path)):
+        produced_data = lambda_method_top2_function.calc_top_two(
+            data, "Q608_total", aggregated_column, additional_aggregated_column,
+            "largest_contributor", "second_largest_contributor", workers=workers,
+            engine=engine, chunks=chunks)
+
+    assert_frame_equal(produced_data, prepared_data, check_exact=True)
+
+
+@pytest.mark.parametrize("engine_name,workers,chunks", VARIANTS)
+@pytest.mark.parametrize("edge_case", EDGE_CASES)
+@pytest.mark.parametrize("seed", SEEDS)
+def test_join_aggregations_differential(seed, edge_case, engine_name, workers,
+                                        chunks, tmp_path):
+    """
+    Checks the combiner joins match the reference exactly, including rows in
+    groups missing from an aggregation.
+    :param seed: Seed of the generated input.
+    :param edge_case: Shape of the generated input.
+    :param engine_name: Name of the compute engine.
+    :param workers: Unused, the joins run in process.
+    :param chunks: Number of chunks.
+    :param tmp_path: Directory to spill chunk results to.
+    :return Test Pass/Fail
+    """
+    engine = get_variant_engine(engine_name)
+    data, aggregated_column, additional_aggregated_column = \
+        make_contributions(seed, edge_case)
+    to_aggregate = [aggregated_column]
+    if additional_aggregated_column != "":
+        to_aggregate.append(additional_aggregated_column)
+
+    cell_totals = reference_column_totals(data, to_aggregate, {"Q608_total": "sum"}) \
+        .rename(columns={"Q608_total": "cell_total_Q608_total"})
+    ent_counts = reference_column_totals(
+        data, to_aggregate, {"enterprise_reference": "nunique"}) \
+        .rename(columns={"enterprise_reference": "ent_ref_count"})
+    top_two = reference_top_two(
+        data, "Q608_total", aggregated_column, additional_aggregated_column,
+        "largest_contributor", "second_largest_contributor")
+    aggregations = [ent_counts, cell_totals.iloc[1:], top_two]
+
+    prepared_data = reference_join(data, aggregations, to_aggregate)
+    with mock.patch.object(parallel, "SPILL_DIRECTORY", str(tmp_path)):
+        produced_data = parallel.apply_chunked(
+            lambda chunk: lambda_combiner_function.join_aggregations(
+                chunk, aggregations, to_aggregate, engine),
+            data, chunks=chunks).reset_index(drop=True)
+
+    assert_frame_equal(produced_data, prepared_data, check_exact=True)
+
+
+@pytest.mark.parametrize("engine_name", ["pandas", "duckdb"])
+@pytest.mark.parametrize("edge_case", EDGE_CASES)
+@pytest.mark.parametrize("seed", SEEDS)
+def test_factorised_differential(seed, edge_case, engine_name):
+    """
+    Checks the wide view of the factorised combiner output matches the reference
+    joins exactly, including rows in groups missing from an aggregation.
+    :param seed: Seed of the generated input.
+    :param edge_case: Shape of the generated input.
+    :param engine_name: Name of the compute engine.
+    :return Test Pass/Fail
+    """
+    engine = get_variant_engine(engine_name)
+    data, aggregated_column, additional_aggregated_column = \
+        make_contributions(seed, edge_case)
+    to_aggregate = [aggregated_column]
+    if additional_aggregated_column != "":
+        to_aggregate.append(additional_aggregated_column)
+
+    cell_totals = reference_column_totals(data, to_aggregate, {"Q608_total": "sum"}) \
+        .rename(columns={"Q608_total": "cell_total_Q608_total"})
+    ent_counts = reference_column_totals(
+        data, to_aggregate, {"enterprise_reference": "nunique"}) \
+        .rename(columns={"enterprise_reference": "ent_ref_count"})
+    top_two = reference_top_two(
+        data, "Q608_total", aggregated_column, additional_aggregated_column,
+        "largest_contributor", "second_largest_contributor")
+    aggregations = [ent_counts.iloc[1:], cell_totals.iloc[:-1], top_two]
+
+    prepared_data = reference_join(data, aggregations, to_aggregate)
+    produced_data = factorised.factorise(data, aggregations, to_aggregate, engine)
+
+    assert len(produced_data.aggregates) <= len(prepared_data)
+    assert_frame_equal(produced_data.wide(), prepared_data, check_exact=True)
+    for column in produced_data.aggregate_columns:
+        assert_series_equal(produced_data.column(column), prepared_data[column],
+                            check_dtype=False, check_exact=True)
+
+
+@pytest.mark.parametrize("sparse,workers,chunks", BRICK_VARIANTS)
+@pytest.mark.parametrize("edge_case", BRICK_EDGE_CASES)
+@pytest.mark.parametrize("seed", SEEDS)
+@mock.patch("parallel.MINIMUM_PARTITION_ROWS", 1)
+def test_collate_brick_types_differential(seed, edge_case, sparse, workers, chunks,
+                                          tmp_path):
+    """
+    Checks the partitioned and long form brick type collations match the row by row
+    collation exactly.
+    :param seed: Seed of the generated input.
+    :param edge_case: Shape of the generated input.
+    :param sparse: Whether to collate from the long form.
+    :param workers: Number of worker processes.
+    :param chunks: Number of chunks.
+    :param tmp_path: Directory to spill chunk results to.
+    :return Test Pass/Fail
+    """
+    data, questions_list = make_bricks(seed, edge_case)
+    collate = lambda_pre_wrangler_function.collate_brick_types_sparse if sparse \
+        else lambda_pre_wrangler_function.collate_brick_types
+
+    prepared_data = reference_collation(seed, edge_case)
+    with mock.patch.object(parallel, "SPILL_DIRECTORY", str(tmp_path)):
+        produced_data = parallel.apply_partitioned(
+            lambda partition: collate(partition.copy(), BRICK_TYPE, BRICK_COLUMNS,
+                                      questions_list, ["brick_type"]),
+            data, workers=workers, chunks=chunks)
+
+    # Rows with no positive brick type total come out of the reference's row by row
+    # apply without the generic columns, which reorders the columns and makes them
+    # all float. The values must still match.
+    relaxed = sparse and edge_case == "negative_values"
+    assert_frame_equal(produced_data, prepared_data, check_exact=True,
+                       check_like=relaxed, check_dtype=not relaxed)
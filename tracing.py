@@ -0,0 +1,231 @@
+import argparse
+import json
+import sys
+import time
+import uuid
+
+
+class Tracer:
+    """
+    Records the spans of a single lambda invocation. Every invocation is a span,
+    and each instrumentation stage (read, decode, compute, encode, invoke, write,
+    notify) is a span within it. The trace context passed to a method in the
+    invoke payload makes the method's invocation a child of the wrangler's.
+    Without an incoming context, the trace id is the run_id, so every function of
+    a run lands in the same trace.
+
+    Spans use wall clock time, as they are compared across functions, and are
+    emitted as a single log line for the collector to assemble.
+    When disabled every call returns immediately.
+    """
+
+    def __init__(self, run_id, current_module, trace_context=None, enabled=False):
+        """
+        :param run_id: The run_id of the current invocation. - String.
+        :param current_module: Name of the module being traced. - String.
+        :param trace_context: Context from the caller, with a trace_id and
+                              parent_span_id. - Dict.
+        :param enabled: Whether to record and emit spans. - Bool.
+        """
+        trace_context = trace_context or {}
+        self.run_id = run_id
+        self.current_module = current_module
+        self.enabled = enabled
+        self.trace_id = trace_context.get("trace_id", str(run_id))
+        self.parent_span_id = trace_context.get("parent_span_id")
+        self.span_id = uuid.uuid4().hex[:16]
+        self.start = time.time()
+        self.spans = []
+
+    def child_context(self):
+        """
+        Trace context to send in the payload of an invoke.
+
+        :return: trace_context: Empty when disabled. - Dict.
+        """
+        if not self.enabled:
+            return {}
+
+        return {"trace_id": self.trace_id, "parent_span_id": self.span_id}
+
+    def add_span(self, name, start, end):
+        """
+        Records a span within the invocation.
+
+        :param name: Name of the span. e.g. read, compute. - String.
+        :param start: Start time in seconds since the epoch. - Float.
+        :param end: End time in seconds since the epoch. - Float.
+        :return: None
+        """
+        if not self.enabled:
+            return
+
+        self.spans.append({"name": name, "start": start, "end": end})
+
+    def emit(self, logger):
+        """
+        Ends the invocation span and writes it, with its spans, to the log.
+
+        :param logger: The handler's logger.
+        :return: None
+        """
+        if not self.enabled:
+            return
+
+        logger.info(json.dumps({"trace": {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_span_id": self.parent_span_id,
+            "module": self.current_module,
+            "run_id": self.run_id,
+            "start": self.start,
+            "end": time.time(),
+            "spans": self.spans
+        }}))
+
+
+def read_traces(lines):
+    """
+    Collects the invocation spans emitted by Tracer from log lines, such as a
+    CloudWatch Logs export or the output of a local run. Any text before the JSON
+    on a line is ignored, as are lines that hold no trace.
+
+    :param lines: Log lines. - Iterable.
+
+    :return: traces: Invocation spans by trace id, in start order. - Dict.
+    """
+    traces = {}
+    for line in lines:
+        position = line.find('{"trace"')
+        if position == -1:
+            continue
+        try:
+            invocation = json.loads(line[position:])["trace"]
+        except ValueError:
+            continue
+        traces.setdefault(invocation["trace_id"], []).append(invocation)
+
+    for invocations in traces.values():
+        invocations.sort(key=lambda invocation: invocation["start"])
+
+    return traces
+
+
+def critical_path(invocations):
+    """
+    Works out where the end to end time of a trace went. Functions that were not
+    invoked by another, such as pipeline steps, are chained backwards from the one
+    that ended last, each preceded by the latest one to end before it started.
+    Within a function, an invoke span is replaced by the spans of the method it
+    waited on, with what remains of the invoke attributed to the invoke overhead.
+    Gaps between functions are attributed to orchestration.
+
+    :param invocations: Invocation spans of one trace. - List.
+
+    :return: path: Entries with the module, span name and seconds. - List.
+    """
+    children = {}
+    roots = []
+    for invocation in invocations:
+        if invocation["parent_span_id"] is None:
+            roots.append(invocation)
+        else:
+            children.setdefault(invocation["parent_span_id"], []).append(invocation)
+
+    chain = []
+    current = max(roots, key=lambda root: root["end"], default=None)
+    while current is not None:
+        chain.insert(0, current)
+        current = max((root for root in roots if root["end"] <= current["start"]),
+                      key=lambda root: root["end"], default=None)
+
+    path = []
+    for position, invocation in enumerate(chain):
+        if position > 0:
+            gap = invocation["start"] - chain[position - 1]["end"]
+            path.append({"module": "", "name": "orchestration", "seconds": gap})
+        path.extend(_invocation_path(invocation, children))
+
+    return path
+
+
+def waterfall(invocations):
+    """
+    Lays out every span of a trace against a shared time axis, indenting methods
+    under the function that invoked them.
+
+    :param invocations: Invocation spans of one trace. - List.
+
+    :return: lines: One line per span with its offset and duration. - List.
+    """
+    if not invocations:
+        return []
+
+    origin = min(invocation["start"] for invocation in invocations)
+    depths = {}
+    lines = []
+    for invocation in invocations:
+        depth = depths.get(invocation["parent_span_id"], -1) + 1
+        depths[invocation["span_id"]] = depth
+        indent = "  " * depth
+        lines.append(_waterfall_line(indent + invocation["module"], invocation,
+                                     origin))
+        for span in invocation["spans"]:
+            lines.append(_waterfall_line(indent + "  " + span["name"], span, origin))
+
+    return lines
+
+
+def _invocation_path(invocation, children):
+    path = []
+    covered = 0.0
+    for span in invocation["spans"]:
+        seconds = span["end"] - span["start"]
+        covered += seconds
+        waited_on = [child for child in children.get(invocation["span_id"], [])
+                     if span["start"] <= child["start"] <= span["end"]]
+        if span["name"] == "invoke" and waited_on:
+            child = max(waited_on, key=lambda child: child["end"] - child["start"])
+            path.extend(_invocation_path(child, children))
+            seconds -= child["end"] - child["start"]
+            path.append({"module": invocation["module"], "name": "invoke overhead",
+                         "seconds": seconds})
+        else:
+            path.append({"module": invocation["module"], "name": span["name"],
+                         "seconds": seconds})
+
+    path.append({"module": invocation["module"], "name": "other",
+                 "seconds": max(invocation["end"] - invocation["start"] - covered,
+                                0.0)})
+
+    return path
+
+
+def _waterfall_line(label, span, origin):
+    return (f"{label:<50} +{(span['start'] - origin) * 1000:10.1f} ms "
+            f"{(span['end'] - span['start']) * 1000:10.1f} ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Assemble traced runs into a waterfall and critical path.")
+    parser.add_argument("log_file", nargs="?", help="Log file, defaults to stdin.")
+    parser.add_argument("--run-id", help="Only report this run.")
+    arguments = parser.parse_args()
+
+    if arguments.log_file:
+        with open(arguments.log_file, "r") as log_file:
+            collected = read_traces(log_file)
+    else:
+        collected = read_traces(sys.stdin)
+
+    for trace_id, trace in collected.items():
+        if arguments.run_id and trace[0]["run_id"] != arguments.run_id:
+            continue
+        print(f"Trace {trace_id}")
+        print("\n".join(waterfall(trace)))
+        print("Critical path:")
+        for entry in critical_path(trace):
+            print(f"    {entry['module']:<40} {entry['name']:<20} "
+                  f"{entry['seconds'] * 1000:10.1f} ms")
+        print()
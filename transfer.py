@@ -0,0 +1,207 @@
+import io
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import boto3
+import numpy as np
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from es_aws_functions import aws_functions
+
+from json_layout import decode_frame
+from result_cache import object_key
+
+# GETs are not hedged until this many latencies have been seen, nor sooner than
+# HEDGE_MINIMUM_DELAY seconds, however fast the requests so far.
+HEDGE_MINIMUM_SAMPLES = 10
+HEDGE_MINIMUM_DELAY = 0.05
+
+# Latencies the hedging threshold is taken from, newest first.
+LATENCY_WINDOW = 200
+
+
+class Transfer:
+    """
+    Reads and writes S3 objects over several connections at once. Objects larger
+    than part_size are uploaded as a concurrent multipart upload and downloaded as
+    concurrent ranged GETs of part_size bytes, so one connection no longer caps
+    the throughput on large outputs. S3 requires upload parts of at least 5 MiB,
+    and boto3 raises smaller upload part sizes to that.
+    When part_size is 0, the aws_functions single request versions are used,
+    except for reads of the split JSON layout, which aws_functions cannot decode,
+    and when hedging or retries are configured.
+
+    With a hedge_percentile, a single request GET that has not responded within
+    that percentile of the latencies seen so far is sent again, and whichever
+    response arrives first is used. Latency is measured to the response headers,
+    so it does not grow with the size of the object. Ranged GETs are not hedged.
+    With max_attempts, requests are retried up to that many attempts in all, with
+    botocore's adaptive retry mode: jittered exponential backoff, and a client
+    side rate limit that slows down when S3 throttles.
+    """
+
+    def __init__(self, part_size=0, concurrency=10, json_layout="records",
+                 hedge_percentile=0.0, max_attempts=0, latencies=None):
+        self.part_size = part_size
+        self.concurrency = concurrency
+        self.json_layout = json_layout
+        self.hedge_percentile = hedge_percentile
+        self.max_attempts = max_attempts
+        self.latencies = latencies if latencies is not None else GET_LATENCIES
+        self.enabled = part_size > 0
+        self.hedging = hedge_percentile > 0
+        self.direct = self.enabled or self.hedging or max_attempts > 0
+        self.hedged_reads = 0
+        self.hedges_won = 0
+        self._lock = threading.Lock()
+        self._client = None
+
+    @property
+    def client(self):
+        if self._client is None:
+            retries = {"mode": "adaptive", "total_max_attempts": self.max_attempts} \
+                if self.max_attempts > 0 else None
+            self._client = boto3.client("s3", region_name="eu-west-2",
+                                        config=Config(retries=retries))
+        return self._client
+
+    @property
+    def config(self):
+        return TransferConfig(multipart_threshold=self.part_size,
+                              multipart_chunksize=self.part_size,
+                              max_concurrency=self.concurrency)
+
+    def read_dataframe(self, bucket_name, file_name):
+        """
+        Drop in replacement for aws_functions.read_dataframe_from_s3.
+
+        :param bucket_name: Name of the bucket holding the file. - String.
+        :param file_name: Name of the file. - String.
+
+        :return: data: Contents of the file. - DataFrame.
+        """
+        if not self.direct and self.json_layout == "records":
+            return aws_functions.read_dataframe_from_s3(bucket_name, file_name)
+
+        if not self.enabled:
+            return decode_frame(self.get_object(
+                bucket_name, object_key(file_name))["Body"].read())
+
+        content = io.BytesIO()
+        self.client.download_fileobj(bucket_name, object_key(file_name), content,
+                                     Config=self.config)
+
+        return decode_frame(content.getvalue())
+
+    def save_to_s3(self, bucket_name, file_name, data):
+        """
+        Drop in replacement for aws_functions.save_to_s3.
+
+        :param bucket_name: Name of the bucket to save to. - String.
+        :param file_name: Name of the file. - String.
+        :param data: Contents of the file. - String.
+
+        :return: None
+        """
+        if not self.direct:
+            aws_functions.save_to_s3(bucket_name, file_name, data)
+            return
+
+        if not self.enabled:
+            self.client.put_object(Bucket=bucket_name, Key=object_key(file_name),
+                                   Body=data.encode("utf-8"))
+            return
+
+        self.client.upload_fileobj(io.BytesIO(data.encode("utf-8")), bucket_name,
+                                   object_key(file_name), Config=self.config)
+
+    def get_object(self, bucket_name, key):
+        """
+        GETs an object, hedging the request when it is slow to respond.
+
+        :param bucket_name: Name of the bucket holding the object. - String.
+        :param key: Key of the object. - String.
+
+        :return: response: The get_object response. - Dict.
+        """
+        threshold = self.latencies.threshold(self.hedge_percentile) \
+            if self.hedging else None
+        if threshold is None:
+            return self._timed_get(bucket_name, key)
+
+        executor = ThreadPoolExecutor(max_workers=2)
+        try:
+            requests = [executor.submit(self._timed_get, bucket_name, key)]
+            done, _ = wait(requests, timeout=threshold)
+            if not done:
+                requests.append(executor.submit(self._timed_get, bucket_name, key))
+                with self._lock:
+                    self.hedged_reads += 1
+
+            # Use the first success, and only fail if every request failed.
+            pending = set(requests)
+            while True:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for request in requests:
+                    if request in done and request.exception() is None:
+                        if request is not requests[0]:
+                            with self._lock:
+                                self.hedges_won += 1
+                        for other in pending:
+                            other.add_done_callback(_close_response)
+                        return request.result()
+                if not pending:
+                    return requests[0].result()
+        finally:
+            executor.shutdown(wait=False)
+
+    def _timed_get(self, bucket_name, key):
+        start = time.perf_counter()
+        response = self.client.get_object(Bucket=bucket_name, Key=key)
+        self.latencies.add(time.perf_counter() - start)
+        return response
+
+
+class LatencyTracker:
+    """
+    Keeps the most recent request latencies, across the invocations a warm
+    container serves, to set the hedging threshold from.
+    """
+
+    def __init__(self, window=LATENCY_WINDOW):
+        self.samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def add(self, latency):
+        """
+        :param latency: Seconds a request took to respond. - Float.
+        :return: None
+        """
+        with self._lock:
+            self.samples.append(latency)
+
+    def threshold(self, percentile):
+        """
+        Seconds after which a request is slower than percentile of those seen.
+
+        :param percentile: Percentile of the latencies, 0 to 100. - Float.
+
+        :return: threshold: None until enough latencies have been seen. - Float.
+        """
+        with self._lock:
+            if len(self.samples) < HEDGE_MINIMUM_SAMPLES:
+                return None
+            samples = list(self.samples)
+
+        return max(float(np.percentile(samples, percentile)), HEDGE_MINIMUM_DELAY)
+
+
+def _close_response(request):
+    # The losing response of a hedged GET still holds its connection open.
+    if request.exception() is None:
+        request.result()["Body"].close()
+
+
+GET_LATENCIES = LatencyTracker()